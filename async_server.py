@@ -0,0 +1,146 @@
+"""Event-loop server for UpdateMe: tornado holds the connections, and the Flask app is run
+on thread pools so that a request waiting on the database never holds up the others
+
+	python async_server.py
+
+The read-heavy JSON routes get a pool of their own, and so do notification streams: each
+open stream holds one of NOTIFICATION_STREAMS threads, and a stream asked for when they are
+all taken is answered 503 at once (the browser then polls), so open streams can't starve
+the pages, forms or JSON routes. Tornado reads each request body into memory before the app
+sees it, so uploads aren't streamed to disk here; the Procfile runs gunicorn instead"""
+
+from tornado import httputil, ioloop
+
+from tornado.httpserver import HTTPServer
+
+from tornado.log import access_log, enable_pretty_logging
+
+from tornado.wsgi import WSGIContainer
+
+from concurrent.futures import ThreadPoolExecutor
+
+from server import app, configure_app, NOTIFICATION_STREAMS, MAX_PICTURE_BYTES
+
+import os
+
+import threading
+
+import time
+
+ASYNC_JSON_ROUTES = set(["/feed-all-json", "/feed-connects-json", "/get-notifications-json",
+	"/older-messages.json", "/check-username"])
+ASYNC_STREAM_ROUTES = set(["/notifications/stream"])
+ASYNC_JSON_THREADS = int(os.environ.get("ASYNC_JSON_THREADS", 10))
+ASYNC_THREADS = int(os.environ.get("ASYNC_THREADS", 20))
+
+
+class PooledWSGIContainer(object):
+	"""Runs a WSGI application for each tornado request on a thread pool, sending the
+	response back through the IOLoop a chunk at a time as the application produces it.
+	Requests for stream_paths run on a pool of max_streams threads of their own, and are
+	turned away with a 503 when those are all taken rather than waiting for one"""
+
+	def __init__(self, wsgi_application, executor, fast_executor=None, fast_paths=(), stream_paths=(),
+			max_streams=0):
+		self.wsgi_application = wsgi_application
+		self.executor = executor
+		self.fast_executor = fast_executor or executor
+		self.fast_paths = set(fast_paths)
+		self.stream_paths = set(stream_paths)
+		self.stream_executor = ThreadPoolExecutor(max_streams) if max_streams > 0 else None
+		self.stream_slots = threading.BoundedSemaphore(max_streams) if max_streams > 0 else None
+
+	def __call__(self, request):
+		release = None
+		if request.path in self.stream_paths:
+			if self.stream_slots is None or not self.stream_slots.acquire(False):
+				self.reject(request)
+				return
+			executor = self.stream_executor
+			release = self.stream_slots.release
+		elif request.path in self.fast_paths:
+			executor = self.fast_executor
+		else:
+			executor = self.executor
+		closed = []
+		request.connection.set_close_callback(lambda: closed.append(True))
+		executor.submit(self.run, request, ioloop.IOLoop.current(), closed, release)
+
+	def reject(self, request):
+		"""Answers a stream request from the IOLoop itself when every stream thread is taken"""
+
+		self.write_headers(request, "503 Service Unavailable", [("Retry-After", "60"), ("Content-Length", "0")], b"")
+		self.finish(request)
+
+	def run(self, request, io_loop, closed, release=None):
+		"""Calls the application (on a pool thread) and hands what it returns to the IOLoop"""
+
+		started = {}
+
+		def start_response(status, response_headers, exc_info=None):
+			started["status"] = status
+			started["headers"] = response_headers
+			return write
+
+		def write(chunk):
+			if "sent" not in started:
+				started["sent"] = True
+				io_loop.add_callback(self.write_headers, request, started["status"], started["headers"], chunk)
+			elif chunk:
+				io_loop.add_callback(request.connection.write, chunk)
+
+		try:
+			app_response = self.wsgi_application(WSGIContainer.environ(request), start_response)
+			try:
+				for chunk in app_response:
+					write(chunk)
+					#stops a stream once its client has gone
+					if closed:
+						break
+				if "sent" not in started:
+					write(b"")
+			finally:
+				if hasattr(app_response, "close"):
+					app_response.close()
+		except Exception:
+			access_log.exception("Error handling %s", request.uri)
+			if "sent" not in started:
+				start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+				write(b"Internal Server Error")
+		finally:
+			if release is not None:
+				release()
+		io_loop.add_callback(self.finish, request)
+
+	def write_headers(self, request, status, response_headers, chunk):
+		"""Sends the status line and headers, with the first chunk of the body"""
+
+		status_code, reason = status.split(" ", 1)
+		start_line = httputil.ResponseStartLine("HTTP/1.1", int(status_code), reason)
+		headers = httputil.HTTPHeaders()
+		for key, value in response_headers:
+			headers.add(key, value)
+		request.status_code = int(status_code)
+		request.connection.write_headers(start_line, headers, chunk=chunk)
+
+	def finish(self, request):
+		request.connection.finish()
+		access_log.info("%d %s %s %.2fms", getattr(request, "status_code", 500), request.method,
+			request.uri, 1000.0 * (time.time() - request._start_time))
+
+
+def make_server():
+	"""Returns an HTTPServer running the Flask app on the thread pools (turning away request
+	bodies larger than an upload may be, as tornado holds each one in memory)"""
+
+	container = PooledWSGIContainer(app, ThreadPoolExecutor(ASYNC_THREADS),
+		ThreadPoolExecutor(ASYNC_JSON_THREADS), ASYNC_JSON_ROUTES, ASYNC_STREAM_ROUTES, NOTIFICATION_STREAMS)
+	return HTTPServer(container, max_body_size=MAX_PICTURE_BYTES + 1024 * 1024)
+
+
+if __name__ == "__main__":
+	enable_pretty_logging()
+	configure_app()
+	server = make_server()
+	server.listen(int(os.environ.get("PORT", 5000)))
+	ioloop.IOLoop.current().start()
@@ -0,0 +1,62 @@
+"""Benchmark comparing the read-heavy JSON routes on the threaded Flask server
+(python server.py) and the event-loop server (python async_server.py): requests per
+second and latency percentiles at a given concurrency
+
+	python server.py                          (serves on port 5000)
+	PORT=5001 python async_server.py
+	python bench_async.py --username shepard --password ... --other-id 2"""
+
+from tornado import gen, ioloop
+
+from bench_common import log_in, run_load, summarize
+
+import argparse
+
+
+def route_paths(other_id, username):
+	"""The JSON routes that async_server.py gives their own pool, with example arguments"""
+
+	return ["/feed-all-json", "/feed-connects-json", "/get-notifications-json",
+		"/older-messages.json?other_id=%d&offset=5" % other_id, "/check-username?username=%s" % username]
+
+
+@gen.coroutine
+def compare(servers, paths, total, concurrency):
+	"""Runs every path against every server in turn, and returns a list of result rows"""
+
+	rows = []
+	for path in paths:
+		for name, base_url, cookie in servers:
+			elapsed, latencies, failures = yield run_load(base_url + path, total, concurrency,
+				headers={"Cookie": cookie})
+			result = summarize(elapsed, latencies, failures)
+			result.update({"server": name, "path": path})
+			rows.append(result)
+	raise gen.Return(rows)
+
+
+def report(rows):
+	"""Prints the results as a table"""
+
+	print("%-45s %-6s %9s %9s %9s %8s" % ("route", "server", "req/s", "p50 ms", "p99 ms", "failed"))
+	for row in rows:
+		print("%-45s %-6s %9.1f %9.1f %9.1f %8d" % (row["path"], row["server"], row["rps"], row["p50"],
+			row["p99"], row["failures"]))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--sync-url", default="http://localhost:5000")
+	parser.add_argument("--async-url", default="http://localhost:5001")
+	parser.add_argument("--username", required=True)
+	parser.add_argument("--password", required=True)
+	parser.add_argument("--other-id", type=int, required=True, help="a user the logged in user has messaged")
+	parser.add_argument("--requests", type=int, default=2000, help="requests per route and server")
+	parser.add_argument("--concurrency", type=int, default=200)
+	args = parser.parse_args()
+
+	servers = [(name, url, log_in(url, args.username, args.password))
+		for name, url in [("sync", args.sync_url), ("async", args.async_url)]]
+	paths = route_paths(args.other_id, args.username)
+	rows = ioloop.IOLoop.current().run_sync(lambda: compare(servers, paths, args.requests, args.concurrency))
+	report(rows)
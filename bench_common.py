@@ -0,0 +1,66 @@
+"""Helpers shared by the benchmark and load test scripts"""
+
+from tornado import gen
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+import requests
+
+import time
+
+
+def log_in(base_url, username, password):
+	"""Logs in through the login form and returns the session cookie header"""
+
+	response = requests.post(base_url + "/login-success", data={"username": username, "password": password},
+		allow_redirects=False)
+	if "session" not in response.cookies:
+		raise SystemExit("Could not log in as %s" % username)
+	return "session=" + response.cookies["session"]
+
+
+def percentile(values, fraction):
+	"""Returns the value at a fraction (0 to 1) of the way through the sorted values"""
+
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+@gen.coroutine
+def run_load(url, total, concurrency, headers=None, method="GET", body=None, timeout=60):
+	"""Sends total requests to url, concurrency at a time, and returns (seconds taken,
+	list of latencies in seconds, number of failed requests)"""
+
+	http_client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+	latencies = []
+	failures = [0]
+	remaining = [total]
+
+	@gen.coroutine
+	def worker():
+		while remaining[0] > 0:
+			remaining[0] -= 1
+			request = HTTPRequest(url, method=method, body=body, headers=headers, follow_redirects=False,
+				connect_timeout=timeout, request_timeout=timeout)
+			started = time.time()
+			response = yield http_client.fetch(request, raise_error=False)
+			latencies.append(time.time() - started)
+			if response.code >= 400 or response.code == 599:
+				failures[0] += 1
+
+	started = time.time()
+	yield [worker() for i in range(concurrency)]
+	elapsed = time.time() - started
+	http_client.close()
+	raise gen.Return((elapsed, latencies, failures[0]))
+
+
+def summarize(elapsed, latencies, failures):
+	"""Turns the results of run_load into requests per second and latency percentiles (ms)"""
+
+	return {"requests": len(latencies), "failures": failures,
+		"rps": len(latencies) / elapsed if elapsed else 0.0,
+		"p50": (percentile(latencies, 0.5) or 0) * 1000,
+		"p99": (percentile(latencies, 0.99) or 0) * 1000}
@@ -0,0 +1,35 @@
+"""Benchmark for /login-success under concurrent load: logins per second and latency
+percentiles, to compare password worker and cost factor settings
+
+	PASSWORD_WORKERS=4 BCRYPT_ROUNDS=12 python server.py
+	python bench_login.py --username shepard --password ... --concurrency 50"""
+
+from tornado import ioloop
+
+from bench_common import run_load, summarize
+
+import argparse
+
+try:
+	from urllib import urlencode
+except ImportError:
+	from urllib.parse import urlencode
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--url", default="http://localhost:5000")
+	parser.add_argument("--username", required=True)
+	parser.add_argument("--password", required=True)
+	parser.add_argument("--requests", type=int, default=500)
+	parser.add_argument("--concurrency", type=int, default=50)
+	args = parser.parse_args()
+
+	body = urlencode({"username": args.username, "password": args.password})
+	results = ioloop.IOLoop.current().run_sync(lambda: run_load(args.url + "/login-success", args.requests,
+		args.concurrency, headers={"Content-Type": "application/x-www-form-urlencoded"}, method="POST", body=body))
+	result = summarize(*results)
+	print("logins:      %d (%d failed)" % (result["requests"], result["failures"]))
+	print("logins/s:    %.1f" % result["rps"])
+	print("p50 (ms):    %.1f" % result["p50"])
+	print("p99 (ms):    %.1f" % result["p99"])
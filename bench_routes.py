@@ -0,0 +1,258 @@
+"""Benchmark of every route in server.py, run in this process through the Flask test client
+against a seeded database: latency percentiles and SQL statements per request for each
+route, compared with a stored baseline
+
+	createdb twitterclonebench
+	python bench_routes.py --users 10000 --updates 100000 --save-baseline
+	python bench_routes.py                (exits with status 1 if a route has regressed)
+
+The database is seeded with fake_users.py when it has no users (or with --reseed). The
+write routes add rows as they run, so the numbers drift slowly on a reused database.
+SKIPPED_ENDPOINTS are left out"""
+
+from model import User, Update, Pair, Conversation, Notification, db
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from bench_common import percentile
+from server import app, configure_app, connections, add_notification
+from images import store_avatar
+from io import BytesIO
+from PIL import Image
+import argparse
+import fake_users
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+
+#/logout (would end the viewer's session), /notifications/stream (never ends), /approve-connection
+#(each request can only be approved once) and /submit-profile-pic (the form version of /profile-pic)
+SKIPPED_ENDPOINTS = set(["logout", "stream_notifications", "approve_request", "upload_user_pic"])
+
+
+class StatementCounter(object):
+	"""Counts the SQL statements sent to the database while it is listening"""
+
+	def __init__(self):
+		self.count = 0
+
+	def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+		self.count += 1
+
+	def __enter__(self):
+		event.listen(Engine, "before_cursor_execute", self.count_statement)
+		return self
+
+	def __exit__(self, *args):
+		event.remove(Engine, "before_cursor_execute", self.count_statement)
+
+
+def pick_subjects():
+	"""Picks what the routes are run against: the user with the most connections as the
+	viewer, the connection they have exchanged most messages with, a user they aren't
+	connected to, the newest public update, one of the viewer's notifications (added if
+	they have none) and a picture to upload (stored once, so that it can be served too)"""
+
+	viewer_id = db.session.query(Pair.user_1_id).group_by(Pair.user_1_id).order_by(
+		db.func.count(Pair.pair_id).desc(), Pair.user_1_id).limit(1).scalar()
+	viewer = User.query.get(viewer_id)
+	conversation = Conversation.query.filter((Conversation.user_1_id == viewer_id) |
+		(Conversation.user_2_id == viewer_id)).order_by(Conversation.message_count.desc()).first()
+	if conversation:
+		pair_id = conversation.pair_id
+		connected_id = conversation.user_2_id if conversation.user_1_id == viewer_id else conversation.user_1_id
+	else:
+		pair_id, connected_id = db.session.query(Pair.pair_id, Pair.user_2_id).filter(
+			Pair.user_1_id == viewer_id).first()
+	stranger_id = db.session.query(User.user_id).filter(~User.user_id.in_(list(connections(viewer_id)) + [viewer_id])).order_by(
+		User.user_id).limit(1).scalar()
+	update = Update.query.filter(Update.is_public == True).order_by(Update.posted_at.desc()).first()
+	notification_id = db.session.query(Notification.notification_id).filter(Notification.user_id == viewer_id).order_by(
+		Notification.notification_id).limit(1).scalar()
+	if notification_id is None:
+		notification_id = add_notification(viewer_id, "msg")
+	picture = BytesIO()
+	Image.new("RGB", (640, 480), (40, 90, 160)).save(picture, "PNG")
+	avatar = store_avatar(BytesIO(picture.getvalue()))
+	return {"viewer_id": viewer_id, "username": viewer.username, "pair_id": pair_id,
+		"connected_id": connected_id, "stranger_id": stranger_id, "update_id": update.update_id,
+		"word": re.sub("[^a-z]", "", update.update_body.split()[0].lower()) or "a",
+		"notification_id": notification_id, "picture": bytearray(picture.getvalue()), "avatar": avatar}
+
+def route_cases(subjects, password):
+	"""Returns (name, method, path, form data, logged in) for each benchmarked request. {i}
+	in a path or form value is replaced with the number of the request, and {run} with a
+	number unique to this run (a bytearray is sent as the whole request body)"""
+
+	s = subjects
+	return [
+		("home", "GET", "/", None, True),
+		("register form", "GET", "/register", None, False),
+		("register", "POST", "/register-success", {"username": "b{run}_{i}", "password": password, "is_public": "1"}, False),
+		("login form", "GET", "/login", None, False),
+		("login", "POST", "/login-success", {"username": s["username"], "password": password}, False),
+		("compose update", "GET", "/compose-update", None, True),
+		("post update", "POST", "/update-posted", {"textbody": "Benchmark update {i}"}, True),
+		("update", "GET", "/update/%d" % s["update_id"], None, True),
+		("comment", "POST", "/add-comment/%d" % s["update_id"], {"comment": "Benchmark comment {i}"}, True),
+		("inbox", "GET", "/inbox", None, True),
+		("message thread", "GET", "/message/%d" % s["pair_id"], None, True),
+		("conversation read", "POST", "/mark-conversation-read-json", {"pair_id": str(s["pair_id"])}, True),
+		#a message the viewer didn't send, so nothing is deleted
+		("delete message", "POST", "/delete-message", {"msg_id": "0", "pair_id": str(s["pair_id"])}, True),
+		("compose message", "GET", "/compose-message", None, True),
+		("send message", "POST", "/submit-message", {"message": "Benchmark message {i}",
+			"chosen-recipient": str(s["connected_id"])}, True),
+		("reply", "POST", "/submit-reply-message", {"message": "Benchmark reply {i}",
+			"recipient": str(s["connected_id"])}, True),
+		("older messages", "GET", "/older-messages.json?other_id=%d&offset=10" % s["connected_id"], None, True),
+		("username taken", "GET", "/check-username?username=%s" % s["username"], None, False),
+		("username free", "GET", "/check-username?username=free{run}_{i}", None, False),
+		("public feed", "GET", "/feed-all-json", None, True),
+		("connections feed", "GET", "/feed-connects-json", None, True),
+		("search", "GET", "/search-results?search=%s" % s["word"], None, True),
+		("own profile", "GET", "/profile/%d" % s["viewer_id"], None, True),
+		("connected profile", "GET", "/profile/%d" % s["connected_id"], None, True),
+		("stranger profile", "GET", "/profile/%d" % s["stranger_id"], None, True),
+		("profile updates", "GET", "/profile-updates.json?user_id=%d" % s["connected_id"], None, True),
+		("upload picture", "POST", "/profile-pic", s["picture"], True),
+		("avatar", "GET", "/avatars/%s" % s["avatar"], None, False),
+		("request connection", "POST", "/request-connection/%d" % s["stranger_id"], None, True),
+		("connection requests", "GET", "/review-connection-requests", None, True),
+		("change password", "POST", "/preferences/change-password-success", {"current_password": password,
+			"new_password": password}, True),
+		("notifications", "GET", "/get-notifications-json", None, True),
+		("notification viewed", "POST", "/update-notifications-json", {"notification_id": str(s["notification_id"])}, True),
+		("notifications viewed", "POST", "/update-notifications-batch-json", {"notification_ids": []}, True),
+		("all notifications viewed", "POST", "/update-all-notifications-json", None, True),
+		("pool stats", "GET", "/pool-stats.json", None, False),
+		("cache stats", "GET", "/cache-stats.json", None, False),
+		("metrics", "GET", "/metrics", None, False)]
+
+def benchmarked_endpoints(cases):
+	"""Returns the names of the endpoints that the cases' requests are routed to"""
+
+	urls = app.url_map.bind("localhost")
+	return set(urls.match(path.split("?")[0], method)[0] for name, method, path, data, logged_in in cases)
+
+def fill_in(value, i, run):
+	if isinstance(value, bytearray):
+		return bytes(value)
+	if isinstance(value, dict):
+		return dict((key, fill_in(item, i, run)) for key, item in value.items())
+	if isinstance(value, list):
+		return value
+	return value.replace("{i}", str(i)).replace("{run}", str(run))
+
+def run_benchmark(subjects, requests=20, warmup=2, password="password123"):
+	"""Sends each route requests times (after warmup requests that aren't measured), and
+	returns route name to latency percentiles (ms), statements per request and errors"""
+
+	run = int(time.time()) % 100000
+	viewer = app.test_client()
+	with viewer.session_transaction() as session:
+		session["user_id"] = subjects["viewer_id"]
+		session["username"] = subjects["username"]
+	results = {}
+	for name, method, path, data, logged_in in route_cases(subjects, password):
+		client = viewer if logged_in else app.test_client()
+		latencies = []
+		statements = []
+		errors = 0
+		for i in range(warmup + requests):
+			with StatementCounter() as counter:
+				started = time.time()
+				response = client.open(fill_in(path, i, run), method=method, data=fill_in(data, i, run) if data else None)
+				elapsed = time.time() - started
+			if i < warmup:
+				continue
+			latencies.append(elapsed)
+			statements.append(counter.count)
+			if response.status_code >= 500:
+				errors += 1
+		db.session.remove()
+		results[name] = {"p50": percentile(latencies, 0.5) * 1000, "p90": percentile(latencies, 0.9) * 1000,
+			"p99": percentile(latencies, 0.99) * 1000, "statements": float(sum(statements)) / len(statements),
+			"errors": errors}
+	return results
+
+def find_regressions(results, baseline, threshold=0.25, min_ms=2.0):
+	"""Compares results with a baseline, and returns a description of each route whose median
+	latency grew by more than threshold (a fraction) and min_ms, that sends more statements
+	per request, or that had errors"""
+
+	regressions = []
+	for name, result in sorted(results.items()):
+		if result["errors"]:
+			regressions.append("%s: %d errors" % (name, result["errors"]))
+		if name not in baseline:
+			continue
+		before = baseline[name]
+		if result["p50"] > before["p50"] * (1 + threshold) and result["p50"] - before["p50"] > min_ms:
+			regressions.append("%s: p50 %.1fms, was %.1fms" % (name, result["p50"], before["p50"]))
+		#statement counts barely vary between runs, so any real increase counts
+		if result["statements"] > before["statements"] + 0.5:
+			regressions.append("%s: %.1f statements per request, was %.1f" % (name, result["statements"],
+				before["statements"]))
+	return regressions
+
+def report(results, baseline):
+	"""Prints the results as a table, with the baseline's median latency alongside"""
+
+	print("%-26s %9s %9s %9s %9s %11s" % ("route", "p50 ms", "p90 ms", "p99 ms", "was p50", "statements"))
+	for name, result in sorted(results.items()):
+		before = baseline.get(name)
+		print("%-26s %9.1f %9.1f %9.1f %9s %11.1f" % (name, result["p50"], result["p90"], result["p99"],
+			"%.1f" % before["p50"] if before else "-", result["statements"]))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--database-url", default="postgresql:///twitterclonebench")
+	parser.add_argument("--reseed", action="store_true", help="drop the database's tables and seed it again")
+	parser.add_argument("--users", type=int, default=10000)
+	parser.add_argument("--updates", type=int, default=100000)
+	parser.add_argument("--pairs", type=int, default=50000)
+	parser.add_argument("--messages", type=int, default=50000)
+	parser.add_argument("--notifications", type=int, default=20000)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--password", default="password123", help="the seeded users' password")
+	parser.add_argument("--requests", type=int, default=20, help="measured requests per route")
+	parser.add_argument("--warmup", type=int, default=2, help="unmeasured requests per route first")
+	parser.add_argument("--baseline", default="bench_baseline.json")
+	parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+	parser.add_argument("--threshold", type=float, default=0.25, help="allowed growth of a median latency")
+	parser.add_argument("--min-ms", type=float, default=2.0, help="latency growth always allowed")
+	args = parser.parse_args()
+
+	environ = dict(os.environ, DATABASE_URL=args.database_url)
+	configure_app(environ)
+	if args.reseed:
+		db.drop_all()
+	db.create_all()
+	if args.reseed or not User.query.first():
+		fake_users.seed(args.users, args.updates, args.pairs, args.messages, args.notifications, args.seed,
+			workers=multiprocessing.cpu_count(), password=args.password)
+
+	dataset = {"users": User.query.count(), "updates": Update.query.count(), "pairs": Pair.query.count()}
+	baseline = {}
+	if os.path.isfile(args.baseline) and not args.save_baseline:
+		with open(args.baseline) as baseline_file:
+			stored = json.load(baseline_file)
+		baseline = stored["routes"]
+		if stored["dataset"] != dataset:
+			print("warning: the baseline was measured on a different dataset (%s)" % stored["dataset"])
+
+	results = run_benchmark(pick_subjects(), args.requests, args.warmup, args.password)
+	report(results, baseline)
+	if args.save_baseline:
+		with open(args.baseline, "w") as baseline_file:
+			json.dump({"dataset": dataset, "routes": results}, baseline_file, indent=2, sort_keys=True)
+		print("baseline saved to %s" % args.baseline)
+	regressions = find_regressions(results, baseline, args.threshold, args.min_ms)
+	for regression in regressions:
+		print("regression: " + regression)
+	sys.exit(1 if regressions else 0)
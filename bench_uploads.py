@@ -0,0 +1,121 @@
+"""Benchmark of the server's memory use while it receives profile pictures: the peak resident
+memory of the server process at growing numbers of concurrent uploads, through the streamed
+upload (/profile-pic) and through the form upload (/submit-profile-pic)
+
+	python server.py               (or gunicorn --workers 1 --threads 50 wsgi:application)
+	python bench_uploads.py --username shepard --password ... --pid <server's pid>
+
+async_server.py isn't suitable, as its tornado front end reads whole request bodies into
+memory before the app sees them. Linux only (the server's memory is read from /proc)"""
+
+from tornado import ioloop
+
+from PIL import Image
+
+from io import BytesIO
+
+from bench_common import log_in, run_load, summarize
+
+import argparse
+
+import os
+
+import threading
+
+import time
+
+
+def make_picture(width, height):
+	"""Returns the bytes of a JPEG of random noise (which hardly compresses, so the file is large)"""
+
+	picture = BytesIO()
+	Image.frombytes("RGB", (width, height), os.urandom(width * height * 3)).save(picture, "JPEG", quality=95)
+	return picture.getvalue()
+
+def multipart_body(data, boundary="benchmarkboundary"):
+	"""Wraps a picture in a multipart/form-data body, as the profile page's form sends it"""
+
+	return (b"--" + boundary.encode("ascii") + b"\r\n" +
+		b'Content-Disposition: form-data; name="file"; filename="picture.jpg"\r\n' +
+		b"Content-Type: image/jpeg\r\n\r\n" + data + b"\r\n--" + boundary.encode("ascii") + b"--\r\n")
+
+def resident_memory(pid):
+	"""Returns a process's resident memory in bytes"""
+
+	with open("/proc/%d/status" % pid) as status:
+		for line in status:
+			if line.startswith("VmRSS:"):
+				return int(line.split()[1]) * 1024
+	return 0
+
+
+class PeakMemorySampler(threading.Thread):
+	"""Samples a process's resident memory every interval seconds until stopped, keeping the peak"""
+
+	def __init__(self, pid, interval=0.01):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.pid = pid
+		self.interval = interval
+		self.peak = 0
+		self._stopped = threading.Event()
+
+	def run(self):
+		while not self._stopped.is_set():
+			self.peak = max(self.peak, resident_memory(self.pid))
+			time.sleep(self.interval)
+
+	def stop(self):
+		self._stopped.set()
+		self.join()
+		return self.peak
+
+
+def measure(base_url, cookie, pid, routes, levels, uploads_per_client):
+	"""Sends the uploads for each route at each concurrency level, and returns a list of
+	result rows with the server's peak memory"""
+
+	rows = []
+	for concurrency in levels:
+		for name, path, content_type, body in routes:
+			sampler = PeakMemorySampler(pid)
+			baseline = resident_memory(pid)
+			sampler.start()
+			results = ioloop.IOLoop.current().run_sync(lambda: run_load(base_url + path,
+				concurrency * uploads_per_client, concurrency, headers={"Cookie": cookie, "Content-Type": content_type},
+				method="POST", body=body))
+			result = summarize(*results)
+			result.update({"route": name, "concurrency": concurrency, "before": baseline, "peak": sampler.stop()})
+			rows.append(result)
+	return rows
+
+def report(rows):
+	"""Prints the results as a table"""
+
+	print("%-8s %-12s %12s %12s %10s %9s" % ("clients", "upload", "RSS before", "peak RSS", "p50 ms", "failures"))
+	for row in rows:
+		print("%-8d %-12s %10.1fMB %10.1fMB %10.1f %9d" % (row["concurrency"], row["route"],
+			row["before"] / 1048576.0, row["peak"] / 1048576.0, row["p50"], row["failures"]))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--url", default="http://localhost:5000")
+	parser.add_argument("--username", required=True)
+	parser.add_argument("--password", required=True)
+	parser.add_argument("--pid", type=int, required=True, help="the server process to watch")
+	parser.add_argument("--levels", default="1,5,10,20,40", help="numbers of concurrent uploads")
+	parser.add_argument("--uploads", type=int, default=2, help="uploads per client at each level")
+	parser.add_argument("--width", type=int, default=2500, help="picture width (the height is 3/4 of it)")
+	parser.add_argument("--form", action="store_true", help="also measure the form upload")
+	args = parser.parse_args()
+
+	picture = make_picture(args.width, args.width * 3 // 4)
+	print("picture: %.1fMB" % (len(picture) / 1048576.0))
+	routes = [("streamed", "/profile-pic", "image/jpeg", picture)]
+	if args.form:
+		routes.append(("form", "/submit-profile-pic/0", "multipart/form-data; boundary=benchmarkboundary",
+			multipart_body(picture)))
+	cookie = log_in(args.url, args.username, args.password)
+	report(measure(args.url, cookie, args.pid, routes, [int(level) for level in args.levels.split(",")],
+		args.uploads))
@@ -0,0 +1,107 @@
+"""Database connection pool helpers: a pool that times how long checkouts wait for a free
+connection, and pessimistic checking of pooled connections before they are used"""
+
+from sqlalchemy import event, exc, select
+
+from sqlalchemy.pool import QueuePool
+
+import threading
+
+import time
+
+
+class PoolStats(object):
+	"""Counts of connection checkouts and how long they waited, for one worker's pool"""
+
+	def __init__(self):
+		self.checkouts = 0
+		self.timeouts = 0
+		self.total_wait = 0.0
+		self.max_wait = 0.0
+		self._lock = threading.Lock()
+
+	def record(self, wait, timed_out=False):
+		"""Records one checkout (or a checkout that gave up waiting)"""
+
+		with self._lock:
+			if timed_out:
+				self.timeouts += 1
+			else:
+				self.checkouts += 1
+			self.total_wait += wait
+			self.max_wait = max(self.max_wait, wait)
+
+	def snapshot(self):
+		"""Returns the counters, with waits in milliseconds"""
+
+		with self._lock:
+			attempts = self.checkouts + self.timeouts
+			return {"checkouts": self.checkouts, "timeouts": self.timeouts,
+				"total_wait_ms": self.total_wait * 1000,
+				"mean_wait_ms": self.total_wait * 1000 / attempts if attempts else 0.0,
+				"max_wait_ms": self.max_wait * 1000}
+
+
+class TimedQueuePool(QueuePool):
+	"""QueuePool that records in self.stats how long each checkout waited for a connection"""
+
+	def __init__(self, creator, **kw):
+		QueuePool.__init__(self, creator, **kw)
+		self.stats = PoolStats()
+
+	def _do_get(self):
+		started = time.time()
+		try:
+			connection = QueuePool._do_get(self)
+		except exc.TimeoutError:
+			self.stats.record(time.time() - started, timed_out=True)
+			raise
+		self.stats.record(time.time() - started)
+		return connection
+
+	def recreate(self):
+		#the pool is recreated when it is disposed (e.g. after the database restarts),
+		#and the counters should carry on across that
+		pool = QueuePool.recreate(self)
+		pool.stats = self.stats
+		return pool
+
+
+def pool_status(pool):
+	"""Returns the current size and checkout counters of a pool"""
+
+	status = {"pool": pool.__class__.__name__}
+	if isinstance(pool, QueuePool):
+		status.update({"size": pool.size(), "checked_in": pool.checkedin(),
+			"checked_out": pool.checkedout(), "overflow": pool.overflow()})
+	if getattr(pool, "stats", None) is not None:
+		status.update(pool.stats.snapshot())
+	return status
+
+
+def ping_connection(connection, branch):
+	"""Runs a "SELECT 1" on a connection as it is taken from the pool, replacing it if the
+	database has dropped it (e.g. after a restart or an idle timeout)"""
+
+	#see http://docs.sqlalchemy.org/en/rel_1_1/core/pooling.html#disconnect-handling-pessimistic
+	if branch:
+		return
+	should_close_with_result = connection.should_close_with_result
+	connection.should_close_with_result = False
+	try:
+		connection.scalar(select([1]))
+	except exc.DBAPIError as error:
+		#the pool has thrown away the dead connection, so this uses a fresh one
+		if error.connection_invalidated:
+			connection.scalar(select([1]))
+		else:
+			raise
+	finally:
+		connection.should_close_with_result = should_close_with_result
+
+
+def install_pre_ping(engine):
+	"""Has an engine check its pooled connections before they are used"""
+
+	if not event.contains(engine, "engine_connect", ping_connection):
+		event.listen(engine, "engine_connect", ping_connection)
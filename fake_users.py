@@ -1,49 +1,216 @@
-from model import User, Update, Comment, Pair, Message, Request, connect_to_db, db
-import factory
+"""Seeds the database with fake users, updates, connections, messages and notifications,
+in bulk, to build datasets for development and performance work
+
+	python fake_users.py --users 100000 --updates 1000000 --pairs 500000 --messages 200000 \\
+		--notifications 100000 --seed 1 --workers 4
+
+Every seeded user has the same password (--password), so that load tests can log in as
+anyone. The same seed gives the same dataset, whatever the number of workers"""
+
+from model import User, connect_to_db, db, populate_timelines, populate_conversations
 from faker import Factory as FakerFactory
-from datetime import datetime
-from server import app, pair_lookup
+from datetime import datetime, timedelta
+from passwords import password_hasher
+from server import app
+from collections import OrderedDict
+import argparse
+import io
+import multiprocessing
 import random
+import re
+import time
 
 #see docs for Faker at https://faker.readthedocs.io/en/latest/
-#see docs for factory_boy at https://factoryboy.readthedocs.io/en/latest/
 
 faker = FakerFactory.create()
 
+#seeded rows are dated in the year up to this time, so that a seed always gives the same rows
+SEED_END_TIME = datetime(2016, 11, 11)
+NOTIFICATION_TYPES = ["msg", "req", "apr"]
 
-def add_users():
-	"""Adds fake users to db, in theory should add 500 but usually fails before it can reach 500 
-	because the system will try to use the same fake username"""
+COLUMNS = OrderedDict([
+	("users", ["user_id", "username", "password", "joined_at", "is_public"]),
+	("updates", ["user_id", "update_body", "posted_at", "is_public"]),
+	("pairs", ["user_1_id", "user_2_id"]),
+	("messages", ["owner_id", "recipient_id", "sent_at", "message_body", "read", "deleted"]),
+	("notifications", ["user_id", "notification_type", "added_at", "viewed"])])
 
-	for i in range(5000):
-		user = User(username=(faker.first_name() + faker.pystr(min_chars=3, max_chars=7)), 
-			password=faker.password(length=10, special_chars=False, digits=True, upper_case=True, lower_case=True), 
-			joined_at=faker.date_time_this_year(before_now=True, after_now=False, tzinfo=None),
-			is_public=faker.boolean(), rounds=4)
-		db.session.add(user)
-		db.session.commit()
 
-def add_updates():
-	"""Adds fake updates to the system"""
+def username_for(user_id, first_name):
+	"""Makes a username from a first name and a user_id: unique, because the letters end
+	where the (unique) user_id begins"""
 
-	current_users = db.session.query(User.user_id).all()
-	for i in range(5000):
-		update = Update(user_id=random.choice(current_users), update_body=faker.text(max_nb_chars=140), 
-			posted_at=datetime.now())
-		db.session.add(update)
-		db.session.commit()
+	letters = re.sub("[^a-z]", "", first_name.lower())[:10] or "user"
+	return letters + str(user_id)
+
+def split_total(total, parts):
+	"""Splits a total into a number of near-equal whole parts"""
+
+	return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+def random_time(rng):
+	"""Returns a random time in the year before SEED_END_TIME"""
+
+	return SEED_END_TIME - timedelta(seconds=rng.randint(0, 365 * 24 * 60 * 60))
+
+def fake_text(rng, vocabulary, max_chars=140):
+	"""Makes up a sentence of random words (much quicker than asking Faker for one per row)"""
+
+	text = rng.choice(vocabulary).capitalize()
+	for i in range(rng.randint(3, 25)):
+		word = rng.choice(vocabulary)
+		if len(text) + len(word) + 2 > max_chars:
+			break
+		text += " " + word
+	return text + "."
+
+def csv_value(value):
+	"""Formats a value for PostgreSQL's CSV COPY format"""
+
+	if value is None:
+		return u""
+	if value is True or value is False:
+		return u"t" if value else u"f"
+	if isinstance(value, datetime):
+		return value.isoformat()
+	if isinstance(value, int):
+		return u"%d" % value
+	return u'"' + value.replace(u'"', u'""') + u'"'
+
+def to_csv(rows):
+	"""Turns rows into the bytes of a CSV file"""
+
+	return u"".join(u",".join(csv_value(value) for value in row) + u"\n" for row in rows).encode("utf-8")
+
+
+def generate_chunk(job):
+	"""Generates the rows for one range of users (run in a worker process). The "users" part
+	makes the users themselves, and the "activity" part everything else (made once all the
+	users are in, as connections can be with users from any range)"""
 
-def add_connections():
-	"""Adds fake user connections to the system"""
+	part, seed, chunk, first_user_id, user_count, last_user_id, counts, password_hash, as_csv = job
+	rng = random.Random(seed * 1000003 + chunk)
+	faker.seed(seed * 1000003 + chunk)
 
-	current_users = db.session.query(User.user_id).all()
-	for i in range(2000):
-		user1 = random.choice(current_users)
-		user2 = random.choice(current_users)
-		if user1 != user2 and not pair_lookup(user1, user2):
-			pair = Pair(user_1_id=user1, user_2_id=user2)
-			db.session.add(pair)
+	users = []
+	for user_id in range(first_user_id, first_user_id + user_count):
+		users.append((user_id, username_for(user_id, faker.first_name()), password_hash, random_time(rng),
+			rng.random() < 0.5))
+	if part == "users":
+		rows = {"users": users}
+	else:
+		is_public = dict((user[0], user[4]) for user in users)
+		last_in_chunk = first_user_id + user_count - 1
+		vocabulary = faker.words(nb=1000)
+
+		updates = []
+		for i in range(counts["updates"]):
+			author_id = rng.randint(first_user_id, last_in_chunk)
+			updates.append((author_id, fake_text(rng, vocabulary), random_time(rng), is_public[author_id]))
+
+		#pairs are stored lower user_id first, and the lower user is always from this chunk,
+		#so no two chunks can make the same pair
+		pairs = set()
+		for i in range(counts["pairs"]):
+			user_1_id = rng.randint(first_user_id, last_in_chunk)
+			if user_1_id < last_user_id:
+				pairs.add((user_1_id, rng.randint(user_1_id + 1, last_user_id)))
+		pairs = sorted(pairs)
+
+		messages = []
+		if pairs:
+			for i in range(counts["messages"]):
+				pair = rng.choice(pairs)
+				if rng.random() < 0.5:
+					pair = (pair[1], pair[0])
+				messages.append((pair[0], pair[1], random_time(rng), fake_text(rng, vocabulary),
+					rng.random() < 0.8, False))
+
+		notifications = []
+		for i in range(counts["notifications"]):
+			notifications.append((rng.randint(first_user_id, last_in_chunk), rng.choice(NOTIFICATION_TYPES),
+				random_time(rng), rng.random() < 0.8))
+
+		rows = {"updates": updates, "pairs": pairs, "messages": messages, "notifications": notifications}
+
+	if as_csv:
+		return dict((table, to_csv(table_rows)) for table, table_rows in rows.items())
+	return rows
+
+
+def load_rows(table, data, as_csv):
+	"""Adds generated rows to a table: with COPY on PostgreSQL, and a multi-row insert otherwise"""
+
+	columns = COLUMNS[table]
+	if as_csv:
+		cursor = db.session.connection().connection.cursor()
+		cursor.copy_expert("COPY %s (%s) FROM STDIN WITH CSV" % (table, ", ".join(columns)), io.BytesIO(data))
+	elif data:
+		db.session.execute(db.metadata.tables[table].insert(), [dict(zip(columns, row)) for row in data])
+
+def seed(users, updates, pairs, messages, notifications, seed=0, workers=1, chunk_size=10000,
+	password="password123"):
+	"""Adds the given numbers of fake rows, generated by a pool of workers a range of users
+	at a time, then fills in the timelines and conversations tables from them"""
+
+	as_csv = db.session.connection().dialect.name == "postgresql"
+	first_user_id = (db.session.query(db.func.max(User.user_id)).scalar() or 0) + 1
+	last_user_id = first_user_id + users - 1
+	password_hash = password_hasher.hash(password, rounds=4)
+
+	chunks = max((users + chunk_size - 1) // chunk_size, 1)
+	user_counts = split_total(users, chunks)
+	counts = [dict(zip(["updates", "pairs", "messages", "notifications"], chunk_counts)) for chunk_counts in
+		zip(*[split_total(total, chunks) for total in [updates, pairs, messages, notifications]])]
+
+	jobs = []
+	for part in ["users", "activity"]:
+		chunk_first_user_id = first_user_id
+		for chunk in range(chunks):
+			jobs.append((part, seed, chunk, chunk_first_user_id, user_counts[chunk], last_user_id, counts[chunk],
+				password_hash, as_csv))
+			chunk_first_user_id += user_counts[chunk]
+
+	pool = multiprocessing.Pool(workers) if workers > 1 else None
+	started = time.time()
+	try:
+		results = pool.imap(generate_chunk, jobs) if pool else (generate_chunk(job) for job in jobs)
+		for job, tables in zip(jobs, results):
+			for table in COLUMNS:
+				if table in tables:
+					load_rows(table, tables[table], as_csv)
 			db.session.commit()
+			print("%s %d/%d loaded (%.1fs)" % (job[0], job[2] + 1, chunks, time.time() - started))
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+
+	if as_csv:
+		#user_ids were given explicitly, so the sequence has to be moved past them
+		db.session.execute("SELECT setval(pg_get_serial_sequence('users', 'user_id'), "
+			"(SELECT max(user_id) FROM users))")
+		db.session.commit()
+	populate_timelines()
+	populate_conversations()
+	print("timelines and conversations filled in (%.1fs)" % (time.time() - started))
 
 
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--database-url", default="postgresql:///twitterclone")
+	parser.add_argument("--users", type=int, default=5000)
+	parser.add_argument("--updates", type=int, default=5000)
+	parser.add_argument("--pairs", type=int, default=2000)
+	parser.add_argument("--messages", type=int, default=2000)
+	parser.add_argument("--notifications", type=int, default=1000)
+	parser.add_argument("--seed", type=int, default=0, help="the same seed gives the same data")
+	parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+	parser.add_argument("--chunk-size", type=int, default=10000, help="users generated per batch")
+	parser.add_argument("--password", default="password123", help="the password of every seeded user")
+	args = parser.parse_args()
 
+	connect_to_db(app, args.database_url)
+	db.create_all()
+	seed(args.users, args.updates, args.pairs, args.messages, args.notifications, args.seed, args.workers,
+		args.chunk_size, args.password)
@@ -0,0 +1,96 @@
+"""Profile pictures: checks that an upload really is a picture, turns it into a fixed-size
+thumbnail and stores that under a name made from a hash of its contents, so that a stored
+file never changes and can be cached by browsers for good"""
+
+from PIL import Image, ImageOps
+
+from io import BytesIO
+
+import hashlib
+
+import os
+
+import tempfile
+
+import threading
+
+AVATAR_FOLDER = os.environ.get("AVATAR_FOLDER",
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "avatars"))
+AVATAR_URL = "/avatars/"
+AVATAR_SIZE = 256
+AVATAR_QUALITY = 85
+ALLOWED_FORMATS = set(["JPEG", "PNG"])
+#larger pictures are turned away before they are decoded, as decoding is what takes the memory
+MAX_PIXELS = 40 * 1000 * 1000
+#pictures decoded at once (by this process), so that many uploads at a time can't add up to
+#many decoded pictures in memory
+IMAGE_DECODES = int(os.environ.get("IMAGE_DECODES", 2))
+
+decoding = threading.BoundedSemaphore(IMAGE_DECODES)
+
+
+class InvalidImage(ValueError):
+	"""Raised for an upload that isn't a picture in one of the allowed formats"""
+
+
+def open_image(stream, draft_size=None):
+	"""Reads a picture from a file-like object, checking its format and size before decoding it
+	(a JPEG is decoded straight at the smallest scale still covering draft_size, if given)"""
+
+	try:
+		image = Image.open(stream)
+		if image.format not in ALLOWED_FORMATS:
+			raise InvalidImage("%s pictures aren't allowed" % image.format)
+		if image.size[0] * image.size[1] > MAX_PIXELS:
+			raise InvalidImage("The picture is too large")
+		if draft_size and image.format == "JPEG":
+			image.draft(image.mode, draft_size)
+		image.load()
+	except InvalidImage:
+		raise
+	except Exception:
+		#Pillow raises a variety of errors for truncated or corrupt files
+		raise InvalidImage("The file isn't a picture that can be read")
+	return image
+
+def make_thumbnail(image, size=AVATAR_SIZE):
+	"""Crops a picture to a centred square and scales it to size x size, on a white background
+	where it was transparent"""
+
+	if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+		image = image.convert("RGBA")
+		background = Image.new("RGB", image.size, (255, 255, 255))
+		background.paste(image, mask=image.split()[3])
+		image = background
+	else:
+		image = image.convert("RGB")
+	return ImageOps.fit(image, (size, size), Image.LANCZOS)
+
+def thumbnail_bytes(image):
+	"""Encodes a thumbnail as a JPEG"""
+
+	output = BytesIO()
+	image.save(output, "JPEG", quality=AVATAR_QUALITY, optimize=True)
+	return output.getvalue()
+
+def store_avatar(stream, folder=None):
+	"""Makes a thumbnail of an uploaded picture and stores it in folder (AVATAR_FOLDER by
+	default), named after the hash of its contents (a picture that is already stored isn't
+	written again), and returns the file's name. Raises InvalidImage for uploads that aren't
+	pictures"""
+
+	folder = folder or AVATAR_FOLDER
+	with decoding:
+		data = thumbnail_bytes(make_thumbnail(open_image(stream, (AVATAR_SIZE, AVATAR_SIZE))))
+	filename = hashlib.sha1(data).hexdigest() + ".jpg"
+	path = os.path.join(folder, filename)
+	if not os.path.isfile(path):
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		#written under a temporary name and renamed, so that a half-written file is never served
+		handle, temporary_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+		with os.fdopen(handle, "wb") as temporary_file:
+			temporary_file.write(data)
+		os.chmod(temporary_path, 0o644)
+		os.rename(temporary_path, path)
+	return filename
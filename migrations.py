@@ -0,0 +1,184 @@
+"""Versioned schema migrations, to bring databases created by an older version
+of model.py up to date (run "python migrations.py")"""
+
+from model import (User, Update, Comment, Pair, Message, Request, Notification, TimelineEntry, Conversation,
+	UPDATE_SEARCH_INDEX, USERNAME_PREFIX_INDEX, populate_timelines, populate_update_visibility,
+	populate_conversations, db)
+
+from sqlalchemy import inspect
+
+from datetime import datetime
+
+from images import AVATAR_URL, InvalidImage, store_avatar
+
+import os
+
+import re
+
+LEGACY_PICTURE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "images")
+
+#every migration checks what is already there before changing anything, so a
+#database made by db.create_all() can be brought up to date safely too
+MIGRATIONS = []
+
+schema_migrations = db.Table("schema_migrations",
+	db.Column("version", db.Integer, primary_key=True, autoincrement=False),
+	db.Column("description", db.String(140), nullable=False),
+	db.Column("applied_at", db.DateTime, nullable=False))
+
+
+def migration(version, description):
+	"""Registers the decorated function as the upgrade to a schema version"""
+
+	def register(upgrade_function):
+		MIGRATIONS.append((version, description, upgrade_function))
+		return upgrade_function
+	return register
+
+def create_missing_table(model):
+	"""Creates the table for a model if the database doesn't have it yet"""
+
+	model.__table__.create(db.session.connection(), checkfirst=True)
+
+def create_missing_indexes(model):
+	"""Creates any of a model's declared indexes that the database doesn't have yet"""
+
+	connection = db.session.connection()
+	existing = set(index["name"] for index in inspect(connection).get_indexes(model.__tablename__))
+	for index in model.__table__.indexes:
+		if index.name not in existing:
+			index.create(connection)
+
+def has_column(table_name, column_name):
+	"""Checks whether a table in the database has a given column"""
+
+	columns = inspect(db.session.connection()).get_columns(table_name)
+	return column_name in [column["name"] for column in columns]
+
+
+@migration(1, "timelines table for the connections feed")
+def add_timelines():
+	create_missing_table(TimelineEntry)
+	populate_timelines()
+
+@migration(2, "author visibility copied onto updates")
+def add_update_visibility():
+	if not has_column("updates", "is_public"):
+		db.session.execute("ALTER TABLE updates ADD COLUMN is_public BOOLEAN NOT NULL DEFAULT FALSE")
+		populate_update_visibility()
+	create_missing_indexes(Update)
+
+@migration(3, "indexes for the filters used by the server")
+def add_filter_indexes():
+	#pairs get theirs in migration 4, as the unique one can only be built once duplicates are gone
+	for model in [Update, Comment, Message, Request, Notification, TimelineEntry]:
+		create_missing_indexes(model)
+
+
+@migration(4, "pairs stored canonically behind a unique index")
+def canonicalize_pairs():
+	#drop pairs of a user with themselves, and every copy of a pair but the first
+	db.session.execute("""DELETE FROM pairs WHERE user_1_id = user_2_id OR EXISTS (
+		SELECT 1 FROM pairs AS other WHERE other.pair_id < pairs.pair_id AND (
+			(other.user_1_id = pairs.user_1_id AND other.user_2_id = pairs.user_2_id) OR
+			(other.user_1_id = pairs.user_2_id AND other.user_2_id = pairs.user_1_id)))""")
+	db.session.execute("""UPDATE pairs SET user_1_id = user_2_id, user_2_id = user_1_id
+		WHERE user_1_id > user_2_id""")
+	existing = [index["name"] for index in inspect(db.session.connection()).get_indexes("pairs")]
+	if "ix_pairs_user_1_id_user_2_id" in existing:
+		db.session.execute("DROP INDEX ix_pairs_user_1_id_user_2_id")
+	create_missing_indexes(Pair)
+	if db.session.get_bind().dialect.name == "postgresql":
+		if not db.session.execute("SELECT 1 FROM pg_constraint WHERE conname = 'ck_pairs_canonical'").first():
+			db.session.execute("ALTER TABLE pairs ADD CONSTRAINT ck_pairs_canonical CHECK (user_1_id < user_2_id)")
+	#duplicate pairs will have pushed duplicate updates onto timelines
+	populate_timelines()
+
+@migration(5, "conversations table for the inbox")
+def add_conversations():
+	create_missing_table(Conversation)
+	populate_conversations()
+
+@migration(6, "message counts kept on conversations")
+def add_conversation_message_counts():
+	if not has_column("conversations", "message_count"):
+		db.session.execute("ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+		populate_conversations()
+	create_missing_indexes(Conversation)
+
+@migration(7, "case-insensitive unique index on usernames")
+def add_lower_username_index():
+	#written out, as expression indexes aren't reflected and so can't be checked for by name
+	db.session.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_users_lower_username ON users (lower(username))")
+
+@migration(8, "search indexes on update bodies and usernames")
+def add_search_indexes():
+	connection = db.session.connection()
+	UPDATE_SEARCH_INDEX(Update.__table__, connection)
+	USERNAME_PREFIX_INDEX(User.__table__, connection)
+
+@migration(9, "timeline index for feed validators")
+def add_timeline_validator_index():
+	create_missing_indexes(TimelineEntry)
+
+@migration(10, "profile picture urls stored on users")
+def add_user_picture_urls():
+	if not has_column("users", "picture_url"):
+		db.session.execute("ALTER TABLE users ADD COLUMN picture_url VARCHAR(100)")
+	#pictures uploaded before, as static/images/user<id>.png, are turned into stored thumbnails
+	for filename in sorted(os.listdir(LEGACY_PICTURE_FOLDER)):
+		match = re.match(r"^user(\d+)\.png$", filename)
+		if not match:
+			continue
+		try:
+			with open(os.path.join(LEGACY_PICTURE_FOLDER, filename), "rb") as picture:
+				picture_url = AVATAR_URL + store_avatar(picture)
+		except InvalidImage:
+			continue
+		User.query.filter(User.user_id == int(match.group(1)), User.picture_url == None).update(
+			{"picture_url": picture_url}, synchronize_session=False)
+
+@migration(11, "feed and profile indexes in the order their pages are read")
+def reorder_feed_indexes():
+	#made all ascending before, which a page ordered newest first (ties by ascending id) can't
+	#be read from in either direction
+	for model, name in [(TimelineEntry, "ix_timelines_owner_id_posted_at"), (Update, "ix_updates_user_id_posted_at")]:
+		db.session.execute("DROP INDEX IF EXISTS %s" % name)
+		create_missing_indexes(model)
+
+@migration(12, "message index in the order thread pages are read")
+def reorder_message_index():
+	db.session.execute("DROP INDEX IF EXISTS ix_messages_owner_id_recipient_id_deleted_sent_at")
+	create_missing_indexes(Message)
+
+
+def applied_versions():
+	"""Returns the set of migration versions already applied to the database"""
+
+	schema_migrations.create(db.session.connection(), checkfirst=True)
+	return set(row[0] for row in db.session.execute(db.select([schema_migrations.c.version])))
+
+def upgrade():
+	"""Applies every migration the database hasn't had yet, in version order,
+	recording each one as soon as it completes, and returns the versions applied"""
+
+	done = applied_versions()
+	applied = []
+	for version, description, upgrade_function in sorted(MIGRATIONS, key=lambda m: m[0]):
+		if version in done:
+			continue
+		upgrade_function()
+		db.session.execute(schema_migrations.insert().values(version=version,
+			description=description, applied_at=datetime.now()))
+		db.session.commit()
+		applied.append(version)
+	db.session.commit()
+	return applied
+
+
+if __name__ == '__main__':
+	from server import app
+	from model import connect_to_db
+	connect_to_db(app)
+	for version in upgrade():
+		print("Applied migration %d" % version)
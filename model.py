@@ -2,11 +2,24 @@
 
 from flask_sqlalchemy import SQLAlchemy 
 
+from sqlalchemy import DDL, event
+
 from datetime import datetime
 
-from passlib.hash import bcrypt
+from passwords import password_hasher
+
+class ConfigurableSQLAlchemy(SQLAlchemy):
+	"""Flask-SQLAlchemy, also passing the app's SQLALCHEMY_ENGINE_OPTIONS (pool class and
+	sizes) through to create_engine"""
+
+	def apply_driver_hacks(self, app, info, options):
+		SQLAlchemy.apply_driver_hacks(self, app, info, options)
+		options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+
+db = ConfigurableSQLAlchemy()
 
-db = SQLAlchemy()
+#how much of the last message in a conversation is shown in the inbox
+SNIPPET_LENGTH = 50
 
 # code help on passwords by X-Istence from http://stackoverflow.com/a/33717279
 
@@ -20,24 +33,23 @@ class User(db.Model):
 	password = db.Column(db.String(80), nullable=False)
 	joined_at = db.Column(db.DateTime, nullable=False)
 	is_public = db.Column(db.Boolean, nullable=False)
+	#the stored thumbnail of the user's profile picture, if they have uploaded one
+	picture_url = db.Column(db.String(100), nullable=True)
 
 	def __init__(self, username, password, joined_at, is_public, rounds=None):
 		"""Passes in appropriate parameters to user instance, and creates 
 		encrypted hash of password for database"""
 
 		self.username = username
-		#to make seeding db faster with fake data:
-		if rounds:
-			self.password = bcrypt.encrypt(password, rounds=rounds)
-		else:
-			self.password = bcrypt.encrypt(password)
+		#rounds can be lowered to make seeding db faster with fake data
+		self.password = password_hasher.hash(password, rounds)
 		self.joined_at = joined_at
 		self.is_public = is_public
 
 	def validate_password(self, password):
 		"""Verifies password hash, returns True or False"""
 
-		return bcrypt.verify(password, self.password)
+		return password_hasher.verify(password, self.password)
 
 	def __repr__(self):
 		"""Provides useful representation of an instance when printed"""
@@ -54,16 +66,35 @@ class Update(db.Model):
 	user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
 	update_body = db.Column(db.String(140), nullable=False)
 	posted_at = db.Column(db.DateTime, nullable=False)
+	#copy of the author's users.is_public, so the public feed doesn't need to look at users
+	is_public = db.Column(db.Boolean, nullable=False)
 	#potential other columns relating to type of update?
 	
 	user = db.relationship("User", backref="updates")
 
+	#in the order a profile's pages are read, newest first with ties by ascending id
+	__table_args__ = (db.Index("ix_updates_user_id_posted_at", user_id, posted_at.desc(), update_id),)
+
 	def __repr__(self):
 		"""Provides useful representation of an instance when printed"""
 
 		return ("<Update update_id=%d user_id=%d update_body=%s>"
 				% (self.update_id, self.user_id, self.update_body))
 
+#usernames are unique whatever their case, and looked up lowercased
+db.Index("ux_users_lower_username", db.func.lower(User.username), unique=True)
+
+#the public feed is a single range scan of this index, in the order it is paged in
+db.Index("ix_updates_is_public_posted_at", Update.is_public, Update.posted_at.desc(), Update.update_id)
+
+#the indexes behind search (see search.py), which only PostgreSQL has
+UPDATE_SEARCH_INDEX = DDL("CREATE INDEX IF NOT EXISTS ix_updates_body_search ON updates "
+	"USING gin (to_tsvector('english', update_body))").execute_if(dialect="postgresql")
+USERNAME_PREFIX_INDEX = DDL("CREATE INDEX IF NOT EXISTS ix_users_lower_username_prefix ON users "
+	"(lower(username) text_pattern_ops)").execute_if(dialect="postgresql")
+event.listen(Update.__table__, "after_create", UPDATE_SEARCH_INDEX)
+event.listen(User.__table__, "after_create", USERNAME_PREFIX_INDEX)
+
 
 class Comment(db.Model):
 	"""Information associated with a specific comment on a specific update"""
@@ -79,6 +110,8 @@ class Comment(db.Model):
 	user = db.relationship("User", backref="comments")
 	update = db.relationship("Update", backref="comments")
 
+	__table_args__ = (db.Index("ix_comments_update_id", "update_id"),)
+
 	def __repr__(self):
 		"""Provides useful representation of an instance when printed"""
 
@@ -101,12 +134,28 @@ class Pair(db.Model):
 	user1 = db.relationship("User", backref="pair1", foreign_keys=[user_1_id])
 	user2 = db.relationship("User", backref="pair2", foreign_keys=[user_2_id])
 
+	#pairs are only ever stored one way round (lower user_id first), so finding the
+	#pair for two users is a single probe of the unique index
+	__table_args__ = (db.Index("ux_pairs_user_1_id_user_2_id", "user_1_id", "user_2_id", unique=True),
+					db.Index("ix_pairs_user_2_id", "user_2_id"),
+					db.CheckConstraint("user_1_id < user_2_id", name="ck_pairs_canonical"))
+
+	def __init__(self, user_1_id, user_2_id):
+		"""Stores the two users of a pair in canonical order"""
+
+		self.user_1_id, self.user_2_id = canonical_pair(user_1_id, user_2_id)
+
 	def __repr__(self):
 		"""Provides useful representation of an instance when printed"""
 
 		return ("<Pair_id=%d user_1_id=%d user_2_id=%d>"
 				% (self.pair_id, self.user_1_id, self.user_2_id))
 
+def canonical_pair(user_1_id, user_2_id):
+	"""Returns two user_ids in the order they are stored in a pair, lower first"""
+
+	return tuple(sorted([int(user_1_id), int(user_2_id)]))
+
 class Message(db.Model):
 	"""Messages between a pair of users"""
 
@@ -123,6 +172,13 @@ class Message(db.Model):
 	owner = db.relationship("User", backref="user_owner", foreign_keys=[owner_id])
 	recipient = db.relationship("User", backref="user_recipient", foreign_keys=[recipient_id])
 
+	#the first index holds each direction of a conversation in the order its pages are read
+	#(newest first, ties by ascending msg_id), and the second serves the recipient side of
+	#inbox lookups
+	__table_args__ = (db.Index("ix_messages_owner_id_recipient_id_deleted_sent_at", owner_id, recipient_id, deleted,
+						sent_at.desc(), msg_id),
+					db.Index("ix_messages_recipient_id_owner_id", "recipient_id", "owner_id"))
+
 	def __repr__(self):
 		"""Provides useful representation of an instance when printed"""
 
@@ -141,6 +197,9 @@ class Request(db.Model):
 	requester = db.relationship("User", backref="user_requester", foreign_keys=[requester_id])
 	requestee = db.relationship("User", backref="user_requestee", foreign_keys=[requestee_id])
 
+	__table_args__ = (db.Index("ix_requests_requester_id_requestee_id", "requester_id", "requestee_id"),
+					db.Index("ix_requests_requestee_id", "requestee_id"))
+
 	def __repr__(self):
 		"""Provides useful representation of an instance when printed"""
 
@@ -160,12 +219,118 @@ class Notification(db.Model):
 
 	user = db.relationship("User", backref="notifications")
 
+	__table_args__ = (db.Index("ix_notifications_user_id_viewed", "user_id", "viewed"),)
+
 	def __repr__(self):
 		"""Provides useful representation of an instance when printed"""
 
 		return ("<notification_id=%d user_id=%d notification_type=%s>" 
 			% (self.notification_id, self.user_id, self.notification_type))
 
+class TimelineEntry(db.Model):
+	"""One update in one user's connections feed--rows are pushed (fanned out)
+	when an update is posted so the feed can be read as a single pre-sorted list"""
+
+	__tablename__ = "timelines"
+
+	timeline_id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+	owner_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+	update_id = db.Column(db.Integer, db.ForeignKey("updates.update_id"), nullable=False)
+	#copied from the update so that the feed can be sorted off of the index alone
+	posted_at = db.Column(db.DateTime, nullable=False)
+
+	owner = db.relationship("User", backref="timeline")
+	update = db.relationship("Update")
+
+	#in the order the feed's pages are read, newest first with ties by ascending id
+	__table_args__ = (db.Index("ix_timelines_owner_id_posted_at", owner_id, posted_at.desc(), update_id),
+					db.Index("ix_timelines_owner_id_timeline_id", "owner_id", "timeline_id"))
+
+	def __repr__(self):
+		"""Provides useful representation of an instance when printed"""
+
+		return ("<timeline_id=%d owner_id=%d update_id=%d>"
+				% (self.timeline_id, self.owner_id, self.update_id))
+
+class Conversation(db.Model):
+	"""Summary of the messages between two users (one row per pair of users, stored
+	lower user_id first like pairs), kept up to date as messages are sent so that an
+	inbox can be read with a single query"""
+
+	__tablename__ = "conversations"
+
+	conversation_id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+	user_1_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+	user_2_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+	pair_id = db.Column(db.Integer, db.ForeignKey("pairs.pair_id"), nullable=True)
+	last_message_at = db.Column(db.DateTime, nullable=False)
+	last_snippet = db.Column(db.String(SNIPPET_LENGTH), nullable=False)
+	last_sender_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+	user_1_unread = db.Column(db.Integer, default=0, nullable=False)
+	user_2_unread = db.Column(db.Integer, default=0, nullable=False)
+	message_count = db.Column(db.Integer, default=0, nullable=False)
+
+	pair = db.relationship("Pair")
+
+	__table_args__ = (db.Index("ux_conversations_user_1_id_user_2_id", "user_1_id", "user_2_id", unique=True),
+					db.Index("ix_conversations_pair_id", "pair_id"),
+					db.Index("ix_conversations_user_1_id_last_message_at", "user_1_id", "last_message_at"),
+					db.Index("ix_conversations_user_2_id_last_message_at", "user_2_id", "last_message_at"))
+
+	def __repr__(self):
+		"""Provides useful representation of an instance when printed"""
+
+		return ("<conversation_id=%d user_1_id=%d user_2_id=%d>"
+				% (self.conversation_id, self.user_1_id, self.user_2_id))
+
+def populate_update_visibility():
+	"""Copies each user's is_public setting onto all of their updates, for data
+	that was added before updates carried their own visibility"""
+
+	author_is_public = db.select([User.is_public]).where(User.user_id == Update.user_id).as_scalar()
+	db.session.query(Update).update({"is_public": author_is_public}, synchronize_session=False)
+	db.session.commit()
+
+def populate_timelines():
+	"""Rebuilds every user's timeline from the pairs and updates tables, for data
+	that was added without going through the server (seeding, existing databases)"""
+
+	db.session.query(TimelineEntry).delete()
+	for owner_column, author_column in [(Pair.user_1_id, Pair.user_2_id), (Pair.user_2_id, Pair.user_1_id)]:
+		updates = db.select([owner_column, Update.update_id, Update.posted_at]).where(
+			Update.user_id == author_column)
+		db.session.execute(TimelineEntry.__table__.insert().from_select(
+			["owner_id", "update_id", "posted_at"], updates))
+	db.session.commit()
+
+def populate_conversations():
+	"""Rebuilds the conversations table from the messages table, for data that was
+	added without going through the server (seeding, existing databases)"""
+
+	db.session.query(Conversation).delete()
+	summaries = {}
+	messages = db.session.query(Message.owner_id, Message.recipient_id, Message.sent_at,
+		Message.message_body, Message.read).filter(Message.deleted == False).order_by(Message.sent_at)
+	for owner_id, recipient_id, sent_at, message_body, read in messages.yield_per(1000):
+		user_1_id, user_2_id = canonical_pair(owner_id, recipient_id)
+		summary = summaries.setdefault((user_1_id, user_2_id), {"user_1_id": user_1_id,
+			"user_2_id": user_2_id, "user_1_unread": 0, "user_2_unread": 0, "message_count": 0})
+		summary["message_count"] += 1
+		summary["last_message_at"] = sent_at
+		summary["last_snippet"] = message_body[:SNIPPET_LENGTH]
+		summary["last_sender_id"] = owner_id
+		if not read:
+			if recipient_id == user_1_id:
+				summary["user_1_unread"] += 1
+			else:
+				summary["user_2_unread"] += 1
+	if summaries:
+		db.session.execute(Conversation.__table__.insert(), list(summaries.values()))
+	pair_id = db.select([Pair.pair_id]).where((Pair.user_1_id == Conversation.user_1_id) &
+		(Pair.user_2_id == Conversation.user_2_id)).as_scalar()
+	db.session.query(Conversation).update({"pair_id": pair_id}, synchronize_session=False)
+	db.session.commit()
+
 def fake_test_data():
 	"""Creates sample data for unittests to use"""
 
@@ -176,11 +341,11 @@ def fake_test_data():
 	user5 = User(username="saren", password="evildude", joined_at=datetime(2016, 11, 11, 0, 0, 31, 645845), is_public=False)
 	user6 = User(username="jenkins", password="npclyfe", joined_at=datetime(2016, 11, 11, 0, 0, 31, 645845), is_public=True)
 
-	update1 = Update(user_id=2, update_body="just in the middle of some calibrations", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091))
-	update2 = Update(user_id=1, update_body="anyone want to open this bottle of serrice ice I got for Chakwas with me?", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091))
-	update3 = Update(user_id=4, update_body="please stop calling me the shadow broker, I'm totally not her--I mean, them...", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091))
-	update4 = Update(user_id=5, update_body="I'm so going to betray Nihlus ;)", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091))
-	update5 = Update(user_id=6, update_body="Yay first day at work I'm totally not going to die!", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091))
+	update1 = Update(user_id=2, update_body="just in the middle of some calibrations", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091), is_public=False)
+	update2 = Update(user_id=1, update_body="anyone want to open this bottle of serrice ice I got for Chakwas with me?", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091), is_public=True)
+	update3 = Update(user_id=4, update_body="please stop calling me the shadow broker, I'm totally not her--I mean, them...", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091), is_public=False)
+	update4 = Update(user_id=5, update_body="I'm so going to betray Nihlus ;)", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091), is_public=False)
+	update5 = Update(user_id=6, update_body="Yay first day at work I'm totally not going to die!", posted_at=datetime(2016, 11, 11, 0, 2, 16, 227091), is_public=True)
 
 	comment1 = Comment(update_id=2, user_id=3, comment_body="Shepard.", posted_at=datetime(2016, 11, 11, 0, 2, 45, 185511))
 	comment2 = Comment(update_id=2, user_id=1, comment_body="Wrex.", posted_at=datetime(2016, 11, 11, 0, 2, 45, 185511))
@@ -207,6 +372,9 @@ def fake_test_data():
 		notification1, notification2, notification3])
 	db.session.commit()
 
+	populate_timelines()
+	populate_conversations()
+
 
 def connect_to_db(app, uri="postgresql:///twitterclone"):
 	"""Connects the PostgreSQL database to the Flask app"""
@@ -217,8 +385,10 @@ def connect_to_db(app, uri="postgresql:///twitterclone"):
 
 if __name__ == '__main__':
 	from server import app 
+	from migrations import upgrade
 	connect_to_db(app)
 	db.create_all()
+	upgrade()
 
 
 
@@ -0,0 +1,249 @@
+"""Publish/subscribe for notifications, so that connected browsers are told about new
+messages, requests and approvals as they happen. Subscriptions are held by each worker,
+and notifications are passed between workers through Redis when it is configured"""
+
+from collections import OrderedDict
+
+from six.moves.queue import Queue, Empty, Full
+
+import json
+
+import threading
+
+import time
+
+
+class Subscription(object):
+	"""One connected client's queue of (notification_id, notification_type) events"""
+
+	def __init__(self, user_id, max_queued=100):
+		self.user_id = user_id
+		self.queue = Queue(maxsize=max_queued)
+		#ids queued for the client, so that catching up doesn't send them twice
+		self.delivered = set()
+
+	def put(self, event):
+		"""Queues an event, dropping it if the client has stopped reading (the client
+		gets every unviewed notification again when it reconnects)"""
+
+		try:
+			self.queue.put_nowait(event)
+			self.delivered.add(event[0])
+		except Full:
+			pass
+
+	def events(self, heartbeat=15):
+		"""Yields events as they arrive, and None whenever heartbeat seconds pass without one
+		(so that the caller can keep the connection alive and notice when it has gone)"""
+
+		while True:
+			try:
+				yield self.queue.get(timeout=heartbeat)
+			except Empty:
+				yield None
+
+
+class NotificationBus(object):
+	"""Broker: keeps the unviewed notifications of up to max_users users in memory (filled
+	from the database by loader(user_id) the first time they are needed, and reloaded after
+	ttl seconds so that notifications added through other workers show up) and hands new
+	ones to the user's open subscriptions, of which there can be max_subscriptions at once.
+	With a relay, new and viewed notifications are sent through it to every worker's bus"""
+
+	def __init__(self, loader, ttl=30, max_users=10000, max_subscriptions=None, relay=None):
+		self.loader = loader
+		self.ttl = ttl
+		self.max_users = max_users
+		self.max_subscriptions = max_subscriptions
+		self.relay = relay
+		#in the order they were loaded, so the first entries are the first to expire
+		self._pending = OrderedDict()
+		self._subscriptions = {}
+		self._lock = threading.Lock()
+
+	def _expired(self, entry):
+		return self.ttl is not None and time.time() - entry[0] >= self.ttl
+
+	def _drain(self):
+		"""Drops expired entries and the oldest ones beyond max_users (called with the lock held)"""
+
+		while self._pending:
+			user_id, entry = next(iter(self._pending.items()))
+			if not self._expired(entry) and len(self._pending) <= self.max_users:
+				break
+			del self._pending[user_id]
+
+	def pending(self, user_id):
+		"""Returns a user's unviewed notifications as [notification_id, notification_type] lists"""
+
+		user_id = int(user_id)
+		self._listen()
+		with self._lock:
+			entry = self._pending.get(user_id)
+			if entry is not None and not self._expired(entry):
+				return [[notification_id, notification_type] for notification_id, notification_type in entry[1].items()]
+
+		#loaded outside of the lock so that a slow query doesn't hold up other threads
+		notifications = OrderedDict((notification_id, notification_type)
+			for notification_id, notification_type in self.loader(user_id))
+		with self._lock:
+			self._pending.pop(user_id, None)
+			self._pending[user_id] = (time.time(), notifications)
+			self._drain()
+		return [[notification_id, notification_type] for notification_id, notification_type in notifications.items()]
+
+	def subscribe(self, user_id, max_queued=100):
+		"""Opens a subscription for a user, starting with their unviewed notifications, or
+		returns None if max_subscriptions are already open"""
+
+		subscription = Subscription(int(user_id), max_queued)
+		with self._lock:
+			if self.max_subscriptions is not None and self._count() >= self.max_subscriptions:
+				return None
+			self._subscriptions.setdefault(subscription.user_id, set()).add(subscription)
+		for notification_id, notification_type in self.pending(user_id):
+			subscription.put((notification_id, notification_type))
+		return subscription
+
+	def unsubscribe(self, subscription):
+		"""Closes a subscription (when its client has disconnected)"""
+
+		with self._lock:
+			subscriptions = self._subscriptions.get(subscription.user_id, set())
+			subscriptions.discard(subscription)
+			if not subscriptions:
+				self._subscriptions.pop(subscription.user_id, None)
+
+	def missed(self, subscription):
+		"""Returns the user's unviewed notifications that haven't been sent to a subscription
+		yet. Without a relay, this is how notifications added through other workers reach it
+		(once this worker's copy of the user's notifications is reloaded)"""
+
+		if self.relay is not None:
+			return []
+		pending = self.pending(subscription.user_id)
+		subscription.delivered &= set(notification_id for notification_id, notification_type in pending)
+		return [(notification_id, notification_type) for notification_id, notification_type in pending
+			if notification_id not in subscription.delivered]
+
+	def publish(self, user_id, notification_id, notification_type):
+		"""Records a new notification for a user and sends it to their subscriptions (in
+		every worker, with a relay)"""
+
+		if not self._send(["new", int(user_id), notification_id, notification_type]):
+			self._add(int(user_id), notification_id, notification_type)
+
+	def viewed(self, user_id, notification_ids=None):
+		"""Forgets notifications that a user has viewed (all of them if no ids are given)"""
+
+		if notification_ids is not None:
+			notification_ids = [int(notification_id) for notification_id in notification_ids]
+		if not self._send(["viewed", int(user_id), notification_ids]):
+			self._forget(int(user_id), notification_ids)
+
+	def _add(self, user_id, notification_id, notification_type):
+		with self._lock:
+			entry = self._pending.get(user_id)
+			if entry is not None:
+				entry[1][notification_id] = notification_type
+			subscriptions = list(self._subscriptions.get(user_id, []))
+		for subscription in subscriptions:
+			subscription.put((notification_id, notification_type))
+
+	def _forget(self, user_id, notification_ids):
+		with self._lock:
+			entry = self._pending.get(user_id)
+			if entry is None:
+				return
+			if notification_ids is None:
+				entry[1].clear()
+			for notification_id in notification_ids or []:
+				entry[1].pop(notification_id, None)
+
+	def _send(self, message):
+		"""Passes a message to every worker through the relay, returning False if there is
+		none (or it can't be reached, in which case only this worker hears of it)"""
+
+		if self.relay is None:
+			return False
+		self._listen()
+		try:
+			self.relay.send(message)
+		except Exception:
+			return False
+		return True
+
+	def _listen(self):
+		if self.relay is not None:
+			self.relay.listen(self.receive)
+
+	def receive(self, message):
+		"""Applies a message sent through the relay (by any worker, this one included)"""
+
+		if message[0] == "new":
+			self._add(message[1], message[2], message[3])
+		elif message[0] == "viewed":
+			self._forget(message[1], message[2])
+
+	def _count(self):
+		return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+	def subscriber_count(self):
+		"""Returns the number of open subscriptions"""
+
+		with self._lock:
+			return self._count()
+
+	def clear(self):
+		"""Forgets all pending notifications (open subscriptions are kept)"""
+
+		with self._lock:
+			self._pending.clear()
+
+
+class RedisRelay(object):
+	"""Passes bus messages between workers over a Redis pub/sub channel, with one thread
+	per worker process listening to it"""
+
+	def __init__(self, client, channel="updateme:notifications", retry=1):
+		self.client = client
+		self.channel = channel
+		self.retry = retry
+		self._listener = None
+		self._lock = threading.Lock()
+
+	def send(self, message):
+		self.client.publish(self.channel, json.dumps(message))
+
+	def listen(self, receive):
+		"""Starts the listening thread, unless this process already has one (a forked
+		worker doesn't inherit its parent's)"""
+
+		with self._lock:
+			if self._listener is not None and self._listener.is_alive():
+				return
+			self._listener = threading.Thread(target=self._listen, args=(receive,))
+			self._listener.daemon = True
+			self._listener.start()
+
+	def _listen(self, receive):
+		while True:
+			try:
+				pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+				pubsub.subscribe(self.channel)
+				for message in pubsub.listen():
+					if message["type"] == "message":
+						receive(json.loads(message["data"]))
+			except Exception:
+				#reconnects after Redis has gone away
+				time.sleep(self.retry)
+
+
+def make_bus(loader, url=None, ttl=30, max_users=10000, max_subscriptions=None):
+	"""Returns a NotificationBus, relaying through Redis for a redis:// url (needs the redis package)"""
+
+	relay = None
+	if url and url.startswith("redis://"):
+		import redis
+		relay = RedisRelay(redis.StrictRedis.from_url(url))
+	return NotificationBus(loader, ttl, max_users, max_subscriptions, relay)
@@ -0,0 +1,92 @@
+"""Load test for the notification stream: logs in, holds many idle /notifications/stream
+connections open at once, and reports how many connected and how many stayed open
+
+	python notification_load_test.py --username shepard --password ... --connections 2000
+
+(raise the open file limit first, e.g. "ulimit -n 10000", as every connection is a socket
+on both ends)"""
+
+from tornado import gen, ioloop
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from bench_common import log_in, percentile
+
+import argparse
+
+import time
+
+
+class StreamClient(object):
+	"""One idle stream connection, recording when it first heard from the server and what it got"""
+
+	def __init__(self):
+		self.started_at = None
+		self.connected_at = None
+		self.events = 0
+		self.heartbeats = 0
+		self.error = None
+
+	def on_chunk(self, chunk):
+		if self.connected_at is None:
+			self.connected_at = time.time()
+		self.events += chunk.count(b"event: notification")
+		self.heartbeats += chunk.count(b": heartbeat")
+
+
+@gen.coroutine
+def hold_stream(client, http_client, url, cookie, hold):
+	"""Opens a stream and keeps it open until it is cut off after hold seconds"""
+
+	client.started_at = time.time()
+	request = HTTPRequest(url, headers={"Cookie": cookie, "Accept": "text/event-stream"},
+		streaming_callback=client.on_chunk, connect_timeout=hold, request_timeout=hold)
+	try:
+		yield http_client.fetch(request)
+	except Exception as error:
+		#a timeout is how a connection that stayed open for the whole test ends
+		if getattr(error, "code", None) != 599 or client.connected_at is None:
+			client.error = error
+
+
+@gen.coroutine
+def run(base_url, cookie, connections, hold):
+	"""Opens all of the connections at once and waits for them to finish"""
+
+	AsyncHTTPClient.configure(None, max_clients=connections)
+	http_client = AsyncHTTPClient()
+	clients = [StreamClient() for i in range(connections)]
+	yield [hold_stream(client, http_client, base_url + "/notifications/stream", cookie, hold) for client in clients]
+	raise gen.Return(clients)
+
+
+def report(clients, hold):
+	"""Prints a summary of the run"""
+
+	connected = [client for client in clients if client.connected_at is not None]
+	failed = [client for client in clients if client.error is not None]
+	connect_times = [client.connected_at - client.started_at for client in connected]
+	print("connections:       %d" % len(clients))
+	print("connected:         %d" % len(connected))
+	print("failed:            %d" % len(failed))
+	if connect_times:
+		print("connect p50 (ms):  %.1f" % (percentile(connect_times, 0.5) * 1000))
+		print("connect p99 (ms):  %.1f" % (percentile(connect_times, 0.99) * 1000))
+	print("events received:   %d" % sum(client.events for client in clients))
+	print("heartbeats:        %d over %ds" % (sum(client.heartbeats for client in clients), hold))
+	for client in failed[:5]:
+		print("error: %r" % client.error)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--url", default="http://localhost:5000")
+	parser.add_argument("--username", required=True)
+	parser.add_argument("--password", required=True)
+	parser.add_argument("--connections", type=int, default=1000)
+	parser.add_argument("--hold", type=int, default=60, help="seconds to keep the connections open")
+	args = parser.parse_args()
+
+	cookie = log_in(args.url, args.username, args.password)
+	clients = ioloop.IOLoop.current().run_sync(lambda: run(args.url, cookie, args.connections, args.hold))
+	report(clients, args.hold)
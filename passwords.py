@@ -0,0 +1,89 @@
+"""Password hashing and checking, run on a pool of worker processes so that bcrypt's CPU
+time doesn't hold up the threads serving requests"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.hash import bcrypt
+
+import multiprocessing
+
+import os
+
+import threading
+
+#the bcrypt cost factor for new hashes: each step up doubles the time a hash takes
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+#worker processes for hashing (0 hashes in the calling thread instead)
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", multiprocessing.cpu_count()))
+
+
+def hash_password(password, rounds):
+	"""Returns a bcrypt hash of a password (run in a worker process)"""
+
+	return bcrypt.encrypt(password, rounds=rounds)
+
+def verify_password(password, hashed):
+	"""Checks a password against a bcrypt hash (run in a worker process)"""
+
+	return bcrypt.verify(password, hashed)
+
+
+class PasswordHasher(object):
+	"""Hashes and verifies passwords on a pool of worker processes. At most max_pending
+	passwords are handed to the pool at once; further callers wait their turn rather than
+	queueing up without limit"""
+
+	def __init__(self, workers=PASSWORD_WORKERS, rounds=BCRYPT_ROUNDS, max_pending=None):
+		self.workers = workers
+		self.rounds = rounds
+		self._pending = threading.BoundedSemaphore(max_pending or max(workers, 1) * 4)
+		self._executor = None
+		self._executor_pid = None
+		self._lock = threading.Lock()
+
+	def executor(self):
+		"""Returns the process pool, starting it on first use (in each process, so that forked
+		server workers don't share their parent's pool)"""
+
+		with self._lock:
+			if self._executor is None or self._executor_pid != os.getpid():
+				self._executor = ProcessPoolExecutor(self.workers)
+				self._executor_pid = os.getpid()
+			return self._executor
+
+	def run(self, function, *args):
+		"""Runs a function on the pool and waits for its result"""
+
+		if not self.workers:
+			return function(*args)
+		with self._pending:
+			return self.executor().submit(function, *args).result()
+
+	def hash(self, password, rounds=None):
+		"""Returns a bcrypt hash of a password, at the configured cost unless rounds is given"""
+
+		return self.run(hash_password, password, rounds or self.rounds)
+
+	def verify(self, password, hashed):
+		"""Checks a password against a bcrypt hash, returns True or False"""
+
+		return self.run(verify_password, password, hashed)
+
+	def needs_rehash(self, hashed):
+		"""Checks whether a hash was made at a different cost than the configured one"""
+
+		try:
+			return bcrypt.from_string(hashed).rounds != self.rounds
+		except ValueError:
+			return True
+
+	def shutdown(self):
+		"""Stops the worker processes"""
+
+		with self._lock:
+			if self._executor is not None and self._executor_pid == os.getpid():
+				self._executor.shutdown()
+			self._executor = None
+
+
+password_hasher = PasswordHasher()
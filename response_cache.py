@@ -0,0 +1,154 @@
+"""Caches for rendered responses: one kept in the worker's memory, and one kept in Redis
+(shared by all the workers) with the same interface"""
+
+from collections import OrderedDict
+
+import threading
+
+import time
+
+
+class MemoryCache(object):
+	"""Least-recently-used map of keys to values, holding at most max_entries, where each
+	entry expires ttl seconds after it was set (ttl=None keeps entries until evicted)"""
+
+	def __init__(self, max_entries=1000, ttl=30):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._entries = OrderedDict()
+		#counters are kept apart from the entries, so that they are never evicted
+		self._counters = {}
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		"""Returns the value for a key, or None if it isn't cached (or has expired)"""
+
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is not None and (entry[1] is None or entry[1] > time.time()):
+				#re-inserted at the end, as the most recently used
+				self._entries[key] = entry
+				self.hits += 1
+				return entry[0]
+			self.misses += 1
+			return None
+
+	def set(self, key, value, ttl=None):
+		"""Caches a value, for ttl seconds if given (otherwise the cache's default)"""
+
+		ttl = ttl or self.ttl
+		expires_at = time.time() + ttl if ttl is not None else None
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (value, expires_at)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+				self.evictions += 1
+
+	def incr(self, key):
+		"""Adds one to a counter (starting from 0) that never expires, and returns it"""
+
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + 1
+			return self._counters[key]
+
+	def counter(self, key):
+		"""Returns a counter's value (0 if it hasn't been started), without counting as a hit or miss"""
+
+		with self._lock:
+			return self._counters.get(key, 0)
+
+	def delete(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._counters.pop(key, None)
+
+	def clear(self):
+		"""Empties the cache and resets its counters"""
+
+		with self._lock:
+			self._entries.clear()
+			self._counters.clear()
+			self.hits = 0
+			self.misses = 0
+			self.evictions = 0
+
+	def stats(self):
+		"""Returns the cache's counters and current size"""
+
+		with self._lock:
+			return {"backend": "memory", "hits": self.hits, "misses": self.misses,
+				"evictions": self.evictions, "entries": len(self._entries)}
+
+
+class RedisCache(object):
+	"""The same interface as MemoryCache, kept in Redis under a key prefix (Redis's own
+	maxmemory policy does the evicting, and is reported from its INFO)"""
+
+	def __init__(self, client, ttl=30, prefix="updateme:"):
+		self.client = client
+		self.ttl = ttl
+		self.prefix = prefix
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		value = self.client.get(self.prefix + key)
+		if value is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return value
+
+	def set(self, key, value, ttl=None):
+		ttl = ttl or self.ttl
+		if ttl is None:
+			self.client.set(self.prefix + key, value)
+		else:
+			self.client.setex(self.prefix + key, int(ttl), value)
+
+	def incr(self, key):
+		self._start_counter(key)
+		return int(self.client.incr(self.prefix + key))
+
+	def counter(self, key):
+		value = self.client.get(self.prefix + key)
+		if value is None:
+			self._start_counter(key)
+			value = self.client.get(self.prefix + key)
+		return int(value)
+
+	def _start_counter(self, key):
+		"""Starts a missing counter from the current time in microseconds rather than 0, so
+		that a counter Redis has evicted never comes back to a value it had before"""
+
+		self.client.set(self.prefix + key, int(time.time() * 1000000), nx=True)
+
+	def delete(self, key):
+		self.client.delete(self.prefix + key)
+
+	def clear(self):
+		"""Deletes every key under the prefix and resets the counters"""
+
+		keys = list(self.client.scan_iter(self.prefix + "*"))
+		if keys:
+			self.client.delete(*keys)
+		self.hits = 0
+		self.misses = 0
+
+	def stats(self):
+		return {"backend": "redis", "hits": self.hits, "misses": self.misses,
+			"evictions": int(self.client.info("stats").get("evicted_keys", 0)),
+			"entries": self.client.dbsize()}
+
+
+def make_cache(url=None, max_entries=1000, ttl=30):
+	"""Returns a RedisCache for a redis:// url (needs the redis package), otherwise a MemoryCache"""
+
+	if url and url.startswith("redis://"):
+		import redis
+		return RedisCache(redis.StrictRedis.from_url(url), ttl)
+	return MemoryCache(max_entries, ttl)
@@ -0,0 +1,169 @@
+"""Search over public updates and usernames: on PostgreSQL through a full-text index on
+update bodies and a prefix index on usernames, and otherwise (e.g. SQLite test runs)
+through an inverted index kept in memory"""
+
+from model import User, Update, db
+
+from sqlalchemy.orm import joinedload
+
+from bisect import bisect_left
+
+import re
+
+import threading
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def words(text):
+	"""Splits text into lowercase words"""
+
+	return WORD.findall(text.lower())
+
+def escape_like(text):
+	"""Escapes the LIKE wildcards in text, so that it only matches itself"""
+
+	return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def username_prefix_query(text):
+	"""Returns the query for users whose username starts with text (in any case), shortest first"""
+
+	return User.query.filter(db.func.lower(User.username).like(escape_like(text.lower()) + "%", escape="\\")).order_by(
+		db.func.length(User.username), db.func.lower(User.username))
+
+
+class PostgresSearch(object):
+	"""Searches with the database's own indexes (created in model.py),
+	which PostgreSQL keeps up to date as rows are written"""
+
+	def search_updates(self, text, offset, limit):
+		"""Returns up to limit public updates matching all the words of text, best match first"""
+
+		vector = db.func.to_tsvector("english", Update.update_body)
+		query = db.func.plainto_tsquery("english", text)
+		return Update.query.options(joinedload(Update.user)).filter(vector.op("@@")(query),
+			Update.is_public == True).order_by(db.func.ts_rank(vector, query).desc(), Update.posted_at.desc(),
+			Update.update_id).offset(offset).limit(limit).all()
+
+	def search_users(self, text, offset, limit):
+		"""Returns up to limit users whose username starts with text"""
+
+		return username_prefix_query(text).offset(offset).limit(limit).all()
+
+	def index_update(self, update):
+		pass
+
+	def index_user(self, user):
+		pass
+
+	def set_author_visibility(self, user_id, is_public):
+		pass
+
+	def clear(self):
+		pass
+
+
+class MemorySearch(object):
+	"""Inverted index of the words in every update (word to {update_id: times used}) and a
+	sorted list of lowercased usernames, loaded on first use and then kept up to date by
+	index_update, index_user and set_author_visibility"""
+
+	def __init__(self):
+		self._postings = None
+		self._updates = {}
+		self._usernames = []
+		self._lock = threading.Lock()
+
+	def _load(self):
+		"""Builds the index from the database (called with the lock held)"""
+
+		self._postings = {}
+		self._updates = {}
+		rows = db.session.query(Update.update_id, Update.user_id, Update.update_body, Update.posted_at,
+			Update.is_public)
+		for update_id, user_id, update_body, posted_at, is_public in rows.yield_per(1000):
+			self._add_update(update_id, user_id, update_body, posted_at, is_public)
+		self._usernames = sorted((username.lower(), user_id)
+			for user_id, username in db.session.query(User.user_id, User.username))
+
+	def _add_update(self, update_id, user_id, update_body, posted_at, is_public):
+		self._updates[update_id] = [user_id, posted_at, is_public]
+		for word in words(update_body):
+			counts = self._postings.setdefault(word, {})
+			counts[update_id] = counts.get(update_id, 0) + 1
+
+	def _loaded(self):
+		if self._postings is None:
+			self._load()
+
+	def search_updates(self, text, offset, limit):
+		"""Returns up to limit public updates containing all the words of text, ranked by how
+		often they use them and then newest first"""
+
+		with self._lock:
+			self._loaded()
+			postings = [self._postings.get(word, {}) for word in set(words(text))]
+			if not postings:
+				return []
+			postings.sort(key=len)
+			matches = [update_id for update_id in postings[0]
+				if self._updates[update_id][2] and all(update_id in counts for counts in postings[1:])]
+			#most uses of the words first, then newest first, then oldest update_id first
+			ranked = sorted(matches, key=lambda update_id: (sum(counts[update_id] for counts in postings),
+				self._updates[update_id][1], -update_id), reverse=True)
+			page = ranked[offset:offset + limit]
+		if not page:
+			return []
+		updates = Update.query.options(joinedload(Update.user)).filter(Update.update_id.in_(page)).all()
+		by_id = dict((update.update_id, update) for update in updates)
+		return [by_id[update_id] for update_id in page if update_id in by_id]
+
+	def search_users(self, text, offset, limit):
+		"""Returns up to limit users whose username starts with text, shortest first"""
+
+		prefix = text.lower()
+		with self._lock:
+			self._loaded()
+			position = bisect_left(self._usernames, (prefix,))
+			user_ids = []
+			while position < len(self._usernames) and self._usernames[position][0].startswith(prefix):
+				user_ids.append(self._usernames[position])
+				position += 1
+		user_ids = [user_id for username, user_id in sorted(user_ids, key=lambda entry: (len(entry[0]), entry[0]))]
+		page = user_ids[offset:offset + limit]
+		if not page:
+			return []
+		users = dict((user.user_id, user) for user in User.query.filter(User.user_id.in_(page)).all())
+		return [users[user_id] for user_id in page if user_id in users]
+
+	def index_update(self, update):
+		"""Adds a new update to the index"""
+
+		with self._lock:
+			if self._postings is not None:
+				self._add_update(update.update_id, update.user_id, update.update_body, update.posted_at,
+					update.is_public)
+
+	def index_user(self, user):
+		"""Adds a new user to the index"""
+
+		with self._lock:
+			if self._postings is not None:
+				entry = (user.username.lower(), user.user_id)
+				self._usernames.insert(bisect_left(self._usernames, entry), entry)
+
+	def set_author_visibility(self, user_id, is_public):
+		"""Shows or hides a user's updates in results, after they change their account's visibility"""
+
+		with self._lock:
+			for update in self._updates.values():
+				if update[0] == user_id:
+					update[2] = is_public
+
+	def clear(self):
+		"""Empties the index, so that it is rebuilt on next use"""
+
+		with self._lock:
+			self._postings = None
+			self._updates = {}
+			self._usernames = []
@@ -2,24 +2,54 @@
 
 from jinja2 import StrictUndefined
 
-from flask import (Flask, render_template, redirect, request, session, flash, jsonify, url_for)
+from flask import (Flask, Response, abort, render_template, redirect, request, session, flash, jsonify, url_for,
+	send_from_directory)
 
 from flask_debugtoolbar import DebugToolbarExtension
 
-from model import User, Update, Comment, Pair, Message, Request, Notification, connect_to_db, db
+from model import (User, Update, Comment, Pair, Message, Request, Notification, TimelineEntry, Conversation,
+	SNIPPET_LENGTH, canonical_pair, connect_to_db, db)
 
 from datetime import datetime
 
-from passlib.hash import bcrypt
-
 from sqlalchemy import func, desc
 
-from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
+
+from sqlalchemy.orm import joinedload
+
+from social_graph import SocialGraphCache
+
+from notification_bus import make_bus
+
+from db_pool import TimedQueuePool, install_pre_ping, pool_status
+
+from passwords import password_hasher
+
+from username_index import UsernameIndex
+
+from search import MemorySearch, PostgresSearch
+
+from response_cache import make_cache
+
+from sql_metrics import SqlMetrics, server_timing
+
+from uploads import UploadRejected, receive_upload
+
+import images
 
 import os
 
 import os.path
 
+import base64
+
+import hashlib
+
+import hmac
+
+import json
+
 app = Flask(__name__)
 
 #reminder: need to input "source secret.sh" in shell to use
@@ -31,14 +61,43 @@ app.jinja_env.undefined = StrictUndefined
 app.jinja_env.auto_reload = True
 
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_FOLDER = os.path.join(APP_ROOT, "static/images")
 ALLOWED_EXTENSIONS = set(["jpg", "jpeg", "png"])
+DEFAULT_PICTURE_URL = "/static/images/default.png"
+MAX_PICTURE_BYTES = int(os.environ.get("MAX_PICTURE_MB", 16)) * 1024 * 1024
+#avatar files are named after their contents, so they can be cached for as long as browsers allow
+AVATAR_CACHE_SECONDS = 365 * 24 * 60 * 60
+FEED_PAGE_SIZE = 20
+MESSAGE_PAGE_SIZE = 5
+SEARCH_PAGE_SIZE = 20
+CURSOR_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+SOCIAL_GRAPH_CACHE_EDGES = int(os.environ.get("SOCIAL_GRAPH_CACHE_EDGES", 1000000))
+SOCIAL_GRAPH_CACHE_TTL = int(os.environ.get("SOCIAL_GRAPH_CACHE_TTL", 30))
+NOTIFICATION_CACHE_TTL = int(os.environ.get("NOTIFICATION_CACHE_TTL", 30))
+NOTIFICATION_HEARTBEAT = int(os.environ.get("NOTIFICATION_HEARTBEAT", 15))
+NOTIFICATION_CACHE_USERS = int(os.environ.get("NOTIFICATION_CACHE_USERS", 10000))
+#each open stream holds a thread for as long as its browser is open, so only this many are
+#served at once per process (browsers over the limit, or with 0, poll instead)
+NOTIFICATION_STREAMS = int(os.environ.get("NOTIFICATION_STREAMS", 10))
+NOTIFICATION_BUS_URL = os.environ.get("NOTIFICATION_BUS_URL")
+USERNAME_INDEX_REFRESH = int(os.environ.get("USERNAME_INDEX_REFRESH", 5))
+USERNAME_INDEX_RELOAD = int(os.environ.get("USERNAME_INDEX_RELOAD", 300))
+RESPONSE_CACHE_URL = os.environ.get("RESPONSE_CACHE_URL")
+RESPONSE_CACHE_ENTRIES = int(os.environ.get("RESPONSE_CACHE_ENTRIES", 1000))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 30))
+app.config["RESPONSE_CACHE_ENABLED"] = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+app.config["SERVER_TIMING"] = os.environ.get("SERVER_TIMING", "0") == "1"
+#the stats and metrics routes are only answered for requests made on this machine, or from
+#anywhere with an "Authorization: Bearer <STATS_TOKEN>" header when a token is set
+app.config["STATS_TOKEN"] = os.environ.get("STATS_TOKEN")
+#where uploaded pictures are spooled while their thumbnails are made (which go in images.AVATAR_FOLDER)
+app.config["UPLOAD_FOLDER"] = os.environ.get("UPLOAD_FOLDER", os.path.join(APP_ROOT, "uploads"))
 
 #logic functions here:
 
 
 def add_user(username, password, is_public):
-	"""Adds new user to database, allowing them to use the website"""
+	"""Adds new user to database, allowing them to use the website, and returns their
+	user_id (or None if the username was taken meanwhile, in any case)"""
 	if is_public == 1:
 		username = username.lower()
 		user = User(username=username, password=password, 
@@ -49,11 +108,36 @@ def add_user(username, password, is_public):
 					joined_at=datetime.now(), is_public=False)
 
 	db.session.add(user)
-	db.session.commit()
+	#the username check on the form can race with another signup, which the unique index catches
+	try:
+		db.session.commit()
+	except IntegrityError:
+		db.session.rollback()
+		return None
 	user_id = user.user_id
 	username = user.username
+	username_index.add(username)
+	search_backend().index_user(user)
 	return user_id
 
+def usernames_registered_after(user_id):
+	"""Returns (user_id, username) for the users with a higher user_id than the one given,
+	used to fill the username index"""
+
+	return db.session.query(User.user_id, User.username).filter(User.user_id > user_id).order_by(User.user_id).all()
+
+username_index = UsernameIndex(usernames_registered_after, refresh=USERNAME_INDEX_REFRESH,
+	full_reload=USERNAME_INDEX_RELOAD)
+
+def username_taken(username):
+	"""Checks whether a username is already in use, in any case (answered from the username
+	index when it isn't, and with one indexed query when it might be)"""
+
+	if not username_index.might_exist(username):
+		return False
+	user = db.session.query(User.user_id).filter(db.func.lower(User.username) == username.lower()).first()
+	return user is not None
+
 def check_user_credentials(username, password):
 	"""Checks the validity of a username and password"""
 	
@@ -61,6 +145,10 @@ def check_user_credentials(username, password):
 	if user is not None:
 		password_hashed = User.validate_password(user, password)
 		if password_hashed:
+			#hashes made before the cost factor was changed are redone while the password is at hand
+			if password_hasher.needs_rehash(user.password):
+				user.password = password_hasher.hash(password)
+				db.session.commit()
 			user_id = user.user_id
 			username = user.username
 			return user_id
@@ -72,13 +160,40 @@ def check_user_credentials(username, password):
 def submit_update(user_id, body):
 	"""Creates an update object with the text body and user_id passed in"""
 
-	update = Update(user_id=user_id, update_body=body, posted_at=datetime.now())
+	#the author's visibility is copied over by the insert itself, rather than by a separate lookup
+	author_is_public = db.select([User.is_public]).where(User.user_id == user_id).as_scalar()
+	update = Update(user_id=user_id, update_body=body, posted_at=datetime.now(), is_public=author_is_public)
 
 	db.session.add(update)
+	db.session.flush()
+	fan_out_update(update)
 	db.session.commit()
+	search_backend().index_update(update)
+	if update.is_public:
+		invalidate_cached_responses("feed-all")
 
 	return update.update_id
 
+def fan_out_update(update):
+	"""Pushes a newly posted update onto the timeline of every user connected with
+	its author, in a single INSERT ... SELECT off of the pairs table"""
+
+	author_id = update.user_id
+	connected_id = db.case([(Pair.user_1_id == author_id, Pair.user_2_id)], else_=Pair.user_1_id)
+	entries = db.select([connected_id, db.literal(update.update_id), db.literal(update.posted_at)]).where(
+		(Pair.user_1_id == author_id) | (Pair.user_2_id == author_id))
+	db.session.execute(TimelineEntry.__table__.insert().from_select(
+		["owner_id", "update_id", "posted_at"], entries))
+
+def backfill_timeline(owner_id, author_id):
+	"""Copies every existing update by author_id onto owner_id's timeline, used
+	when two users connect"""
+
+	entries = db.select([db.literal(owner_id), Update.update_id, Update.posted_at]).where(
+		Update.user_id == author_id)
+	db.session.execute(TimelineEntry.__table__.insert().from_select(
+		["owner_id", "update_id", "posted_at"], entries))
+
 def submit_comment(user_id, update_id, body):
 	"""Creates a comment object and adds it to the database"""
 
@@ -95,10 +210,11 @@ def display_comments(update_id):
 
 	user_comments = {}
 
-	comments = Comment.query.filter(Comment.update_id == update_id).all()
+	#commenters are joined in so that their usernames come back with the comments
+	comments = Comment.query.options(joinedload(Comment.user)).filter(Comment.update_id == update_id).all()
 
 	for comment in comments:
-		user = User.query.get(comment.user_id)
+		user = comment.user
 		username = user.username
 		time_date = datetime.strftime(comment.posted_at, "%-H:%M UTC on %B %-d, %Y")
 		user_comments[comment.comment_id] = {"comment on": comment.update_id,
@@ -109,53 +225,94 @@ def display_comments(update_id):
 
 def check_inbox(user_id):
 	"""For a given user, checks what message threads they are currently in to
-	then display an inbox"""
+	then display an inbox, most recently active first"""
 
-	users_in_conversations_with = []
+	return [conversation["user_id"] for conversation in inbox_conversations(user_id)]
 
-	messages = Message.query.filter((Message.owner_id == user_id) | (Message.recipient_id == user_id)).all()
+def inbox_conversations(user_id):
+	"""For a given user, returns a summary of each of their conversations, most recently
+	active first, read from the conversations table with a single query"""
 
-	for message in messages:
-		if message.owner_id not in users_in_conversations_with and message.recipient_id not in users_in_conversations_with:
-			if message.owner_id == user_id:
-				users_in_conversations_with.append(message.recipient_id)
-			else:
-				users_in_conversations_with.append(message.owner_id)
+	other_user_id = db.case([(Conversation.user_1_id == user_id, Conversation.user_2_id)], else_=Conversation.user_1_id)
+	rows = db.session.query(Conversation, User.user_id, User.username).join(User, User.user_id == other_user_id).filter(
+		(Conversation.user_1_id == user_id) | (Conversation.user_2_id == user_id)).order_by(
+		Conversation.last_message_at.desc()).all()
+
+	conversations = []
+	for conversation, other_id, username in rows:
+		if conversation.user_1_id == user_id:
+			unread = conversation.user_1_unread
+		else:
+			unread = conversation.user_2_unread
+		time_date = datetime.strftime(conversation.last_message_at, "%-H:%M UTC on %B %-d, %Y")
+		conversations.append({"user_id": other_id, "username": username, "pair_id": conversation.pair_id,
+			"last message at": time_date, "snippet": conversation.last_snippet, "unread": unread})
+	return conversations
+
+def load_adjacency(user_id):
+	"""For a given user, returns (other user_id, pair_id) for each of their connections,
+	used to fill the social graph cache"""
+
+	pairs = db.session.query(Pair.pair_id, Pair.user_1_id, Pair.user_2_id).filter(
+		(Pair.user_1_id == user_id) | (Pair.user_2_id == user_id)).all()
+
+	adjacency = []
+	for pair_id, user_1_id, user_2_id in pairs:
+		if user_1_id == user_id:
+			adjacency.append((user_2_id, pair_id))
+		else:
+			adjacency.append((user_1_id, pair_id))
+	return adjacency
+
+social_graph = SocialGraphCache(load_adjacency, max_edges=SOCIAL_GRAPH_CACHE_EDGES, ttl=SOCIAL_GRAPH_CACHE_TTL)
 
-	return users_in_conversations_with
+def reset_caches():
+	"""Empties the in-process caches, for when the database has been changed behind the
+	server's back (e.g. between tests)"""
+
+	social_graph.clear()
+	notification_bus.clear()
+	username_index.clear()
+	memory_search.clear()
+	response_cache.clear()
 
 def connections(user_id):
 	"""For a given user, returns list of users this user has connected with/
 	authorized for communication"""
 
-	connected_to = []
-
-	friends = Pair.query.filter((Pair.user_1_id == user_id) | (Pair.user_2_id == user_id)).all()
+	return social_graph.neighbours(user_id)
 
-	for friend in friends:
-		if friend.user_1_id == user_id:
-			connected_to.append(friend.user_2_id)
-		if friend.user_2_id == user_id:
-			connected_to.append(friend.user_1_id)
+def get_message_history(pair_id, offset_num=0, cursor=None):
+	"""For a given pair, return the 5 most recent messages between the two users, with potential for offset
+	or for a cursor from a previous page"""
 
-	return connected_to
+	return serialize_messages(message_history_page(pair_id, offset_num, cursor))
 
-def get_message_history(pair_id, offset_num=0):
-	"""For a given pair, return the 10 most recent messages between the two users, with potential for offset"""
+def message_history_page(pair_id, offset_num=0, cursor=None):
+	"""For a given pair, returns one page of message objects, newest first"""
 
 	pair = Pair.query.filter(Pair.pair_id == pair_id).first()
-	messages = Message.query.filter(
-		((Message.recipient_id == pair.user_1_id) | (Message.recipient_id == pair.user_2_id)), 
-		((Message.owner_id == pair.user_1_id) | (Message.owner_id == pair.user_2_id)),
-		Message.deleted == False).order_by(desc(Message.sent_at)).limit(5).offset(offset_num).all()
+	#each direction is its own range of the messages index, and the two are merged in order
+	#(rather than filtering both users as owner or recipient, which reads the whole thread)
+	sent = Message.query.filter(Message.owner_id == pair.user_1_id, Message.recipient_id == pair.user_2_id,
+		Message.deleted == False)
+	received = Message.query.filter(Message.owner_id == pair.user_2_id, Message.recipient_id == pair.user_1_id,
+		Message.deleted == False)
+	position = decode_cursor(cursor) if cursor else None
+	if position:
+		sent = after_cursor(sent, Message.sent_at, Message.msg_id, position)
+		received = after_cursor(received, Message.sent_at, Message.msg_id, position)
+	messages = sent.union_all(received).options(joinedload(Message.owner), joinedload(Message.recipient))
+	return paginate(messages, Message.sent_at, Message.msg_id, 0 if position else offset_num, None, MESSAGE_PAGE_SIZE)
+
+def serialize_messages(messages):
+	"""Turns message objects into the dictionaries used by the message templates and json"""
 
 	message_history = []
 
 	for message in messages:
-		owner = User.query.get(message.owner_id)
-		owner_username = owner.username
-		recipient = User.query.get(message.recipient_id)
-		recipient_username = recipient.username
+		owner_username = message.owner.username
+		recipient_username = message.recipient.username
 		time_date = datetime.strftime(message.sent_at, "%-H:%M UTC on %B %-d, %Y")
 		message_history.append({"to": recipient_username, "from": owner_username,
 		"message": message.message_body, "sent at": time_date, "read": message.read, "msg_id": message.msg_id})
@@ -171,11 +328,9 @@ def which_pair_by_active_user(user_id, pair_id):
 	if user_id != pair.user_1_id and user_id != pair.user_2_id:
 		return False
 	if user_id == pair.user_1_id:
-		other_user = User.query.get(pair.user_2_id)
-		return other_user.user_id
+		return pair.user_2_id
 	if user_id == pair.user_2_id:
-		other_user = User.query.get(pair.user_1_id)
-		return other_user.user_id
+		return pair.user_1_id
 
 def submit_message_to_db(user_id, recipient_id, message_body):
 	"""Adds a message instance to the db"""
@@ -183,56 +338,260 @@ def submit_message_to_db(user_id, recipient_id, message_body):
 	message = Message(owner_id=user_id, recipient_id=recipient_id,
 		sent_at=datetime.now(), message_body=message_body)
 	db.session.add(message)
+	record_in_conversation(message)
 	db.session.commit()
 	return message.msg_id
 
+def record_in_conversation(message):
+	"""Updates (or starts) the conversation summary between a message's sender and
+	recipient to show the new message"""
+
+	user_1_id, user_2_id = canonical_pair(message.owner_id, message.recipient_id)
+	conversation = find_conversation(user_1_id, user_2_id)
+	if conversation is None:
+		conversation = Conversation(user_1_id=user_1_id, user_2_id=user_2_id,
+			pair_id=pair_lookup(user_1_id, user_2_id), user_1_unread=0, user_2_unread=0, message_count=0,
+			last_message_at=message.sent_at, last_snippet=message.message_body[:SNIPPET_LENGTH],
+			last_sender_id=message.owner_id)
+		#the first messages of both users can arrive at once, and the unique index turns away
+		#the second conversation to be inserted, which then updates the first one instead
+		try:
+			with db.session.begin_nested():
+				db.session.add(conversation)
+		except IntegrityError:
+			conversation = find_conversation(user_1_id, user_2_id)
+	conversation.last_message_at = message.sent_at
+	conversation.last_snippet = message.message_body[:SNIPPET_LENGTH]
+	conversation.last_sender_id = message.owner_id
+	db.session.flush()
+	#incremented in the database so that messages sent at the same time aren't lost
+	conversation.message_count = Conversation.message_count + 1
+	if int(message.recipient_id) == user_1_id:
+		conversation.user_1_unread = Conversation.user_1_unread + 1
+	else:
+		conversation.user_2_unread = Conversation.user_2_unread + 1
+
+def find_conversation(user_1_id, user_2_id):
+	"""Returns the conversation between two users (given lower user_id first), or None"""
+
+	return Conversation.query.filter(Conversation.user_1_id == user_1_id, Conversation.user_2_id == user_2_id).first()
+
+def delete_message(user_id, msg_id):
+	"""Soft-deletes a message sent by a user (it stays in the db, but is no longer shown),
+	keeping the conversation's message count, unread count and last message in step (the
+	conversation goes once it has no messages left)"""
+
+	deleted = Message.query.filter(Message.msg_id == msg_id, Message.owner_id == user_id,
+		Message.deleted == False).update({"deleted": True}, synchronize_session=False)
+	if deleted:
+		message = Message.query.get(msg_id)
+		user_1_id, user_2_id = canonical_pair(message.owner_id, message.recipient_id)
+		conversation = Conversation.query.filter(Conversation.user_1_id == user_1_id,
+			Conversation.user_2_id == user_2_id)
+		newest = Message.query.filter(
+			((Message.owner_id == user_1_id) & (Message.recipient_id == user_2_id)) |
+			((Message.owner_id == user_2_id) & (Message.recipient_id == user_1_id)),
+			Message.deleted == False).order_by(Message.sent_at.desc(), Message.msg_id.desc()).first()
+		if newest is None:
+			conversation.delete(synchronize_session=False)
+		else:
+			changes = {Conversation.message_count: Conversation.message_count - 1,
+				Conversation.last_message_at: newest.sent_at,
+				Conversation.last_snippet: newest.message_body[:SNIPPET_LENGTH],
+				Conversation.last_sender_id: newest.owner_id}
+			if not message.read:
+				if int(message.recipient_id) == user_1_id:
+					changes[Conversation.user_1_unread] = Conversation.user_1_unread - 1
+				else:
+					changes[Conversation.user_2_unread] = Conversation.user_2_unread - 1
+			conversation.update(changes, synchronize_session=False)
+	db.session.commit()
+	return bool(deleted)
+
+def mark_conversation_read(user_id, other_user_id):
+	"""Clears the unread count (and unread messages) for a user in their conversation
+	with another user, returning whether there were any"""
+
+	user_1_id, user_2_id = canonical_pair(user_id, other_user_id)
+	if user_id == user_1_id:
+		unread_column = Conversation.user_1_unread
+	else:
+		unread_column = Conversation.user_2_unread
+	updated = Conversation.query.filter(Conversation.user_1_id == user_1_id, Conversation.user_2_id == user_2_id,
+		unread_column > 0).update({unread_column: 0}, synchronize_session=False)
+	if updated:
+		Message.query.filter(Message.owner_id == other_user_id, Message.recipient_id == user_id,
+			Message.read == False).update({"read": True}, synchronize_session=False)
+	db.session.commit()
+	return bool(updated)
+
 def pair_lookup(user_1_id, user_2_id):
 	"""For two users, finds the pair_id for the connection (if exists)"""
 
-	pair = Pair.query.filter((Pair.user_1_id == user_1_id) | (Pair.user_1_id == user_2_id),
-		(Pair.user_2_id == user_1_id) | (Pair.user_2_id == user_2_id)).first()
+	return social_graph.pair_id(user_1_id, user_2_id)
+
+response_cache = make_cache(RESPONSE_CACHE_URL, RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_TTL)
+
+def cached_response(namespace, key_parts, build_response):
+	"""Returns a json response from the response cache, or builds it with build_response()
+	and caches it. Cached responses are keyed by the namespace's generation, so that
+	invalidate_cached_responses(namespace) retires all of them at once"""
+
+	if not app.config["RESPONSE_CACHE_ENABLED"]:
+		return build_response()
+	generation = response_cache.counter(namespace + ":generation")
+	key = "%s:%d:%s" % (namespace, generation, ":".join(str(part) for part in key_parts))
+	body = response_cache.get(key)
+	if body is not None:
+		return app.response_class(body, mimetype="application/json")
+	response = build_response()
+	if response.status_code == 200:
+		response_cache.set(key, response.get_data())
+	return response
+
+def invalidate_cached_responses(namespace):
+	"""Makes the cached responses in a namespace stale (in every worker, with a shared cache)"""
+
+	response_cache.incr(namespace + ":generation")
+
+def make_etag(*parts):
+	"""Turns the values that a response depends on into an entity tag"""
+
+	return hashlib.md5(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+def conditional_response(etag, build_response, last_modified=None):
+	"""Answers 304 Not Modified if the client's copy of a response is still current (by its
+	If-None-Match entity tags, or else its If-Modified-Since date), and otherwise builds the
+	response with build_response() and adds the validators to it"""
+
+	if request.if_none_match:
+		not_modified = request.if_none_match.contains(etag)
+	else:
+		not_modified = (last_modified is not None and request.if_modified_since is not None and
+			last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None))
+	if not_modified:
+		response = app.response_class(status=304)
+	else:
+		response = build_response()
+	response.set_etag(etag)
+	if last_modified is not None:
+		response.last_modified = last_modified
+	#browsers keep the response, but check it is current before each use
+	response.headers["Cache-Control"] = "private, no-cache"
+	return response
+
+def public_feed_validators():
+	"""Returns (entity tag, last modified) for the public feed, from its newest update
+	(a single lookup at the start of the index the feed is read from) and the feed's
+	generation"""
+
+	#ties go to the highest update_id, so that an update posted at the same time as the
+	#newest one still changes the tag
+	newest = db.session.query(Update.posted_at, Update.update_id).filter(Update.is_public == True).order_by(
+		Update.posted_at.desc(), Update.update_id.desc()).first()
+	#a user changing their visibility adds or takes out updates without changing the newest
+	#one, but moves on the feed's generation (shared by the workers when the response cache
+	#is in Redis)
+	generation = response_cache.counter("feed-all:generation")
+	if newest is None:
+		return make_etag("feed-all", generation), None
+	return make_etag("feed-all", generation, newest.posted_at.isoformat(), newest.update_id), newest.posted_at
+
+def connection_feed_validator(user_id):
+	"""Returns the entity tag for a user's connections feed, from the newest row of their
+	timeline (which also changes when a new connection's updates are copied in)"""
+
+	newest = db.session.query(db.func.max(TimelineEntry.timeline_id)).filter(TimelineEntry.owner_id == user_id).scalar()
+	return make_etag("feed-connects", user_id, newest)
+
+def encode_cursor(timestamp, row_id):
+	"""Packs the sort position of the last row on a page into an opaque string
+	that the client hands back to get the following page"""
+
+	position = "%s|%d" % (datetime.strftime(timestamp, CURSOR_TIME_FORMAT), row_id)
+	return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+	"""Unpacks a cursor made by encode_cursor into (timestamp, row_id), returns None
+	if the cursor can't be read"""
+
+	try:
+		position = base64.urlsafe_b64decode(str(cursor)).decode("utf-8")
+		timestamp, row_id = position.split("|")
+		return (datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(row_id))
+	except (TypeError, ValueError):
+		return None
+
+def paginate(query, time_column, id_column, offset_num=0, cursor=None, page_size=FEED_PAGE_SIZE):
+	"""Orders a query newest first and returns one page of it--with a cursor the
+	page starts just after the cursor's position (a range scan that costs the same
+	however deep the page is), otherwise it starts offset_num rows in"""
+
+	#ties on time are broken by ascending id so that pages never overlap
+	query = query.order_by(time_column.desc(), id_column)
+	position = decode_cursor(cursor) if cursor else None
+	if position:
+		query = after_cursor(query, time_column, id_column, position)
+	else:
+		query = query.offset(offset_num)
+	return query.limit(page_size).all()
 
-	if pair: 
-		return pair.pair_id
+def after_cursor(query, time_column, id_column, position):
+	"""Narrows a query to the rows that come after a decoded cursor's (time, id) position"""
 
-def show_feed_all(offset_num):
+	timestamp, row_id = position
+	#the first condition is implied by the second, but it is the one an index range can start from
+	return query.filter(time_column <= timestamp,
+		(time_column < timestamp) | ((time_column == timestamp) & (id_column > row_id)))
+
+def next_cursor(rows, time_attr, id_attr, page_size=FEED_PAGE_SIZE):
+	"""Returns the cursor for the page after rows, or None if rows was the last page"""
+
+	if len(rows) < page_size:
+		return None
+	last_row = rows[-1]
+	return encode_cursor(getattr(last_row, time_attr), getattr(last_row, id_attr))
+
+def show_feed_all(offset_num, cursor=None):
 	"""Show 20 most recent public updates"""
 
-	public_users = db.session.query(User.user_id).filter(User.is_public == True).all()
-	updates = Update.query.filter(Update.user_id.in_(public_users)).order_by(Update.posted_at.desc()).limit(20).offset(offset_num).all()
+	return serialize_updates(public_updates_page(offset_num, cursor))
+
+def public_updates_page(offset_num=0, cursor=None):
+	"""Returns one page of public update objects, newest first"""
+
+	updates = Update.query.options(joinedload(Update.user)).filter(Update.is_public == True)
+	return paginate(updates, Update.posted_at, Update.update_id, offset_num, cursor)
+
+def serialize_updates(updates):
+	"""Turns update objects (loaded with their user) into the lists used by the feed json"""
+
 	all_updates = []
 	for update in updates:
-		username = (User.query.get(update.user_id)).username
+		username = update.user.username
 		posted = datetime.strftime(update.posted_at, "%-H:%M UTC on %B %-d, %Y")
-		user_id = (User.query.get(update.user_id)).user_id
+		user_id = update.user_id
 		all_updates.append([username, update.update_body, posted, user_id, update.update_id])
 	return all_updates
 
 def all_connections_for_current_user(current_user_id):
 	"""Used to show feed connections, for the current user returns a list of user_ids connected with"""
 
-	pairs_in = Pair.query.filter((Pair.user_1_id == current_user_id) | (Pair.user_2_id == current_user_id)).all()
-	pairs_with = []
-	for pair in pairs_in:
-		if pair.user_1_id == current_user_id:
-			pairs_with.append(pair.user_2_id)
-		if pair.user_2_id == current_user_id:
-			pairs_with.append(pair.user_1_id)
-	return pairs_with
+	return social_graph.neighbours(current_user_id)
 
 		
-def show_feed_connections(offset_num, current_user_id):
+def show_feed_connections(offset_num, current_user_id, cursor=None):
 	"""Show 20 most recent updates created by connections"""
 	
-	pairs_with = all_connections_for_current_user(current_user_id)
-	updates = Update.query.filter(Update.user_id.in_(pairs_with)).order_by(Update.posted_at.desc()).limit(20).offset(offset_num).all()
-	all_updates = []
-	for update in updates:
-		username = (User.query.get(update.user_id)).username
-		posted = datetime.strftime(update.posted_at, "%-H:%M UTC on %B %-d, %Y")
-		user_id = (User.query.get(update.user_id)).user_id
-		all_updates.append([username, update.update_body, posted, user_id, update.update_id])
-	return all_updates
+	return serialize_updates(connection_updates_page(current_user_id, offset_num, cursor))
+
+def connection_updates_page(current_user_id, offset_num=0, cursor=None):
+	"""Returns one page of update objects from the current user's connections, read
+	from the current user's pre-built timeline rather than from every connection's updates"""
+
+	updates = Update.query.join(TimelineEntry, TimelineEntry.update_id == Update.update_id).options(
+		joinedload(Update.user)).filter(TimelineEntry.owner_id == current_user_id)
+	return paginate(updates, TimelineEntry.posted_at, TimelineEntry.update_id, offset_num, cursor)
 
 def all_updates_for_specific_user(user_id):
 	"""Returns a list of update objects represent the updates a user has posted"""
@@ -240,6 +599,18 @@ def all_updates_for_specific_user(user_id):
 	updates = Update.query.filter(Update.user_id == user_id).order_by(Update.posted_at).all()
 	return updates
 
+def profile_updates_page(user_id, offset_num=0, cursor=None):
+	"""Returns one page of the update objects a user has posted, newest first"""
+
+	updates = Update.query.options(joinedload(Update.user)).filter(Update.user_id == user_id)
+	return paginate(updates, Update.posted_at, Update.update_id, offset_num, cursor)
+
+def can_see_updates(viewer_id, user):
+	"""Checks whether a logged in user may see another user's updates: their own, a public
+	account's, or those of a user they are connected with"""
+
+	return user.user_id == viewer_id or user.is_public or bool(pair_lookup(user.user_id, viewer_id))
+
 def add_connection_request(current_user_id, other_user_id):
 	"""Adds a connection request to the db"""
 
@@ -254,16 +625,23 @@ def add_pair_to_db(current_user_id, user_connecting_with_id):
 
 	pair = Pair(user_1_id=user_connecting_with_id, user_2_id=current_user_id)
 	db.session.add(pair)
+	backfill_timeline(current_user_id, user_connecting_with_id)
+	backfill_timeline(user_connecting_with_id, current_user_id)
 	db.session.commit()
 	other_user_username = (User.query.filter(User.user_id == user_connecting_with_id).first()).username
 	Request.query.filter(Request.requester_id == user_connecting_with_id, Request.requestee_id == current_user_id).delete()
+	user_1_id, user_2_id = canonical_pair(current_user_id, user_connecting_with_id)
+	Conversation.query.filter(Conversation.user_1_id == user_1_id, Conversation.user_2_id == user_2_id).update(
+		{"pair_id": pair.pair_id}, synchronize_session=False)
 	db.session.commit()
+	social_graph.add_edge(current_user_id, user_connecting_with_id, pair.pair_id)
 	return pair.pair_id
 
 def get_connection_requests(current_user_id):
 	"""Fetches from the database any outstanding connection requests for the current user"""
 
-	current_requests = Request.query.filter(Request.requestee_id == current_user_id).all()
+	current_requests = Request.query.options(joinedload(Request.requester)).filter(
+		Request.requestee_id == current_user_id).all()
 	return current_requests
 
 def usernames_behind_connection_requests(current_requests):
@@ -271,33 +649,51 @@ def usernames_behind_connection_requests(current_requests):
 
 	usernames = []
 	for request in current_requests:
-		username = (User.query.get(request.requester_id)).username
+		username = request.requester.username
 		usernames.append(username)
 
 	return usernames
 
+def set_user_visibility(current_user_id, is_public):
+	"""Makes a user's account public or private, carrying the change over to the
+	copy of the setting kept on each of their updates"""
+
+	user = User.query.get(current_user_id)
+	user.is_public = is_public
+	Update.query.filter(Update.user_id == current_user_id).update({"is_public": is_public},
+		synchronize_session=False)
+	db.session.commit()
+	search_backend().set_author_visibility(current_user_id, is_public)
+	invalidate_cached_responses("feed-all")
+	return user.is_public
+
 def change_password(current_user_id, new_password):
 	"""Changes the password of the current user"""
 
 	user = User.query.get(current_user_id)
-	user.password = bcrypt.encrypt(new_password)
+	user.password = password_hasher.hash(new_password)
 	db.session.commit()
-
-	if bcrypt.verify(new_password, user.password):
-		return True
-	else:
-		return False
+	return True
 
 def get_num_messages_between(pair_id):
 	"""For a given pair, return the number of messages between them in the database (used to calculate need
-	for offset/next button when displaying messages"""
+	for offset/next button when displaying messages), read from the count kept on their conversation"""
 
-	pair = Pair.query.filter(Pair.pair_id == pair_id).first()
-	message_count = Message.query.filter(
-		((Message.recipient_id == pair.user_1_id) | (Message.recipient_id == pair.user_2_id)), 
-		((Message.owner_id == pair.user_1_id) | (Message.owner_id == pair.user_2_id)),
-		Message.deleted == False).count()
-	return int(message_count)
+	message_count = db.session.query(Conversation.message_count).filter(Conversation.pair_id == pair_id).scalar()
+	return int(message_count or 0)
+
+def message_thread_for_user(user_id, pair_id):
+	"""For a pair that the logged in user is in, returns (other user_id, other username,
+	number of messages) with a single query, or None if the user isn't in the pair"""
+
+	other_user_id = db.case([(Pair.user_1_id == user_id, Pair.user_2_id)], else_=Pair.user_1_id)
+	thread = db.session.query(User.user_id, User.username, Conversation.message_count).select_from(Pair).join(
+		User, User.user_id == other_user_id).outerjoin(Conversation, Conversation.pair_id == Pair.pair_id).filter(
+		Pair.pair_id == pair_id, (Pair.user_1_id == user_id) | (Pair.user_2_id == user_id)).first()
+	if thread is None:
+		return None
+	other_user_id, other_user, message_count = thread
+	return other_user_id, other_user, int(message_count or 0)
 
 def allowed_file(filename):
 	"""Checks that user uploaded files are in the correct/allowed format"""
@@ -305,12 +701,36 @@ def allowed_file(filename):
 	#see http://flask.pocoo.org/docs/0.11/patterns/fileuploads/
 	return "." in filename and filename.rsplit(".", 1)[1] in ALLOWED_EXTENSIONS
 
+def set_picture_url(user_id, picture_url):
+	"""Records the url of a user's new profile picture"""
+
+	User.query.filter(User.user_id == user_id).update({"picture_url": picture_url}, synchronize_session=False)
+	db.session.commit()
+
+def save_profile_picture(user_id, stream, content_length=None):
+	"""Receives an uploaded picture a chunk at a time (spooled to a file in the upload folder,
+	which is removed once the picture has been read), stores a thumbnail of it and records the
+	thumbnail's url on the user. Raises UploadRejected for uploads that aren't accepted"""
+
+	path = receive_upload(stream, app.config["UPLOAD_FOLDER"], MAX_PICTURE_BYTES, content_length)
+	try:
+		with open(path, "rb") as picture:
+			filename = images.store_avatar(picture)
+	except images.InvalidImage as error:
+		raise UploadRejected(str(error), 415)
+	finally:
+		os.remove(path)
+	picture_url = images.AVATAR_URL + filename
+	set_picture_url(user_id, picture_url)
+	return picture_url
+
 def add_notification(user_id, notification_type):
 	"""Adds a notification to the db, which will then later be used by AJAX to display notifications to the user"""
 
 	notification = Notification(user_id=user_id, notification_type=notification_type, added_at=datetime.now())
 	db.session.add(notification)
 	db.session.commit()
+	notification_bus.publish(user_id, notification.notification_id, notification_type)
 
 	return notification.notification_id
 
@@ -320,8 +740,33 @@ def change_notification_to_viewed(notification_id):
 	notification = Notification.query.get(notification_id)
 	notification.viewed = True
 	db.session.commit()
+	notification_bus.viewed(notification.user_id, [notification.notification_id])
 	return notification.viewed
 
+def mark_notifications_viewed(user_id, notification_ids):
+	"""Changes the viewed column to 'True' for several of a user's notifications at once,
+	with a single update, and returns how many were changed"""
+
+	notification_ids = [int(notification_id) for notification_id in notification_ids]
+	if not notification_ids:
+		return 0
+	updated = Notification.query.filter(Notification.notification_id.in_(notification_ids),
+		Notification.user_id == user_id, Notification.viewed == False).update(
+		{"viewed": True}, synchronize_session=False)
+	db.session.commit()
+	notification_bus.viewed(user_id, notification_ids)
+	return updated
+
+def mark_all_notifications_viewed(user_id):
+	"""Changes the viewed column to 'True' for all of a user's notifications, and returns
+	how many were changed"""
+
+	updated = Notification.query.filter(Notification.user_id == user_id, Notification.viewed == False).update(
+		{"viewed": True}, synchronize_session=False)
+	db.session.commit()
+	notification_bus.viewed(user_id)
+	return updated
+
 def find_notifications_not_viewed(user_id):
 	"""For a given user, returns all current notifications in db that haven't yet been viewed"""
 
@@ -331,13 +776,119 @@ def find_notifications_not_viewed(user_id):
 		notification_list.append([notification.notification_id, notification.notification_type])
 	return notification_list
 
+notification_bus = make_bus(find_notifications_not_viewed, NOTIFICATION_BUS_URL, NOTIFICATION_CACHE_TTL,
+	NOTIFICATION_CACHE_USERS, NOTIFICATION_STREAMS)
+
+def notification_events(subscription, heartbeat=NOTIFICATION_HEARTBEAT):
+	"""Formats a subscription's notifications as a server-sent event stream, with a comment
+	line as a heartbeat while there is nothing to send (when any notifications it has missed
+	are sent too)"""
+
+	yield "retry: 5000\n\n"
+	try:
+		for event in subscription.events(heartbeat):
+			if event is None:
+				#the request's session has been removed by the time the stream is read, so each
+				#check gets a session of its own and gives its connection straight back
+				with app.app_context():
+					try:
+						events = notification_bus.missed(subscription)
+					finally:
+						db.session.remove()
+				if not events:
+					yield ": heartbeat\n\n"
+			else:
+				events = [event]
+			for notification_id, notification_type in events:
+				subscription.delivered.add(notification_id)
+				yield "id: %d\nevent: notification\ndata: %s\n\n" % (notification_id,
+					json.dumps([notification_id, notification_type]))
+	finally:
+		notification_bus.unsubscribe(subscription)
+
+postgres_search = PostgresSearch()
+memory_search = MemorySearch()
+
+def search_backend():
+	"""Returns the search backend for the connected database: PostgreSQL's own full-text
+	indexes, or else the in-memory index"""
+
+	if db.get_engine(app).dialect.name == "postgresql":
+		return postgres_search
+	return memory_search
+
+def search_page(text, page=0):
+	"""For some search text, returns one page of matching usernames and one page of matching public
+	updates, each with whether there is a further page"""
+
+	offset = page * SEARCH_PAGE_SIZE
+	backend = search_backend()
+	users = backend.search_users(text, offset, SEARCH_PAGE_SIZE + 1)
+	updates = backend.search_updates(text, offset, SEARCH_PAGE_SIZE + 1)
+	return {"users": users[:SEARCH_PAGE_SIZE], "more_users": len(users) > SEARCH_PAGE_SIZE,
+		"updates": updates[:SEARCH_PAGE_SIZE], "more_updates": len(updates) > SEARCH_PAGE_SIZE}
+
+def usernames_by_id(user_ids):
+	"""For a list of user_ids, returns a dictionary of user_id to username, fetched in one query"""
+
+	if not user_ids:
+		return {}
+	return dict(db.session.query(User.user_id, User.username).filter(User.user_id.in_(user_ids)).all())
+
 def get_request_id(current_user_id, other_user_id):
 	"""For two given users, returns the id for their connection request"""
 
-	r_id = (Request.query.filter((Request.requester_id == current_user_id) | (Request.requester_id == other_user_id),
-		(Request.requestee_id == current_user_id) | (Request.requestee_id == other_user_id)).first()).request_id
+	r_id = (Request.query.filter(
+		((Request.requester_id == current_user_id) & (Request.requestee_id == other_user_id)) |
+		((Request.requester_id == other_user_id) & (Request.requestee_id == current_user_id))).first()).request_id
 	return r_id
 
+sql_metrics = SqlMetrics()
+sql_metrics.install()
+
+@app.before_request
+def start_sql_metrics():
+	sql_metrics.start()
+
+@app.after_request
+def finish_sql_metrics(response):
+	"""Adds the request's SQL statements to its endpoint's totals, and reports them in a
+	Server-Timing header if SERVER_TIMING is on (statements sent while a streamed response
+	is being sent aren't counted)"""
+
+	scope = sql_metrics.finish(request.endpoint)
+	if scope is not None and app.config["SERVER_TIMING"]:
+		response.headers["Server-Timing"] = server_timing(scope)
+	return response
+
+def profile_relationship(viewer_id, subject_id):
+	"""For a logged in user viewing another user's profile, returns the subject's User (None
+	if there is no such user) and how the two are related, all from one query: ("self", None),
+	("connected", None), ("request-incoming", request_id) when the subject has asked to connect
+	with the viewer, ("request-outgoing", request_id) when the viewer has asked, or ("none", None)"""
+
+	#pairs are stored lower user_id first, so one equality lookup finds the pair
+	user_1_id, user_2_id = canonical_pair(viewer_id, subject_id)
+	pair_id = db.session.query(Pair.pair_id).filter(Pair.user_1_id == user_1_id,
+		Pair.user_2_id == user_2_id).limit(1).as_scalar()
+	incoming_id = db.session.query(Request.request_id).filter(Request.requester_id == subject_id,
+		Request.requestee_id == viewer_id).order_by(Request.request_id).limit(1).as_scalar()
+	outgoing_id = db.session.query(Request.request_id).filter(Request.requester_id == viewer_id,
+		Request.requestee_id == subject_id).order_by(Request.request_id).limit(1).as_scalar()
+	row = db.session.query(User, pair_id, incoming_id, outgoing_id).filter(User.user_id == subject_id).first()
+	if row is None:
+		return None, ("none", None)
+	user, pair_id, incoming_id, outgoing_id = row
+	if subject_id == viewer_id:
+		return user, ("self", None)
+	if pair_id is not None:
+		return user, ("connected", None)
+	if incoming_id is not None:
+		return user, ("request-incoming", incoming_id)
+	if outgoing_id is not None:
+		return user, ("request-outgoing", outgoing_id)
+	return user, ("none", None)
+
 #routes:
 
 @app.route("/")
@@ -375,6 +926,10 @@ def register_success():
 		public = 2
 		user_id = add_user(username, password, 2)
 
+	if user_id is None:
+		flash("Sorry, the username %s has just been taken, please choose another one." % username)
+		return redirect("/register")
+
 	session["user_id"] = user_id
 	session["username"] = username
 	flash("You have successfully registered, %s." % username)
@@ -512,14 +1067,8 @@ def show_inbox():
 
 	if "user_id" in session:
 		user_id = session["user_id"]
-		threads = check_inbox(user_id)
-		users_talking_to = {}
-		for thread in threads:
-			user = User.query.filter(User.user_id == thread).first()
-			username = user.username
-			connection_id = pair_lookup(user_id, thread)
-			users_talking_to[username] = connection_id
-		return render_template("inbox.html", users_talking_to=users_talking_to)
+		conversations = inbox_conversations(user_id)
+		return render_template("inbox.html", conversations=conversations)
 	else:
 		flash("Please sign in to view your inbox")
 		return redirect("/")
@@ -529,25 +1078,24 @@ def show_inbox():
 def show_message(pair_id):
 	"""For a pair, displays the messages between the two users (if any)"""
 	
-	pair = Pair.query.filter(Pair.pair_id == pair_id).first()
 	if "user_id" in session:
 		user_id = session["user_id"]
-		if which_pair_by_active_user(user_id, pair_id):
-			other_user_id = which_pair_by_active_user(user_id, pair_id)
-			other_user = (User.query.get(other_user_id)).username
-			if user_id == pair.user_1_id or user_id == pair.user_2_id:
-				if get_num_messages_between(pair_id) > 10:
-					num_messages = get_num_messages_between(pair_id)
-					message_history = get_message_history(pair_id)
-					return render_template("specific_message_10_plus.html", message_history=message_history,
-						other_user=other_user, other_user_id=other_user_id, num_messages=num_messages)
-				else:
-					message_history = get_message_history(pair_id)
-					return render_template("specific_message.html", message_history=message_history,
-						other_user=other_user, other_user_id=other_user_id)
+		thread = message_thread_for_user(user_id, pair_id)
+		if thread:
+			other_user_id, other_user, num_messages = thread
+			#the page marks the conversation read with a POST once it is shown, as a GET may
+			#be a browser prefetching the link
+			if num_messages > 10:
+				messages = message_history_page(pair_id)
+				message_history = serialize_messages(messages)
+				cursor = next_cursor(messages, "sent_at", "msg_id", MESSAGE_PAGE_SIZE)
+				return render_template("specific_message_10_plus.html", message_history=message_history,
+					other_user=other_user, other_user_id=other_user_id, num_messages=num_messages,
+					next_cursor=cursor, pair_id=pair_id)
 			else:
-				flash("You do not have access to this page.")
-				return redirect("/")
+				message_history = get_message_history(pair_id)
+				return render_template("specific_message.html", message_history=message_history,
+					other_user=other_user, other_user_id=other_user_id, pair_id=pair_id)
 		else:
 			flash("You do not have access to this page.")
 			return redirect("/")
@@ -556,6 +1104,43 @@ def show_message(pair_id):
 		return redirect("/login")
 
 
+@app.route("/mark-conversation-read-json", methods=["POST"])
+def mark_conversation_read_from_ajax():
+	"""Clears the logged in user's unread messages in a conversation (posted by the message
+	page once it has been shown)"""
+
+	if "user_id" not in session:
+		return Response(status=401)
+	user_id = session["user_id"]
+	try:
+		pair_id = int(request.form.get("pair_id"))
+	except (TypeError, ValueError):
+		return Response(status=400)
+	thread = message_thread_for_user(user_id, pair_id)
+	if thread is None:
+		return Response(status=403)
+	return jsonify({"updated": mark_conversation_read(user_id, thread[0])})
+
+
+@app.route("/delete-message", methods=["POST"])
+def remove_message():
+	"""Deletes one of the logged in user's sent messages, and goes back to the conversation"""
+
+	if "user_id" not in session:
+		flash("Please sign in to access messages.")
+		return redirect("/login")
+	try:
+		msg_id = int(request.form.get("msg_id"))
+		pair_id = int(request.form.get("pair_id"))
+	except (TypeError, ValueError):
+		return Response(status=400)
+	if delete_message(session["user_id"], msg_id):
+		flash("Your message has been deleted.")
+	else:
+		flash("You can only delete messages that you have sent.")
+	return redirect("/message/" + str(pair_id))
+
+
 @app.route("/compose-message")
 def compose_message():
 	"""Shows form to gather information to send a message to a fellow user"""
@@ -563,9 +1148,7 @@ def compose_message():
 	if "user_id" in session:
 		user_id = session["user_id"]
 		user_ids_connected_with = connections(user_id)
-		usernames_connected_with = {}
-		for user_id in user_ids_connected_with:
-			usernames_connected_with[user_id] = (User.query.get(user_id)).username
+		usernames_connected_with = usernames_by_id(user_ids_connected_with)
 		return render_template("compose_message.html", usernames_connected_with=usernames_connected_with)
 	else:
 		flash("Please sign in to compose a message")
@@ -616,9 +1199,7 @@ def submit_reply_message():
 def check_username():
 	"""Route for username validation--checks if a given username is already in the system"""
 	username = request.args.get("username")
-	if User.query.filter(User.username == username.lower()).first():
-		return "exists"
-	elif User.query.filter(User.username == username).first():
+	if username_taken(username):
 		return "exists"
 	else:
 		return "available"
@@ -629,71 +1210,95 @@ def see_all_feed():
 	"""Calls the function that returns the json for 20 most recent public updates"""
 	
 	offset = request.args.get("offset")
-	feed_json = show_feed_all(offset)
-	return jsonify({"results": feed_json})
+	cursor = request.args.get("cursor")
+
+	def build_response():
+		updates = public_updates_page(offset, cursor)
+		return jsonify({"results": serialize_updates(updates),
+			"next_cursor": next_cursor(updates, "posted_at", "update_id")})
+
+	etag, last_modified = public_feed_validators()
+	#the same for every visitor, so served from the response cache
+	return conditional_response(etag, lambda: cached_response("feed-all", [offset, cursor], build_response),
+		last_modified)
 
 
 @app.route("/search-results")
 def search_db():
 	"""Takes in the user's input to conduct a search of the entire database,
-	including users and updates (updates only if content is public)"""
+	including users and updates (updates only if content is public), a page at a time"""
 
-	user_input = (request.args.get("search")).lower()
+	user_input = request.args.get("search", "").strip()
+	page = max(request.args.get("page", 0, type=int), 0)
 
-	matching_users = User.query.filter(func.lower(User.username).like("%"+user_input+"%")).all()
-	public_users = db.session.query(User.user_id).filter(User.is_public == True).all()
-	matching_updates = Update.query.filter(func.lower(Update.update_body).like("%"+user_input+"%"), Update.user_id.in_(public_users)).all()
+	results = search_page(user_input, page)
 
-
-	return render_template("search_results.html", matching_users=matching_users,
-		matching_updates=matching_updates)
+	return render_template("search_results.html", matching_users=results["users"],
+		matching_updates=results["updates"], search=user_input, page=page,
+		more_results=results["more_users"] or results["more_updates"])
 
 @app.route("/profile/<int:user_id>")
 def show_profile(user_id):
 	"""For a given user, shows their profile if the account is public, or if the current user is connected to
 	the user in question. If they are not connected, displays an option to request to connect"""
 
-	
-	user_of_interest = User.query.filter(User.user_id == user_id).first()
-	file_to_check = "static/images/user" + str(user_of_interest.user_id) + ".png"
+	if "user_id" not in session:
+		flash("Please log in to view a user's profile")
+		return redirect ("/")
 
-	if os.path.isfile(file_to_check):
-		picture_url = file_to_check
-	else:
-		picture_url = "static/images/default.png"
-	if "user_id" in session:
-		current_user_id = session["user_id"]
-		if user_of_interest.user_id == current_user_id:
-			updates = all_updates_for_specific_user(user_id)
-			return render_template("user_profile.html", updates=updates, current_user_id=current_user_id, picture_url=picture_url)
-		elif user_of_interest.is_public: 
-			if pair_lookup(user_of_interest.user_id, current_user_id):
-				updates = all_updates_for_specific_user(user_id)
-				return render_template("public_profile_connected.html", user_of_interest=user_of_interest, updates=updates, picture_url=picture_url)
-			elif user_of_interest.username in usernames_behind_connection_requests(get_connection_requests(current_user_id)):
-				connect_id = get_request_id(current_user_id, user_of_interest.user_id)
-				updates = all_updates_for_specific_user(user_id)
-				return render_template("public_profile_requestee.html", user_of_interest=user_of_interest, picture_url=picture_url, connect_id=connect_id, updates=updates)
-			elif session["username"] in usernames_behind_connection_requests(get_connection_requests(user_of_interest.user_id)):
-				updates = all_updates_for_specific_user(user_id)
-				return render_template("public_profile_requested.html", user_of_interest=user_of_interest, picture_url=picture_url, updates=updates)
-			else:
-				updates = all_updates_for_specific_user(user_id)
-				return render_template("public_profile.html", user_of_interest=user_of_interest, updates=updates, picture_url=picture_url)
+	current_user_id = session["user_id"]
+	user_of_interest, (relationship, request_id) = profile_relationship(current_user_id, user_id)
+	if user_of_interest is None:
+		abort(404)
+	picture_url = user_of_interest.picture_url or DEFAULT_PICTURE_URL
+	#only the first page of updates, the rest are fetched from /profile-updates.json on scrolling
+	if relationship == "self":
+		updates = profile_updates_page(user_id)
+		return render_template("user_profile.html", updates=updates, current_user_id=current_user_id, picture_url=picture_url,
+			profile_user_id=user_id, next_cursor=next_cursor(updates, "posted_at", "update_id"))
+	elif user_of_interest.is_public:
+		updates = profile_updates_page(user_id)
+		cursor = next_cursor(updates, "posted_at", "update_id")
+		if relationship == "connected":
+			return render_template("public_profile_connected.html", user_of_interest=user_of_interest, updates=updates, picture_url=picture_url,
+				profile_user_id=user_id, next_cursor=cursor)
+		elif relationship == "request-incoming":
+			return render_template("public_profile_requestee.html", user_of_interest=user_of_interest, picture_url=picture_url, connect_id=request_id, updates=updates,
+				profile_user_id=user_id, next_cursor=cursor)
+		elif relationship == "request-outgoing":
+			return render_template("public_profile_requested.html", user_of_interest=user_of_interest, picture_url=picture_url, updates=updates,
+				profile_user_id=user_id, next_cursor=cursor)
 		else:
-			if pair_lookup(user_of_interest.user_id, current_user_id):
-				updates = all_updates_for_specific_user(user_of_interest.user_id)
-				return render_template("shared_private_profile.html", user_of_interest=user_of_interest, updates=updates, picture_url=picture_url)
-			elif user_of_interest.username in usernames_behind_connection_requests(get_connection_requests(current_user_id)):
-				connect_id = get_request_id(current_user_id, user_of_interest.user_id)
-				return render_template("private_profile_requestee.html", user_of_interest=user_of_interest, picture_url=picture_url, connect_id=connect_id)
-			elif session["username"] in usernames_behind_connection_requests(get_connection_requests(user_of_interest.user_id)):
-				return render_template("private_profile_requested.html", user_of_interest=user_of_interest, picture_url=picture_url)
-			else:
-				return render_template("profile_private.html", user_of_interest=user_of_interest, picture_url=picture_url)
+			return render_template("public_profile.html", user_of_interest=user_of_interest, updates=updates, picture_url=picture_url,
+				profile_user_id=user_id, next_cursor=cursor)
 	else:
-		flash("Please log in to view a user's profile")
-		return redirect ("/")
+		if relationship == "connected":
+			updates = profile_updates_page(user_id)
+			return render_template("shared_private_profile.html", user_of_interest=user_of_interest, updates=updates, picture_url=picture_url,
+				profile_user_id=user_id, next_cursor=next_cursor(updates, "posted_at", "update_id"))
+		elif relationship == "request-incoming":
+			return render_template("private_profile_requestee.html", user_of_interest=user_of_interest, picture_url=picture_url, connect_id=request_id)
+		elif relationship == "request-outgoing":
+			return render_template("private_profile_requested.html", user_of_interest=user_of_interest, picture_url=picture_url)
+		else:
+			return render_template("profile_private.html", user_of_interest=user_of_interest, picture_url=picture_url)
+
+
+@app.route("/profile-updates.json")
+def see_more_profile_updates():
+	"""For ajax uses, grabs a user_id and cursor (or offset) to jsonify the next page of that
+	user's updates, if the current user may see them"""
+
+	if "user_id" not in session:
+		return Response(status=401)
+	user = User.query.get(request.args.get("user_id", 0, type=int))
+	if user is None:
+		return Response(status=404)
+	if not can_see_updates(session["user_id"], user):
+		return Response(status=403)
+	updates = profile_updates_page(user.user_id, request.args.get("offset"), request.args.get("cursor"))
+	return jsonify({"results": serialize_updates(updates),
+		"next_cursor": next_cursor(updates, "posted_at", "update_id")})
 
 
 @app.route("/feed-connects-json")
@@ -703,8 +1308,14 @@ def see_connections_feed():
 
 	user_id = session["user_id"]
 	offset = request.args.get("offset")
-	feed_json = show_feed_connections(offset, user_id)
-	return jsonify({"results": feed_json})
+	cursor = request.args.get("cursor")
+
+	def build_response():
+		updates = connection_updates_page(user_id, offset, cursor)
+		return jsonify({"results": serialize_updates(updates),
+			"next_cursor": next_cursor(updates, "posted_at", "update_id")})
+
+	return conditional_response(connection_feed_validator(user_id), build_response)
 
 
 @app.route("/request-connection/<int:other_user_id>", methods=["POST"])
@@ -768,22 +1379,24 @@ def change_password_success():
 
 @app.route("/older-messages.json")
 def see_more_messages_in_hist():
-	"""For ajax uses, grabs offset and other user_id to jsonify the next messages to show"""
+	"""For ajax uses, grabs cursor (or offset) and other user_id to jsonify the next messages to show"""
 
 	user_id = session["user_id"]
 	other_user_id = request.args.get("other_id")
 	pair_id = pair_lookup(user_id, other_user_id)
 	offset = request.args.get("offset")
-	message_json = get_message_history(pair_id, offset)
-	return jsonify({"results": message_json})
+	cursor = request.args.get("cursor")
+	messages = message_history_page(pair_id, offset, cursor)
+	return jsonify({"results": serialize_messages(messages),
+		"next_cursor": next_cursor(messages, "sent_at", "msg_id", MESSAGE_PAGE_SIZE)})
 
 @app.route("/submit-profile-pic/<int:user_id>", methods=['GET', 'POST'])
 def upload_user_pic(user_id):
-	"""Uploads a user-submitted profile picrture to the static images folder"""
+	"""Turns a user-submitted profile picture into a thumbnail, stores it under a name made
+	from its contents and records its url on the user"""
 	#FMI see http://flask.pocoo.org/docs/0.11/patterns/fileuploads/
 
 	user_id = session["user_id"]
-	to_name = "user" + str(user_id) + ".png"
 
 	if request.method == "POST":
 		if "file" not in request.files:
@@ -794,17 +1407,60 @@ def upload_user_pic(user_id):
 			flash("No selected file")
 			return redirect(request.url)
 		if file and allowed_file(file.filename):
-			filename = secure_filename(file.filename)
-			file.save(os.path.join(UPLOAD_FOLDER, to_name))
+			try:
+				save_profile_picture(user_id, file.stream)
+			except UploadRejected as error:
+				flash(str(error))
 			return redirect("/profile/" + str(user_id))
+		flash("Please upload a .jpg or .png picture")
+	return redirect("/profile/" + str(user_id))
+
+@app.route("/profile-pic", methods=["POST"])
+def stream_user_pic():
+	"""Takes a profile picture sent as the whole request body (by the upload script on the
+	profile page), read a chunk at a time instead of being parsed as a form"""
+
+	if "user_id" not in session:
+		return Response(status=401)
+	try:
+		picture_url = save_profile_picture(session["user_id"], request.stream, request.content_length)
+	except UploadRejected as error:
+		return jsonify({"error": str(error)}), error.status
+	return jsonify({"picture_url": picture_url})
+
+@app.route("/avatars/<filename>")
+def see_avatar(filename):
+	"""Serves a stored profile picture, with headers letting browsers and CDNs keep it for good
+	(a new picture always gets a new name)"""
+
+	response = send_from_directory(images.AVATAR_FOLDER, filename)
+	response.headers["Cache-Control"] = "public, max-age=%d, immutable" % AVATAR_CACHE_SECONDS
+	return response
 
 @app.route("/get-notifications-json")
 def get_notifications_for_ajax():
 	"""Grabs current existing notifications in db for current user to be added via AJAX on front end"""
 
 	user_id = session["user_id"]
-	notifications = find_notifications_not_viewed(user_id)
-	return jsonify({"results": notifications})
+	notifications = notification_bus.pending(user_id)
+	#the pending notifications are already in memory, so the validator costs no query
+	etag = make_etag("notifications", user_id, *[notification_id for notification_id, notification_type in notifications])
+	return conditional_response(etag, lambda: jsonify({"results": notifications}))
+
+
+@app.route("/notifications/stream")
+def stream_notifications():
+	"""Pushes the current user's notifications to the browser as server-sent events, starting
+	with the ones not yet viewed and then each new one as it is added (503 once NOTIFICATION_STREAMS
+	are open, which the browser takes as its cue to poll /get-notifications-json instead)"""
+
+	if "user_id" not in session:
+		return Response(status=401)
+	subscription = notification_bus.subscribe(session["user_id"])
+	if subscription is None:
+		return Response(status=503, headers={"Retry-After": "60"})
+	return Response(notification_events(subscription), mimetype="text/event-stream",
+		headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route("/update-notifications-json", methods=["POST"])
@@ -815,9 +1471,101 @@ def update_notifications_from_ajax():
 	change_notification_to_viewed(notification_id)
 	return "success"
 
-if __name__ == '__main__':
-	app.debug = False
+
+@app.route("/update-notifications-batch-json", methods=["POST"])
+def update_notifications_batch_from_ajax():
+	"""Takes from ajax the ids of all the notifications closed since the last call and
+	updates them to having been viewed in one go"""
+
+	user_id = session["user_id"]
+	try:
+		notification_ids = [int(notification_id) for notification_id in request.form.getlist("notification_ids")]
+	except ValueError:
+		return Response(status=400)
+	updated = mark_notifications_viewed(user_id, notification_ids)
+	return jsonify({"updated": updated})
+
+
+@app.route("/update-all-notifications-json", methods=["POST"])
+def update_all_notifications_from_ajax():
+	"""Updates all of the current user's notifications to having been viewed"""
+
+	user_id = session["user_id"]
+	updated = mark_all_notifications_viewed(user_id)
+	return jsonify({"updated": updated})
+
+
+def stats_allowed():
+	"""Checks whether a request may see this worker's stats: with STATS_TOKEN set, only if
+	it carries the token, and otherwise only if it came from this machine and not through a
+	proxy (which would make every request look local)"""
+
+	token = app.config["STATS_TOKEN"]
+	if token:
+		return hmac.compare_digest(request.headers.get("Authorization", "").encode("utf-8"),
+			("Bearer " + token).encode("utf-8"))
+	return request.remote_addr in ("127.0.0.1", "::1") and "X-Forwarded-For" not in request.headers
+
+
+@app.route("/pool-stats.json")
+def see_pool_stats():
+	"""Reports this worker's database connection pool usage, including how long requests
+	have waited for a connection (for sizing workers against the database's max_connections)"""
+
+	if not stats_allowed():
+		return Response(status=403)
+	stats = pool_status(db.get_engine(app).pool)
+	stats["pid"] = os.getpid()
+	return jsonify(stats)
+
+
+@app.route("/cache-stats.json")
+def see_cache_stats():
+	"""Reports this worker's cache hit, miss and eviction counts"""
+
+	if not stats_allowed():
+		return Response(status=403)
+	return jsonify({"pid": os.getpid(), "response_cache": response_cache.stats(),
+		"social_graph": social_graph.stats(), "username_index": username_index.stats()})
+
+@app.route("/metrics")
+def see_metrics():
+	"""Reports this worker's requests, SQL statements and database time per endpoint, in
+	Prometheus's text format"""
+
+	if not stats_allowed():
+		return Response(status=403)
+	return Response(sql_metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+
+def pool_options(environ):
+	"""Reads the database connection pool settings from environment variables"""
+
+	return {"poolclass": TimedQueuePool,
+		"pool_size": int(environ.get("DB_POOL_SIZE", 5)),
+		"max_overflow": int(environ.get("DB_MAX_OVERFLOW", 10)),
+		"pool_timeout": int(environ.get("DB_POOL_TIMEOUT", 30)),
+		"pool_recycle": int(environ.get("DB_POOL_RECYCLE", 1800))}
+
+def configure_app(environ=os.environ):
+	"""Configures the app (database, connection pool and debug settings) from environment
+	variables and returns it, for WSGI servers and the other entry points. The routes are
+	registered on the one module-level app, so it can only be configured once per process"""
+
+	if app.config.get("CONFIGURED"):
+		raise RuntimeError("the app has already been configured")
+	app.config["CONFIGURED"] = True
+	app.debug = environ.get("FLASK_DEBUG", "0") == "1"
 	app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
-	connect_to_db(app)
-	DebugToolbarExtension(app)
-	app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+	app.config["SQLALCHEMY_ENGINE_OPTIONS"] = pool_options(environ)
+	connect_to_db(app, environ.get("DATABASE_URL", "postgresql:///twitterclone"))
+	if environ.get("DB_POOL_PRE_PING", "1") == "1":
+		install_pre_ping(db.get_engine(app))
+	#the toolbar is only for local development
+	if app.debug:
+		DebugToolbarExtension(app)
+	return app
+
+if __name__ == '__main__':
+	configure_app()
+	#threaded, so that open notification streams don't hold up other requests
+	app.run(host="0.0.0.0", port=5000, threaded=True)
\ No newline at end of file
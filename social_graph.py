@@ -0,0 +1,147 @@
+"""Per-worker cache of the social graph (which users are connected, and by which pair)"""
+
+from array import array
+
+from bisect import bisect_left
+
+from collections import OrderedDict
+
+import threading
+
+import time
+
+
+class Adjacency(object):
+	"""The connections of one user, kept compact: the other users' ids in ascending
+	order, with the pair_id connecting to each at the same position"""
+
+	__slots__ = ["neighbours", "pair_ids", "loaded_at"]
+
+	def __init__(self, edges, loaded_at):
+		"""Takes a list of (other user_id, pair_id) tuples"""
+
+		edges = sorted(edges)
+		self.neighbours = array("i", [neighbour for neighbour, pair_id in edges])
+		self.pair_ids = array("i", [pair_id for neighbour, pair_id in edges])
+		self.loaded_at = loaded_at
+
+	def __len__(self):
+		return len(self.neighbours)
+
+	def pair_with(self, other_id):
+		"""Returns the pair_id connecting to other_id, or None if not connected"""
+
+		position = bisect_left(self.neighbours, other_id)
+		if position < len(self.neighbours) and self.neighbours[position] == other_id:
+			return self.pair_ids[position]
+		return None
+
+	def add(self, other_id, pair_id):
+		"""Adds a connection, keeping the ids in order"""
+
+		position = bisect_left(self.neighbours, other_id)
+		if position < len(self.neighbours) and self.neighbours[position] == other_id:
+			return
+		self.neighbours.insert(position, other_id)
+		self.pair_ids.insert(position, pair_id)
+
+
+class SocialGraphCache(object):
+	"""Least-recently-used map of user_id to Adjacency, filled from the database by
+	loader(user_id) on a miss. The cache holds at most max_edges connections in total,
+	and entries older than ttl seconds are reloaded so that connections made through
+	other workers show up (ttl=None keeps entries until they are evicted)"""
+
+	def __init__(self, loader, max_edges=1000000, ttl=30):
+		self.loader = loader
+		self.max_edges = max_edges
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._entries = OrderedDict()
+		self._edges = 0
+		self._lock = threading.Lock()
+
+	def adjacency(self, user_id):
+		"""Returns the Adjacency for a user, from the cache if possible"""
+
+		user_id = int(user_id)
+		with self._lock:
+			entry = self._entries.pop(user_id, None)
+			if entry is not None and (self.ttl is None or time.time() - entry.loaded_at < self.ttl):
+				#re-inserted at the end, as the most recently used
+				self._entries[user_id] = entry
+				self.hits += 1
+				return entry
+			if entry is not None:
+				self._edges -= max(len(entry), 1)
+			self.misses += 1
+
+		#loaded outside of the lock so that a slow query doesn't hold up other threads
+		entry = Adjacency(self.loader(user_id), time.time())
+		self._store(user_id, entry)
+		return entry
+
+	def _store(self, user_id, entry):
+		"""Adds an entry, evicting the least recently used ones to stay under max_edges"""
+
+		size = max(len(entry), 1)
+		if size > self.max_edges:
+			return
+		with self._lock:
+			previous = self._entries.pop(user_id, None)
+			if previous is not None:
+				self._edges -= max(len(previous), 1)
+			self._entries[user_id] = entry
+			self._edges += size
+			while self._edges > self.max_edges:
+				evicted_id, evicted = self._entries.popitem(last=False)
+				self._edges -= max(len(evicted), 1)
+				self.evictions += 1
+
+	def neighbours(self, user_id):
+		"""Returns a list of the user_ids connected with a user, in ascending order"""
+
+		return list(self.adjacency(user_id).neighbours)
+
+	def pair_id(self, user_1_id, user_2_id):
+		"""Returns the pair_id connecting two users, or None if they aren't connected"""
+
+		return self.adjacency(user_1_id).pair_with(int(user_2_id))
+
+	def add_edge(self, user_1_id, user_2_id, pair_id):
+		"""Records a new connection in any cached entries for either user"""
+
+		with self._lock:
+			for user_id, other_id in [(int(user_1_id), int(user_2_id)), (int(user_2_id), int(user_1_id))]:
+				entry = self._entries.get(user_id)
+				if entry is not None:
+					before = max(len(entry), 1)
+					entry.add(other_id, pair_id)
+					self._edges += max(len(entry), 1) - before
+
+	def invalidate(self, user_id):
+		"""Drops a user's entry so that it is reloaded on next use"""
+
+		with self._lock:
+			entry = self._entries.pop(int(user_id), None)
+			if entry is not None:
+				self._edges -= max(len(entry), 1)
+
+	def clear(self):
+		"""Empties the cache and resets its counters"""
+
+		with self._lock:
+			self._entries.clear()
+			self._edges = 0
+			self.hits = 0
+			self.misses = 0
+			self.evictions = 0
+
+	def stats(self):
+		"""Returns the cache's counters and current size"""
+
+		with self._lock:
+			return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+				"users": len(self._entries), "edges": self._edges}
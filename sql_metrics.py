@@ -0,0 +1,167 @@
+"""Counts the SQL statements each request sends and the time they take, per Flask endpoint,
+through SQLAlchemy's engine events, and reports the totals in Prometheus's text format"""
+
+from sqlalchemy import event
+
+from sqlalchemy.engine import Engine
+
+import re
+
+import threading
+
+import time
+
+
+class StatementBudgetExceeded(AssertionError):
+	"""Raised when a block of code sends more SQL statements than it is allowed"""
+
+
+class StatementScope(object):
+	"""The statements sent, and the time they took, during one request or budget block"""
+
+	def __init__(self, keep_slowest=0):
+		self.statements = 0
+		self.seconds = 0.0
+		self.keep_slowest = keep_slowest
+		self.slowest = []
+
+	def add(self, statement, seconds):
+		self.statements += 1
+		self.seconds += seconds
+		if self.keep_slowest:
+			self.slowest.append((seconds, statement))
+			self.slowest.sort(key=lambda entry: entry[0], reverse=True)
+			del self.slowest[self.keep_slowest:]
+
+
+class SqlMetrics(object):
+	"""Listens to every engine's statements, and adds each one to the scopes open in the
+	thread that sent it: the current request's (between start and finish) and those of any
+	budget blocks. Totals are kept per endpoint, with the keep_slowest slowest statements"""
+
+	def __init__(self, keep_slowest=5):
+		self.keep_slowest = keep_slowest
+		self.endpoints = {}
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._installed = False
+
+	def install(self):
+		"""Starts listening to the statements of every engine (once)"""
+
+		if not self._installed:
+			event.listen(Engine, "before_cursor_execute", self._before_statement)
+			event.listen(Engine, "after_cursor_execute", self._after_statement)
+			self._installed = True
+
+	def _budgets(self):
+		if not hasattr(self._local, "budgets"):
+			self._local.budgets = []
+		return self._local.budgets
+
+	def _before_statement(self, conn, cursor, statement, parameters, context, executemany):
+		conn.info["statement_started_at"] = time.time()
+
+	def _after_statement(self, conn, cursor, statement, parameters, context, executemany):
+		seconds = time.time() - conn.info.pop("statement_started_at", time.time())
+		request_scope = getattr(self._local, "request", None)
+		if request_scope is not None:
+			request_scope.add(statement, seconds)
+		for scope in self._budgets():
+			scope.add(statement, seconds)
+
+	def start(self):
+		"""Opens the scope for a request in this thread (replacing any left open by a request
+		that failed)"""
+
+		self._local.request = StatementScope(self.keep_slowest)
+
+	def finish(self, endpoint):
+		"""Closes the request's scope, adds it to the endpoint's totals and returns it (None if
+		no request was started in this thread)"""
+
+		scope = getattr(self._local, "request", None)
+		if scope is None:
+			return None
+		self._local.request = None
+		with self._lock:
+			totals = self.endpoints.setdefault(endpoint or "unknown", {"requests": 0, "statements": 0,
+				"seconds": 0.0, "max_statements": 0, "slowest": []})
+			totals["requests"] += 1
+			totals["statements"] += scope.statements
+			totals["seconds"] += scope.seconds
+			totals["max_statements"] = max(totals["max_statements"], scope.statements)
+			slowest = totals["slowest"] + scope.slowest
+			slowest.sort(key=lambda entry: entry[0], reverse=True)
+			totals["slowest"] = slowest[:self.keep_slowest]
+		return scope
+
+	def budget(self, max_statements):
+		"""Returns a context manager that raises StatementBudgetExceeded if the code inside it
+		sends more than max_statements statements (for tests)"""
+
+		return StatementBudget(self, max_statements)
+
+	def clear(self):
+		with self._lock:
+			self.endpoints = {}
+
+	def prometheus(self, prefix="updateme_"):
+		"""Returns the totals in Prometheus's text exposition format"""
+
+		with self._lock:
+			endpoints = sorted(self.endpoints.items())
+		lines = []
+		for name, kind, description, key in [
+				("requests_total", "counter", "Requests served", "requests"),
+				("sql_statements_total", "counter", "SQL statements sent", "statements"),
+				("sql_seconds_total", "counter", "Time spent running SQL statements", "seconds"),
+				("sql_statements_per_request_max", "gauge", "Most SQL statements sent by one request", "max_statements")]:
+			lines.append("# HELP %s%s %s, by endpoint" % (prefix, name, description))
+			lines.append("# TYPE %s%s %s" % (prefix, name, kind))
+			for endpoint, totals in endpoints:
+				lines.append('%s%s{endpoint="%s"} %s' % (prefix, name, label_value(endpoint), totals[key]))
+		lines.append("# HELP %ssql_slowest_statement_seconds Slowest SQL statements seen, by endpoint" % prefix)
+		lines.append("# TYPE %ssql_slowest_statement_seconds gauge" % prefix)
+		for endpoint, totals in endpoints:
+			for rank, (seconds, statement) in enumerate(totals["slowest"]):
+				lines.append('%ssql_slowest_statement_seconds{endpoint="%s",rank="%d",statement="%s"} %f' % (prefix,
+					label_value(endpoint), rank + 1, label_value(one_line(statement)), seconds))
+		return "\n".join(lines) + "\n"
+
+
+class StatementBudget(object):
+	"""Context manager counting the statements sent inside it (see SqlMetrics.budget)"""
+
+	def __init__(self, metrics, max_statements):
+		self.metrics = metrics
+		self.max_statements = max_statements
+		self.scope = StatementScope()
+
+	def __enter__(self):
+		self.metrics.install()
+		self.metrics._budgets().append(self.scope)
+		return self.scope
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.metrics._budgets().remove(self.scope)
+		if exc_type is None and self.scope.statements > self.max_statements:
+			raise StatementBudgetExceeded("%d SQL statements sent, %d allowed" % (self.scope.statements,
+				self.max_statements))
+
+
+def one_line(statement, max_length=200):
+	"""Collapses a statement's whitespace and shortens it, for use as a label"""
+
+	statement = re.sub(r"\s+", " ", statement).strip()
+	return statement if len(statement) <= max_length else statement[:max_length - 3] + "..."
+
+def label_value(value):
+	"""Escapes a Prometheus label value"""
+
+	return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def server_timing(scope):
+	"""Formats a request's statements as a Server-Timing header value"""
+
+	return 'db;dur=%.1f;desc="%d SQL statements"' % (scope.seconds * 1000, scope.statements)
@@ -0,0 +1,45 @@
+//Shared by every open page of the site, so that a browser holds one notification stream
+//however many pages it has open: each page is passed every notification the stream brings,
+//and told to poll instead if the server turns the stream away
+
+var ports = [];
+var stream = null;
+var polling = false;
+
+function broadcast(message) {
+	for (var i = 0; i < ports.length; i++) {
+		ports[i].postMessage(message);
+	}
+}
+
+function openStream() {
+	stream = new EventSource("/notifications/stream");
+	stream.addEventListener("notification", function(event) {
+		broadcast({"notification": JSON.parse(event.data)});
+	});
+	stream.onerror = function() {
+		//a dropped connection is retried by the browser, but an error response (e.g. 503 when
+		//the server has no room for more streams) closes the stream for good
+		if (stream.readyState === EventSource.CLOSED) {
+			polling = true;
+			broadcast({"poll": true});
+		}
+	};
+}
+
+onconnect = function(event) {
+	var port = event.ports[0];
+	ports.push(port);
+	port.onmessage = function(message) {
+		if (message.data === "close") {
+			ports.splice(ports.indexOf(port), 1);
+		}
+	};
+	port.start();
+	if (stream === null) {
+		openStream();
+	}
+	else if (polling) {
+		port.postMessage({"poll": true});
+	}
+};
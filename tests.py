@@ -1,11 +1,85 @@
 from server import app
 import server as s 
-from model import User, Update, Comment, Pair, Message, Request, Notification, connect_to_db, db, fake_test_data
+from social_graph import SocialGraphCache
+from notification_bus import NotificationBus
+from db_pool import TimedQueuePool, pool_status
+from passwords import PasswordHasher, password_hasher
+from username_index import BloomFilter, UsernameIndex
+from response_cache import MemoryCache, RedisCache
+from sql_metrics import SqlMetrics, StatementBudgetExceeded
+from images import InvalidImage, make_thumbnail, open_image, store_avatar
+from uploads import UploadRejected, receive_upload
+import images
+from model import (User, Update, Comment, Pair, Message, Request, Notification, TimelineEntry, Conversation,
+	connect_to_db, db, fake_test_data)
+import migrations
+import json
+import fake_users
+import bench_routes
 import unittest
 from flask_sqlalchemy import SQLAlchemy 
 from flask import (Flask, render_template, redirect, request, session, flash, jsonify)
 from passlib.hash import bcrypt
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
 import os.path
+import sqlite3
+import tempfile
+import threading
+from PIL import Image
+from io import BytesIO
+
+#uploaded and stored profile pictures go to temporary folders rather than into the app's own
+images.AVATAR_FOLDER = tempfile.mkdtemp()
+s.app.config["UPLOAD_FOLDER"] = tempfile.mkdtemp()
+
+#the response cache is switched on only by the tests of it, so other tests see fresh responses
+s.app.config["RESPONSE_CACHE_ENABLED"] = False
+
+#most SQL statements each route may send for user 1 (shepard) once the in-process caches are warm
+ROUTE_STATEMENT_BUDGETS = {"/": 0, "/inbox": 1, "/message/1": 4, "/compose-message": 1, "/feed-all-json": 2,
+	"/feed-connects-json": 2, "/profile/1": 2, "/profile/5": 1, "/profile/6": 2, "/update/1": 3, "/review-connection-requests": 1,
+	"/get-notifications-json": 0, "/older-messages.json?other_id=2&offset=5": 2}
+
+
+def picture_file(size=(40, 30), format="PNG", mode="RGB", colour=(200, 30, 30)):
+	"""Makes a picture of one colour in memory, as a file to upload"""
+
+	picture = BytesIO()
+	Image.new(mode, size, colour if mode == "RGB" else colour + (0,)).save(picture, format)
+	picture.seek(0)
+	return picture
+
+
+class CountingStream(object):
+	"""File-like object that keeps count of how many bytes have been read from it"""
+
+	def __init__(self, data):
+		self.data = BytesIO(data)
+		self.bytes_read = 0
+
+	def read(self, size=-1):
+		chunk = self.data.read(size)
+		self.bytes_read += len(chunk)
+		return chunk
+
+
+class QueryCounter(object):
+	"""Counts (and keeps) the SQL statements sent to the database inside a with block (listens
+	on every engine, as the session can stay bound to an engine from an earlier test)"""
+
+	def __enter__(self):
+		self.count = 0
+		self.statements = []
+		event.listen(Engine, "before_cursor_execute", self.count_statement)
+		return self
+
+	def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+		self.count += 1
+		self.statements.append((statement, parameters))
+
+	def __exit__(self, *args):
+		event.remove(Engine, "before_cursor_execute", self.count_statement)
 
 
 class LogicTestCases(unittest.TestCase):
@@ -15,6 +89,7 @@ class LogicTestCases(unittest.TestCase):
 		connect_to_db(app, "postgresql:///twitterclonetest")
 		db.create_all()
 		fake_test_data()
+		s.reset_caches()
 
 	def test_add_user_public(self):
 		self.assertEqual(s.add_user("chakwas", "password", 1), 
@@ -26,6 +101,10 @@ class LogicTestCases(unittest.TestCase):
 			(User.query.filter(User.username == "tali").first()).user_id)
 		self.assertFalse((User.query.filter(User.username == "tali").first()).is_public)
 
+	def test_add_user_taken(self):
+		self.assertIsNone(s.add_user("ShePard", "password", 1))
+		self.assertEqual(User.query.filter(db.func.lower(User.username) == "shepard").count(), 1)
+
 	def test_check_valid_user_credentials(self):
 		self.assertEqual(s.check_user_credentials("shepard", "password123"),
 			(User.query.filter(User.username == "shepard").first()).user_id)
@@ -41,6 +120,21 @@ class LogicTestCases(unittest.TestCase):
 		self.assertEqual(s.submit_update(user_id, "I love the Normandy"), 
 			(Update.query.filter(Update.update_body == "I love the Normandy").first()).update_id)
 
+	def test_submit_update_fans_out_to_timelines(self):
+		update_id = s.submit_update(1, "I love the Normandy")
+		owners = [entry.owner_id for entry in TimelineEntry.query.filter(TimelineEntry.update_id == update_id).order_by(TimelineEntry.owner_id).all()]
+		self.assertEqual(owners, [2, 3, 4])
+
+	def test_submit_update_copies_author_visibility(self):
+		self.assertTrue(Update.query.get(s.submit_update(1, "I love the Normandy")).is_public)
+		self.assertFalse(Update.query.get(s.submit_update(2, "Calibrating")).is_public)
+
+	def test_set_user_visibility(self):
+		s.set_user_visibility(2, True)
+		self.assertTrue(User.query.get(2).is_public)
+		self.assertTrue(Update.query.get(1).is_public)
+		self.assertIn(1, [update[4] for update in s.show_feed_all(0)])
+
 	def test_submit_comment(self):
 		user_id = (User.query.filter(User.username == "garrus").first()).user_id
 		self.assertEqual(s.submit_comment(user_id, 3, "uh whatever you say..."), 
@@ -52,9 +146,54 @@ class LogicTestCases(unittest.TestCase):
 		3: {"comment on": 2, "posted by": "garrus", "posted at": "0:02 UTC on November 11, 2016", "body": "you guys are weird...", "user_id": 2}}
 		self.assertEqual(s.display_comments(2),comments)
 
+	def test_display_comments_single_query(self):
+		with QueryCounter() as counter:
+			s.display_comments(2)
+		self.assertEqual(counter.count, 1)
+
 	def test_check_inbox(self):
 		self.assertEqual(s.check_inbox(2), [1])
 
+	def test_check_inbox_most_recent_first(self):
+		s.add_pair_to_db(1, 5)
+		s.submit_message_to_db(5, 1, "Shepard, join me")
+		self.assertEqual(s.check_inbox(1), [5, 2])
+
+	def test_inbox_conversations_single_query(self):
+		with QueryCounter() as counter:
+			conversations = s.inbox_conversations(1)
+		self.assertEqual(counter.count, 1)
+		self.assertEqual(conversations, [{"user_id": 2, "username": "garrus", "pair_id": 1,
+			"last message at": "0:15 UTC on November 11, 2016", "snippet": "hell yes", "unread": 1}])
+
+	def test_submit_message_updates_conversation(self):
+		s.submit_message_to_db(1, 2, "see you at the citadel")
+		conversation = Conversation.query.filter(Conversation.user_1_id == 1, Conversation.user_2_id == 2).one()
+		self.assertEqual(conversation.last_snippet, "see you at the citadel")
+		self.assertEqual(conversation.last_sender_id, 1)
+		self.assertEqual((conversation.user_1_unread, conversation.user_2_unread), (1, 2))
+
+	def test_first_messages_at_once(self):
+		s.submit_message_to_db(1, 3, "Wrex.")
+		#as if the conversation had been started by the other user's message in the meantime
+		find_conversation = s.find_conversation
+		misses = [None]
+		s.find_conversation = lambda user_1_id, user_2_id: misses.pop() if misses else find_conversation(user_1_id, user_2_id)
+		try:
+			s.submit_message_to_db(3, 1, "Shepard.")
+		finally:
+			s.find_conversation = find_conversation
+		conversation = Conversation.query.filter(Conversation.user_1_id == 1, Conversation.user_2_id == 3).one()
+		self.assertEqual((conversation.message_count, conversation.user_1_unread, conversation.user_2_unread), (2, 1, 1))
+		self.assertEqual(conversation.last_snippet, "Shepard.")
+
+	def test_mark_conversation_read(self):
+		s.mark_conversation_read(2, 1)
+		conversation = Conversation.query.filter(Conversation.user_1_id == 1, Conversation.user_2_id == 2).one()
+		self.assertEqual((conversation.user_1_unread, conversation.user_2_unread), (1, 0))
+		self.assertTrue(Message.query.get(1).read)
+		self.assertFalse(Message.query.get(2).read)
+
 	def test_check_connections(self):
 		self.assertEqual(s.connections(1), [2, 3, 4])
 
@@ -62,6 +201,13 @@ class LogicTestCases(unittest.TestCase):
 		messages = [{'from': u'garrus', 'read': False, 'msg_id': 2, 'to': u'shepard', 'sent at': '0:15 UTC on November 11, 2016', 'message': u'hell yes'}, {'from': u'shepard', 'read': False, 'msg_id': 1, 'to': u'garrus', 'sent at': '0:13 UTC on November 11, 2016', 'message': u'up for another contest on the citadel later?'}]
 		self.assertEqual(s.get_message_history(1), messages)
 
+	def test_get_message_history_queries_do_not_grow_with_messages(self):
+		s.submit_message_to_db(1, 2, "Garrus.")
+		s.submit_message_to_db(2, 1, "Shepard.")
+		with QueryCounter() as counter:
+			s.get_message_history(1)
+		self.assertEqual(counter.count, 2)
+
 	def test_which_pair_by_active_user_when_user_1_in_pair(self):
 		self.assertEqual(s.which_pair_by_active_user(1, 1), 2) 
 
@@ -78,10 +224,45 @@ class LogicTestCases(unittest.TestCase):
 	def test_pair_lookup_does_not_exist(self):
 		self.assertIsNone(s.pair_lookup(4, 2))
 
+	def test_pair_lookup_either_order(self):
+		self.assertEqual(s.pair_lookup(3, 1), 2)
+		self.assertEqual(s.pair_lookup(1, 3), 2)
+		self.assertEqual(s.pair_lookup("3", 1), 2)
+
+	def test_pair_lookup_same_user(self):
+		self.assertIsNone(s.pair_lookup(1, 1))
+
+	def test_pairs_stored_canonically(self):
+		pair = Pair.query.get(s.add_pair_to_db(3, 5))
+		self.assertEqual((pair.user_1_id, pair.user_2_id), (3, 5))
+		self.assertEqual((Pair.query.get(2).user_1_id, Pair.query.get(2).user_2_id), (1, 3))
+
 	def test_show_feed_all(self):
 		all_updates = [[u"shepard", u"anyone want to open this bottle of serrice ice I got for Chakwas with me?", "0:02 UTC on November 11, 2016", 1, 2], [u"jenkins", u"Yay first day at work I'm totally not going to die!", "0:02 UTC on November 11, 2016", 6, 5]]
 		self.assertEqual(s.show_feed_all(0), all_updates)
 
+	def test_show_feed_all_with_cursor(self):
+		for i in range(25):
+			s.submit_update(1, "Shepard out " + str(i))
+		first_page = s.public_updates_page()
+		cursor = s.next_cursor(first_page, "posted_at", "update_id")
+		second_page = s.public_updates_page(cursor=cursor)
+		self.assertEqual(len(first_page), 20)
+		self.assertEqual(len(second_page), 7)
+		self.assertEqual(set(u.update_id for u in first_page) & set(u.update_id for u in second_page), set())
+		self.assertIsNone(s.next_cursor(second_page, "posted_at", "update_id"))
+		self.assertEqual(s.show_feed_all(None, cursor), s.serialize_updates(second_page))
+
+	def test_decode_cursor(self):
+		update = Update.query.get(2)
+		self.assertEqual(s.decode_cursor(s.encode_cursor(update.posted_at, 2)), (update.posted_at, 2))
+		self.assertIsNone(s.decode_cursor("not a cursor"))
+
+	def test_get_message_history_with_cursor(self):
+		newest = Message.query.get(2)
+		cursor = s.encode_cursor(newest.sent_at, newest.msg_id)
+		self.assertEqual([message["msg_id"] for message in s.get_message_history(1, cursor=cursor)], [1])
+
 	def test_all_connections_for_current_user(self):
 		self.assertEqual(s.all_connections_for_current_user(1), [2,3,4])
 
@@ -90,10 +271,36 @@ class LogicTestCases(unittest.TestCase):
 		[u"liara", u"please stop calling me the shadow broker, I'm totally not her--I mean, them...", "0:02 UTC on November 11, 2016", 4, 3]]
 		self.assertEqual(s.show_feed_connections(0, 1), all_updates)
 
+	def test_show_feed_connections_single_query(self):
+		with QueryCounter() as counter:
+			s.show_feed_connections(0, 1)
+		self.assertEqual(counter.count, 1)
+
+	def test_usernames_by_id(self):
+		self.assertEqual(s.usernames_by_id([1, 3]), {1: "shepard", 3: "wrex"})
+		self.assertEqual(s.usernames_by_id([]), {})
+
 	def test_all_updates_for_specific_user(self):
 		updates = Update.query.filter(Update.user_id == 1).all()
 		self.assertEqual(s.all_updates_for_specific_user(1), updates)
 
+	def test_profile_updates_page(self):
+		for i in range(25):
+			s.submit_update(1, "report %d" % i)
+		first_page = s.profile_updates_page(1)
+		self.assertEqual([update.update_body for update in first_page[:2]], ["report 24", "report 23"])
+		self.assertEqual(len(first_page), 20)
+		cursor = s.next_cursor(first_page, "posted_at", "update_id")
+		second_page = s.profile_updates_page(1, cursor=cursor)
+		self.assertEqual([update.update_body for update in second_page[-2:]], ["report 0",
+			"anyone want to open this bottle of serrice ice I got for Chakwas with me?"])
+
+	def test_can_see_updates(self):
+		self.assertTrue(s.can_see_updates(1, User.query.get(1)))
+		self.assertTrue(s.can_see_updates(1, User.query.get(6)))
+		self.assertTrue(s.can_see_updates(1, User.query.get(2)))
+		self.assertFalse(s.can_see_updates(1, User.query.get(5)))
+
 	def test_add_connection_request(self):
 		self.assertEqual(s.add_connection_request(3, 4), 3)
 		self.assertIsNotNone(Request.query.filter(Request.request_id == 3).first())
@@ -102,6 +309,11 @@ class LogicTestCases(unittest.TestCase):
 		self.assertEqual(s.add_pair_to_db(3, 4), 5)
 		self.assertIsNotNone(Pair.query.filter(Pair.pair_id == 5).first())
 
+	def test_add_pair_to_db_backfills_timelines(self):
+		s.add_pair_to_db(3, 4)
+		self.assertIsNotNone(TimelineEntry.query.filter(TimelineEntry.owner_id == 3, TimelineEntry.update_id == 3).first())
+		self.assertEqual(s.show_feed_connections(0, 3)[-1][4], 3)
+
 	def test_get_connection_requests(self):
 		requests = Request.query.filter(Request.requestee_id == 2).all()
 		self.assertEqual(s.get_connection_requests(2), requests)
@@ -113,6 +325,62 @@ class LogicTestCases(unittest.TestCase):
 		requests = Request.query.filter(Request.requestee_id == 2).all()
 		self.assertEqual(s.usernames_behind_connection_requests(requests), ["liara"])
 
+	def test_get_request_id_either_direction(self):
+		self.assertEqual(s.get_request_id(2, 4), 1)
+		self.assertEqual(s.get_request_id(4, 2), 1)
+
+	def test_profile_relationship(self):
+		self.assertEqual(s.profile_relationship(1, 1)[1], ("self", None))
+		self.assertEqual(s.profile_relationship(1, 3)[1], ("connected", None))
+		self.assertEqual(s.profile_relationship(3, 1)[1], ("connected", None))
+		self.assertEqual(s.profile_relationship(1, 6)[1], ("request-incoming", 2))
+		self.assertEqual(s.profile_relationship(6, 1)[1], ("request-outgoing", 2))
+		self.assertEqual(s.profile_relationship(1, 5)[1], ("none", None))
+		self.assertEqual(s.profile_relationship(1, 5)[0].username, "saren")
+		self.assertEqual(s.profile_relationship(1, 99), (None, ("none", None)))
+
+	def test_profile_relationship_one_query(self):
+		for requester_id in [2, 3, 4, 5]:
+			s.add_connection_request(requester_id, 6)
+		with QueryCounter() as counter:
+			self.assertEqual(s.profile_relationship(6, 1)[1], ("request-outgoing", 2))
+		self.assertEqual(counter.count, 1)
+
+	def test_check_user_credentials_rehashes_old_cost(self):
+		user = User.query.get(1)
+		user.password = bcrypt.encrypt("password123", rounds=password_hasher.rounds + 1)
+		db.session.commit()
+		self.assertEqual(s.check_user_credentials("shepard", "password123"), 1)
+		self.assertFalse(password_hasher.needs_rehash(User.query.get(1).password))
+		self.assertTrue(bcrypt.verify("password123", User.query.get(1).password))
+
+	def test_memory_search_updates(self):
+		self.assertEqual([update.update_id for update in s.memory_search.search_updates("Bottle of ice", 0, 20)], [2])
+		self.assertEqual(s.memory_search.search_updates("calibrations", 0, 20), [])
+		self.assertEqual(s.memory_search.search_updates("bottle nihlus", 0, 20), [])
+
+	def test_memory_search_ranking_and_pages(self):
+		s.memory_search.search_updates("work", 0, 20)
+		first = s.submit_update(1, "work work work")
+		second = s.submit_update(3, "back to work")
+		self.assertEqual([update.update_id for update in s.memory_search.search_updates("work", 0, 20)], [first, second, 5])
+		self.assertEqual([update.update_id for update in s.memory_search.search_updates("work", 1, 1)], [second])
+
+	def test_memory_search_follows_visibility(self):
+		s.set_user_visibility(2, True)
+		self.assertEqual([update.update_id for update in s.memory_search.search_updates("calibrations", 0, 20)], [1])
+
+	def test_memory_search_users(self):
+		s.memory_search.search_users("s", 0, 20)
+		s.add_user("Shepard2", "password", 1)
+		self.assertEqual([user.username for user in s.memory_search.search_users("SHE", 0, 20)], ["shepard", "shepard2"])
+		self.assertEqual([user.username for user in s.memory_search.search_users("s", 1, 1)], ["shepard"])
+
+	def test_search_page(self):
+		results = s.search_page("jenkins")
+		self.assertEqual([user.user_id for user in results["users"]], [6])
+		self.assertFalse(results["more_users"])
+
 	def test_change_password(self):
 		new_pass = "n7lady"
 		user_id = 1
@@ -127,12 +395,77 @@ class LogicTestCases(unittest.TestCase):
 	def test_get_num_messages_when_none(self):
 		self.assertEqual(s.get_num_messages_between(3), 0)
 
+	def test_get_num_messages_follows_sends_and_deletes(self):
+		s.submit_message_to_db(1, 2, "Garrus.")
+		self.assertEqual(s.get_num_messages_between(1), 3)
+		self.assertTrue(s.delete_message(2, 2))
+		self.assertEqual(s.get_num_messages_between(1), 2)
+		self.assertTrue(Message.query.get(2).deleted)
+
+	def test_delete_newest_message_updates_inbox(self):
+		self.assertTrue(s.delete_message(2, 2))
+		self.assertEqual(s.inbox_conversations(1), [{"user_id": 2, "username": "garrus", "pair_id": 1,
+			"last message at": "0:13 UTC on November 11, 2016", "snippet": "up for another contest on the citadel later?",
+			"unread": 0}])
+		conversation = Conversation.query.filter(Conversation.user_1_id == 1, Conversation.user_2_id == 2).one()
+		self.assertEqual(conversation.last_sender_id, 1)
+		self.assertEqual((conversation.user_1_unread, conversation.user_2_unread), (0, 1))
+
+	def test_delete_read_message_keeps_unread_count(self):
+		s.mark_conversation_read(1, 2)
+		s.submit_message_to_db(2, 1, "Shepard.")
+		self.assertTrue(s.delete_message(2, 2))
+		self.assertEqual(s.inbox_conversations(1)[0]["unread"], 1)
+		self.assertEqual(s.inbox_conversations(1)[0]["snippet"], "Shepard.")
+
+	def test_delete_last_message_removes_conversation(self):
+		self.assertTrue(s.delete_message(2, 2))
+		self.assertTrue(s.delete_message(1, 1))
+		self.assertEqual(s.inbox_conversations(1), [])
+		self.assertEqual(s.inbox_conversations(2), [])
+		self.assertEqual(s.get_num_messages_between(1), 0)
+
+	def test_delete_message_only_by_sender(self):
+		self.assertFalse(s.delete_message(1, 2))
+		self.assertEqual(s.get_num_messages_between(1), 2)
+
+	def test_message_thread_for_user(self):
+		with QueryCounter() as counter:
+			thread = s.message_thread_for_user(2, 1)
+		self.assertEqual(counter.count, 1)
+		self.assertEqual(thread, (1, "shepard", 2))
+
+	def test_message_thread_for_user_not_in_pair(self):
+		self.assertIsNone(s.message_thread_for_user(1, 4))
+
 	def test_add_notifications(self):
 		self.assertEqual(s.add_notification(1, "msg"), 4)
 
 	def test_change_notification_to_viewed(self):
 		self.assertEqual(s.change_notification_to_viewed(1), True)
 
+	def test_mark_notifications_viewed(self):
+		with QueryCounter() as counter:
+			self.assertEqual(s.mark_notifications_viewed(1, ["1", "2"]), 2)
+		self.assertEqual(len([statement for statement, parameters in counter.statements
+			if statement.startswith("UPDATE")]), 1)
+		self.assertEqual(s.find_notifications_not_viewed(1), [])
+
+	def test_mark_notifications_viewed_only_own(self):
+		self.assertEqual(s.mark_notifications_viewed(2, [1, 2]), 0)
+		self.assertEqual(s.find_notifications_not_viewed(1), [[1, "msg"], [2, "req"]])
+
+	def test_mark_all_notifications_viewed(self):
+		self.assertEqual(s.mark_all_notifications_viewed(1), 2)
+		self.assertEqual(s.find_notifications_not_viewed(1), [])
+
+	def test_add_notification_publishes(self):
+		subscription = s.notification_bus.subscribe(1)
+		s.add_notification(1, "apr")
+		s.notification_bus.unsubscribe(subscription)
+		self.assertEqual(list(subscription.queue.queue), [(1, "msg"), (2, "req"), (4, "apr")])
+		self.assertEqual(s.notification_bus.pending(1), [[1, "msg"], [2, "req"], [4, "apr"]])
+
 	def test_find_notifications_not_viewed(self):
 		notifications = [[1, "msg"], [2, "req"]]
 		self.assertEqual(s.find_notifications_not_viewed(1), notifications)
@@ -146,6 +479,653 @@ class LogicTestCases(unittest.TestCase):
 		db.drop_all()
 
 
+class SocialGraphCacheTestCases(unittest.TestCase):
+	"""Tests the social graph cache on its own, with a dictionary standing in for the pairs table"""
+
+	def setUp(self):
+		self.graph = {1: [(2, 10), (3, 11)], 2: [(1, 10)], 3: [(1, 11)], 4: []}
+		self.loads = []
+		self.cache = SocialGraphCache(self.load, max_edges=3, ttl=None)
+
+	def load(self, user_id):
+		self.loads.append(user_id)
+		return self.graph[user_id]
+
+	def test_neighbours_and_pair_id(self):
+		self.assertEqual(self.cache.neighbours(1), [2, 3])
+		self.assertEqual(self.cache.pair_id(1, 3), 11)
+		self.assertIsNone(self.cache.pair_id(1, 4))
+		self.assertEqual(self.loads, [1])
+		self.assertEqual(self.cache.stats()["hits"], 2)
+		self.assertEqual(self.cache.stats()["misses"], 1)
+
+	def test_least_recently_used_evicted(self):
+		self.cache.neighbours(1)
+		self.cache.neighbours(2)
+		self.cache.neighbours(1)
+		self.cache.neighbours(3)
+		self.assertEqual(self.cache.stats()["evictions"], 1)
+		self.cache.neighbours(1)
+		self.cache.neighbours(2)
+		self.assertEqual(self.loads, [1, 2, 3, 2])
+
+	def test_add_edge_updates_cached_users(self):
+		self.cache.neighbours(4)
+		self.cache.add_edge(4, 3, 12)
+		self.assertEqual(self.cache.pair_id(4, 3), 12)
+		self.assertEqual(self.loads, [4])
+
+	def test_expired_entries_reloaded(self):
+		cache = SocialGraphCache(self.load, ttl=0)
+		cache.neighbours(1)
+		cache.neighbours(1)
+		self.assertEqual(self.loads, [1, 1])
+
+
+class NotificationBusTestCases(unittest.TestCase):
+	"""Tests the notification bus on its own, with a dictionary standing in for the notifications table"""
+
+	def setUp(self):
+		self.notifications = {1: [(1, "msg"), (2, "req")], 2: []}
+		self.loads = []
+		self.bus = NotificationBus(self.load, ttl=None)
+
+	def load(self, user_id):
+		self.loads.append(user_id)
+		return self.notifications[user_id]
+
+	def test_subscribe_starts_with_pending(self):
+		subscription = self.bus.subscribe(1)
+		events = subscription.events(heartbeat=0)
+		self.assertEqual([next(events), next(events), next(events)], [(1, "msg"), (2, "req"), None])
+
+	def test_publish_reaches_subscribers_and_pending(self):
+		self.bus.pending(2)
+		subscription = self.bus.subscribe(2)
+		other_subscription = self.bus.subscribe(1)
+		self.bus.publish(2, 3, "apr")
+		self.assertEqual(next(subscription.events(heartbeat=0)), (3, "apr"))
+		self.assertEqual(self.bus.pending(2), [[3, "apr"]])
+		self.assertEqual(other_subscription.queue.qsize(), 2)
+		self.assertEqual(self.loads, [2, 1])
+
+	def test_viewed_removes_pending(self):
+		self.bus.viewed(1, ["2"])
+		self.assertEqual(self.bus.pending(1), [[1, "msg"], [2, "req"]])
+		self.bus.viewed(1, ["2"])
+		self.assertEqual(self.bus.pending(1), [[1, "msg"]])
+		self.bus.viewed(1)
+		self.assertEqual(self.bus.pending(1), [])
+
+	def test_unsubscribe(self):
+		subscription = self.bus.subscribe(1)
+		self.assertEqual(self.bus.subscriber_count(), 1)
+		self.bus.unsubscribe(subscription)
+		self.assertEqual(self.bus.subscriber_count(), 0)
+
+	def test_subscriptions_limited(self):
+		bus = NotificationBus(self.load, ttl=None, max_subscriptions=1)
+		self.assertIsNotNone(bus.subscribe(1))
+		self.assertIsNone(bus.subscribe(2))
+
+	def test_pending_capped(self):
+		bus = NotificationBus(self.load, ttl=None, max_users=1)
+		bus.pending(1)
+		bus.pending(2)
+		bus.pending(1)
+		self.assertEqual(self.loads, [1, 2, 1])
+
+	def test_missed_catches_up(self):
+		subscription = self.bus.subscribe(1)
+		self.assertEqual(self.bus.missed(subscription), [])
+		self.notifications[1].append((3, "apr"))
+		self.bus.clear()
+		self.assertEqual(self.bus.missed(subscription), [(3, "apr")])
+
+	def test_relayed_to_every_bus(self):
+		relay = FakeRelay()
+		buses = [NotificationBus(self.load, ttl=None, relay=relay) for i in range(2)]
+		subscription = buses[1].subscribe(2)
+		buses[0].publish(2, 3, "apr")
+		self.assertEqual(next(subscription.events(heartbeat=0)), (3, "apr"))
+		buses[0].viewed(2, [3])
+		self.assertEqual(buses[1].pending(2), [])
+		self.assertEqual(buses[1].missed(subscription), [])
+
+
+class FakeRelay(object):
+	"""Stands in for Redis, passing each message straight to every listening bus"""
+
+	def __init__(self):
+		self.receivers = []
+
+	def listen(self, receive):
+		if receive not in self.receivers:
+			self.receivers.append(receive)
+
+	def send(self, message):
+		for receive in self.receivers:
+			receive(json.loads(json.dumps(message)))
+
+
+class UsernameIndexTestCases(unittest.TestCase):
+	"""Tests the username index on its own, with a list standing in for the users table"""
+
+	def setUp(self):
+		self.users = [(1, "shepard"), (2, "Garrus")]
+		self.loads = []
+		self.index = UsernameIndex(self.load, capacity=4, refresh=None)
+
+	def load(self, after_user_id):
+		self.loads.append(after_user_id)
+		return [(user_id, username) for user_id, username in self.users if user_id > after_user_id]
+
+	def test_bloom_filter_has_no_false_negatives(self):
+		bloom = BloomFilter(100)
+		for i in range(100):
+			bloom.add("user%d" % i)
+		self.assertTrue(all("user%d" % i in bloom for i in range(100)))
+		self.assertLess(len([i for i in range(1000) if "other%d" % i in bloom]), 50)
+
+	def test_might_exist_any_case(self):
+		self.assertTrue(self.index.might_exist("SHEPARD"))
+		self.assertTrue(self.index.might_exist("garrus"))
+		self.assertFalse(self.index.might_exist("kasumi"))
+		self.assertEqual(self.loads, [0])
+		self.assertEqual(self.index.stats()["negatives"], 1)
+
+	def test_refresh_loads_only_new_users(self):
+		index = UsernameIndex(self.load, capacity=4, refresh=0, overlap=1)
+		index.might_exist("kasumi")
+		self.users.append((3, "kasumi"))
+		self.assertTrue(index.might_exist("kasumi"))
+		self.assertEqual(self.loads, [0, 1])
+		self.assertEqual(index.stats()["usernames"], 3)
+
+	def test_refresh_finds_users_committed_out_of_order(self):
+		index = UsernameIndex(self.load, capacity=10, refresh=0, overlap=5)
+		self.users.append((4, "kasumi"))
+		index.might_exist("tali")
+		self.users.append((3, "tali"))
+		self.assertTrue(index.might_exist("tali"))
+		self.assertEqual(index.stats()["usernames"], 4)
+
+	def test_full_reload(self):
+		index = UsernameIndex(self.load, capacity=4, refresh=0, overlap=0, full_reload=0)
+		index.might_exist("kasumi")
+		index.might_exist("kasumi")
+		self.assertEqual(self.loads, [0, 0])
+		self.assertEqual(index.stats()["usernames"], 2)
+
+	def test_lookups_answered_during_reload(self):
+		index = UsernameIndex(self.load, capacity=4, refresh=0, full_reload=0)
+		index.might_exist("kasumi")
+		loading = threading.Event()
+		release = threading.Event()
+		def slow_load(after_user_id):
+			loading.set()
+			release.wait(5)
+			return self.load(after_user_id)
+		index.loader = slow_load
+		reload = threading.Thread(target=index.might_exist, args=("tali",))
+		reload.start()
+		try:
+			self.assertTrue(loading.wait(5))
+			#from the filter already loaded, without waiting for the reload
+			self.assertTrue(index.might_exist("shepard"))
+			self.assertFalse(index.might_exist("kasumi"))
+			index.add("kasumi")
+		finally:
+			release.set()
+			reload.join(5)
+		#added while the new filter was being built, and copied into it
+		index.refresh = None
+		self.assertTrue(index.might_exist("kasumi"))
+		self.assertEqual(self.loads, [0, 0])
+
+	def test_rebuilt_when_full(self):
+		self.index.might_exist("kasumi")
+		self.index.add("tali")
+		self.index.add("liara")
+		self.assertEqual(self.index.stats()["usernames"], 4)
+		self.index.add("wrex")
+		self.users.extend([(3, "tali"), (4, "liara"), (5, "wrex")])
+		self.assertTrue(self.index.might_exist("wrex"))
+		self.assertEqual(self.index.stats()["usernames"], 5)
+		self.assertGreater(self.index.stats()["capacity"], 4)
+
+
+class PasswordHasherTestCases(unittest.TestCase):
+	"""Tests password hashing on a worker process and in the calling thread"""
+
+	def setUp(self):
+		self.hasher = PasswordHasher(workers=1, rounds=4)
+
+	def tearDown(self):
+		self.hasher.shutdown()
+
+	def test_hash_and_verify_on_pool(self):
+		hashed = self.hasher.hash("n7lady")
+		self.assertTrue(self.hasher.verify("n7lady", hashed))
+		self.assertFalse(self.hasher.verify("n7ladies", hashed))
+		self.assertIsNotNone(self.hasher._executor)
+
+	def test_hash_and_verify_inline(self):
+		hasher = PasswordHasher(workers=0, rounds=4)
+		self.assertTrue(hasher.verify("n7lady", hasher.hash("n7lady")))
+		self.assertIsNone(hasher._executor)
+
+	def test_needs_rehash(self):
+		self.assertFalse(self.hasher.needs_rehash(self.hasher.hash("n7lady")))
+		self.assertTrue(self.hasher.needs_rehash(self.hasher.hash("n7lady", rounds=5)))
+
+
+class MemoryCacheTestCases(unittest.TestCase):
+	"""Tests the in-memory response cache backend"""
+
+	def setUp(self):
+		self.cache = MemoryCache(max_entries=2, ttl=None)
+
+	def test_get_and_set(self):
+		self.assertIsNone(self.cache.get("feed"))
+		self.cache.set("feed", "[]")
+		self.assertEqual(self.cache.get("feed"), "[]")
+		self.assertEqual((self.cache.stats()["hits"], self.cache.stats()["misses"]), (1, 1))
+
+	def test_least_recently_used_evicted(self):
+		self.cache.set("a", 1)
+		self.cache.set("b", 2)
+		self.cache.get("a")
+		self.cache.set("c", 3)
+		self.assertIsNone(self.cache.get("b"))
+		self.assertEqual(self.cache.get("a"), 1)
+		self.assertEqual(self.cache.stats()["evictions"], 1)
+
+	def test_expired_entries_missed(self):
+		self.cache.set("a", 1, ttl=-1)
+		self.assertIsNone(self.cache.get("a"))
+
+	def test_counters_never_evicted(self):
+		self.assertEqual(self.cache.incr("generation"), 1)
+		for key in ["a", "b", "c"]:
+			self.cache.set(key, 1)
+		self.assertEqual(self.cache.incr("generation"), 2)
+		self.assertEqual(self.cache.counter("generation"), 2)
+		self.assertEqual((self.cache.stats()["hits"], self.cache.stats()["misses"]), (0, 0))
+
+	def test_redis_counters_start_fresh(self):
+		cache = RedisCache(FakeRedis())
+		generation = cache.counter("generation")
+		self.assertGreater(generation, 1)
+		self.assertEqual(cache.incr("generation"), generation + 1)
+		#as if Redis had evicted it
+		cache.delete("generation")
+		self.assertGreater(cache.counter("generation"), generation + 1)
+		self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+
+class FakeRedis(object):
+	"""Stands in for a Redis client, with just the commands RedisCache's counters use"""
+
+	def __init__(self):
+		self.values = {}
+
+	def get(self, key):
+		return self.values.get(key)
+
+	def set(self, key, value, nx=False):
+		if not (nx and key in self.values):
+			self.values[key] = str(value).encode("ascii")
+
+	def incr(self, key):
+		self.values[key] = str(int(self.values.get(key, 0)) + 1).encode("ascii")
+		return int(self.values[key])
+
+	def delete(self, key):
+		self.values.pop(key, None)
+
+
+class SqlMetricsTestCases(unittest.TestCase):
+	"""Tests the counting of SQL statements per request and in budget blocks"""
+
+	def setUp(self):
+		connect_to_db(app, "postgresql:///twitterclonetest")
+		db.create_all()
+		fake_test_data()
+		s.reset_caches()
+		self.metrics = SqlMetrics(keep_slowest=2)
+		self.metrics.install()
+
+	def test_request_totals(self):
+		self.metrics.start()
+		User.query.all()
+		Update.query.all()
+		Pair.query.all()
+		scope = self.metrics.finish("endpoint")
+		self.assertEqual(scope.statements, 3)
+		self.assertEqual(len(scope.slowest), 2)
+		self.assertEqual(self.metrics.endpoints["endpoint"]["statements"], 3)
+		User.query.all()
+		self.assertIsNone(self.metrics.finish("endpoint"))
+		self.assertEqual(self.metrics.endpoints["endpoint"]["requests"], 1)
+
+	def test_budget(self):
+		with self.metrics.budget(1) as scope:
+			User.query.all()
+		self.assertEqual(scope.statements, 1)
+		with self.assertRaises(StatementBudgetExceeded):
+			with self.metrics.budget(1):
+				User.query.all()
+				Update.query.all()
+
+	def tearDown(self):
+		db.session.close()
+		db.drop_all()
+
+
+class ImageTestCases(unittest.TestCase):
+	"""Tests the profile picture thumbnails and their storage"""
+
+	def test_make_thumbnail(self):
+		thumbnail = make_thumbnail(open_image(picture_file((300, 100), mode="RGBA")))
+		self.assertEqual((thumbnail.size, thumbnail.mode), ((256, 256), "RGB"))
+		self.assertEqual(thumbnail.getpixel((128, 128)), (255, 255, 255))
+
+	def test_invalid_pictures(self):
+		with self.assertRaises(InvalidImage):
+			open_image(BytesIO(b"<?php echo 'not a picture'; ?>"))
+		with self.assertRaises(InvalidImage):
+			open_image(picture_file(format="GIF"))
+		truncated = picture_file().getvalue()[:60]
+		with self.assertRaises(InvalidImage):
+			open_image(BytesIO(truncated))
+
+	def test_store_avatar_named_by_content(self):
+		folder = tempfile.mkdtemp()
+		filename = store_avatar(picture_file(), folder)
+		self.assertEqual(store_avatar(picture_file(), folder), filename)
+		other_filename = store_avatar(picture_file(colour=(30, 30, 200)), folder)
+		self.assertNotEqual(other_filename, filename)
+		self.assertEqual(sorted(os.listdir(folder)), sorted([filename, other_filename]))
+		self.assertEqual(Image.open(os.path.join(folder, filename)).format, "JPEG")
+
+
+class UploadTestCases(unittest.TestCase):
+	"""Tests the chunked receiving of uploads"""
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+
+	def test_receive_upload(self):
+		data = picture_file((500, 500)).getvalue()
+		path = receive_upload(CountingStream(data), self.folder, 1024 * 1024)
+		self.assertTrue(path.endswith(".png"))
+		with open(path, "rb") as stored:
+			self.assertEqual(stored.read(), data)
+		self.assertEqual(os.listdir(self.folder), [os.path.basename(path)])
+
+	def test_rejected_from_first_bytes(self):
+		stream = CountingStream(b"<html>" * 100000)
+		with self.assertRaises(UploadRejected) as rejected:
+			receive_upload(stream, self.folder, 1024 * 1024)
+		self.assertEqual(rejected.exception.status, 415)
+		self.assertEqual(stream.bytes_read, 8)
+		self.assertEqual(os.listdir(self.folder), [])
+
+	def test_rejected_when_too_large(self):
+		data = b"\xff\xd8\xff" + b"\0" * (300 * 1024)
+		stream = CountingStream(data)
+		with self.assertRaises(UploadRejected) as rejected:
+			receive_upload(stream, self.folder, 100 * 1024, content_length=len(data))
+		self.assertEqual((rejected.exception.status, stream.bytes_read), (413, 0))
+		with self.assertRaises(UploadRejected):
+			receive_upload(stream, self.folder, 100 * 1024)
+		self.assertTrue(stream.bytes_read < 200 * 1024)
+		self.assertEqual(os.listdir(self.folder), [])
+
+
+class ConnectionPoolTestCases(unittest.TestCase):
+	"""Tests the timed connection pool and pool settings, with sqlite connections standing in for the database"""
+
+	def setUp(self):
+		self.pool = TimedQueuePool(lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=0, timeout=0.01)
+
+	def test_checkouts_recorded(self):
+		connection = self.pool.connect()
+		connection.close()
+		self.pool.connect().close()
+		status = pool_status(self.pool)
+		self.assertEqual(status["checkouts"], 2)
+		self.assertEqual(status["checked_out"], 0)
+		self.assertEqual(status["size"], 1)
+
+	def test_timeouts_recorded(self):
+		connection = self.pool.connect()
+		self.assertRaises(Exception, self.pool.connect)
+		connection.close()
+		self.assertEqual(self.pool.stats.snapshot()["timeouts"], 1)
+		self.assertGreater(self.pool.stats.snapshot()["max_wait_ms"], 0)
+
+	def test_stats_kept_when_recreated(self):
+		self.pool.connect().close()
+		self.assertEqual(self.pool.recreate().stats.snapshot()["checkouts"], 1)
+
+	def test_pool_options(self):
+		options = s.pool_options({"DB_POOL_SIZE": "2", "DB_MAX_OVERFLOW": "0"})
+		self.assertEqual(options["poolclass"], TimedQueuePool)
+		self.assertEqual((options["pool_size"], options["max_overflow"], options["pool_timeout"]), (2, 0, 30))
+
+
+class MigrationTestCases(unittest.TestCase):
+	"""Tests the schema migrations used to bring existing databases up to date"""
+
+	def setUp(self):
+		connect_to_db(app, "postgresql:///twitterclonetest")
+		db.create_all()
+		fake_test_data()
+		s.reset_caches()
+
+	def test_upgrade_on_current_schema(self):
+		self.assertEqual(migrations.upgrade(), [version for version, description, upgrade in migrations.MIGRATIONS])
+		self.assertEqual(migrations.upgrade(), [])
+		self.assertEqual(s.show_feed_connections(0, 1)[0][4], 1)
+
+	def test_upgrade_creates_missing_index(self):
+		db.session.execute("DROP INDEX ix_comments_update_id")
+		db.session.commit()
+		migrations.upgrade()
+		indexes = [index["name"] for index in inspect(db.session.connection()).get_indexes("comments")]
+		self.assertIn("ix_comments_update_id", indexes)
+
+	def test_upgrade_with_duplicate_pairs(self):
+		#as on a database made before pairs had any indexes
+		db.session.execute("DROP INDEX ux_pairs_user_1_id_user_2_id")
+		db.session.execute("DROP INDEX ix_pairs_user_2_id")
+		db.session.execute("INSERT INTO pairs (user_1_id, user_2_id) VALUES (1, 2)")
+		db.session.commit()
+		migrations.upgrade()
+		self.assertEqual(Pair.query.filter(Pair.user_1_id == 1, Pair.user_2_id == 2).count(), 1)
+		indexes = [index["name"] for index in inspect(db.session.connection()).get_indexes("pairs")]
+		self.assertIn("ux_pairs_user_1_id_user_2_id", indexes)
+
+	def tearDown(self):
+		db.session.close()
+		db.drop_all()
+
+
+class SeedingTestCases(unittest.TestCase):
+	"""Tests the bulk seeding of fake data in fake_users.py"""
+
+	def setUp(self):
+		connect_to_db(app, "postgresql:///twitterclonetest")
+		db.create_all()
+		fake_test_data()
+		s.reset_caches()
+
+	def test_username_for(self):
+		self.assertEqual(fake_users.username_for(12, "Mary-Ann"), "maryann12")
+		self.assertEqual(fake_users.username_for(3, u"\u00c9mile"), "mile3")
+		self.assertNotEqual(fake_users.username_for(1, "Al"), fake_users.username_for(11, "Al"))
+
+	def test_seed(self):
+		first_user_id = db.session.query(db.func.max(User.user_id)).scalar() + 1
+		fake_users.seed(20, 30, 15, 10, 5, seed=3, chunk_size=8)
+		users = User.query.filter(User.user_id >= first_user_id).all()
+		self.assertEqual(len(users), 20)
+		self.assertEqual(len(set(user.username for user in users)), 20)
+		self.assertTrue(users[0].validate_password("password123"))
+		self.assertEqual(Update.query.filter(Update.user_id >= first_user_id).count(), 30)
+		self.assertEqual(Message.query.filter(Message.owner_id >= first_user_id).count(), 10)
+		self.assertEqual(Notification.query.filter(Notification.user_id >= first_user_id).count(), 5)
+		pairs = db.session.query(Pair.user_1_id, Pair.user_2_id).filter(Pair.user_1_id >= first_user_id).all()
+		self.assertTrue(0 < len(pairs) <= 15)
+		self.assertTrue(all(user_1_id < user_2_id for user_1_id, user_2_id in pairs))
+		self.assertTrue(Conversation.query.filter(Conversation.user_1_id >= first_user_id).count() > 0)
+
+	def test_seed_is_reproducible(self):
+		job = ("activity", 3, 1, 9, 8, 20, {"updates": 5, "pairs": 5, "messages": 5, "notifications": 5}, "hash", False)
+		self.assertEqual(fake_users.generate_chunk(job), fake_users.generate_chunk(job))
+		self.assertEqual(fake_users.generate_chunk(job[:8] + (True,))["pairs"],
+			fake_users.to_csv(fake_users.generate_chunk(job)["pairs"]))
+
+	def tearDown(self):
+		db.session.close()
+		db.drop_all()
+
+
+class RouteBenchmarkTestCases(unittest.TestCase):
+	"""Tests the route benchmark in bench_routes.py"""
+
+	def setUp(self):
+		connect_to_db(app, "postgresql:///twitterclonetest")
+		db.create_all()
+		fake_test_data()
+		s.reset_caches()
+
+	def test_every_route_runs(self):
+		subjects = bench_routes.pick_subjects()
+		cases = bench_routes.route_cases(subjects, "password123")
+		endpoints = set(rule.endpoint for rule in app.url_map.iter_rules()) - set(["static"])
+		self.assertEqual(bench_routes.benchmarked_endpoints(cases) | bench_routes.SKIPPED_ENDPOINTS, endpoints)
+		results = bench_routes.run_benchmark(subjects, requests=1, warmup=0)
+		self.assertEqual(len(results), len(cases))
+		self.assertEqual([name for name in results if results[name]["errors"]], [])
+		self.assertTrue(all(result["statements"] >= 0 for result in results.values()))
+
+	def test_find_regressions(self):
+		baseline = {"inbox": {"p50": 10.0, "statements": 3.0}, "home": {"p50": 1.0, "statements": 0.0}}
+		results = {"inbox": {"p50": 11.0, "statements": 3.0, "errors": 0},
+			"home": {"p50": 2.5, "statements": 0.0, "errors": 0}}
+		self.assertEqual(bench_routes.find_regressions(results, baseline), [])
+		results["inbox"] = {"p50": 20.0, "statements": 5.0, "errors": 1}
+		self.assertEqual(bench_routes.find_regressions(results, baseline), ["inbox: 1 errors",
+			"inbox: p50 20.0ms, was 10.0ms", "inbox: 5.0 statements per request, was 3.0"])
+
+	def tearDown(self):
+		db.session.close()
+		db.drop_all()
+
+
+class QueryPlanTestCases(unittest.TestCase):
+	"""Checks with EXPLAIN that the queries run by the logic functions can all be answered
+	from an index (with sequential scans switched off, postgres only falls back to one
+	when no index fits)"""
+
+	def setUp(self):
+		connect_to_db(app, "postgresql:///twitterclonetest")
+		if db.session.get_bind().dialect.name != "postgresql":
+			self.skipTest("query plans are only checked against postgres")
+		db.create_all()
+		fake_test_data()
+		s.reset_caches()
+
+	def assertNoSequentialScans(self, function, *args):
+		with QueryCounter() as counter:
+			function(*args)
+		connection = db.session.connection()
+		connection.execute("SET LOCAL enable_seqscan = off")
+		for statement, parameters in counter.statements:
+			if not statement.lstrip().upper().startswith("SELECT"):
+				continue
+			plan = "\n".join(row[0] for row in connection.execute("EXPLAIN " + statement, parameters))
+			self.assertNotIn("Seq Scan", plan, "%s falls back to a sequential scan:\n%s\n%s"
+				% (function.__name__, statement, plan))
+
+	def assertCursorPageFromIndex(self, function, *args):
+		"""Checks that the page query run by function starts from the cursor's position in an
+		index and reads the rows already in order (with sorts and bitmap scans switched off too,
+		postgres only sorts or filters the whole list when no index fits)"""
+
+		with QueryCounter() as counter:
+			rows = function(*args)
+		self.assertTrue(rows)
+		connection = db.session.connection()
+		for setting in ["enable_seqscan", "enable_sort", "enable_bitmapscan"]:
+			connection.execute("SET LOCAL %s = off" % setting)
+		pages = [(statement, parameters) for statement, parameters in counter.statements if "LIMIT" in statement]
+		self.assertEqual(len(pages), 1)
+		plan = "\n".join(row[0] for row in connection.execute("EXPLAIN " + pages[0][0], pages[0][1]))
+		#a Merge Append of ordered ranges lists a "Sort Key" too, but isn't a sort
+		self.assertNotRegexpMatches(plan, r"(?m)(^|->)\s*(Incremental )?Sort\s+\(", "%s sorts its rows:\n%s" % (function.__name__, plan))
+		self.assertRegexpMatches(plan, r"Index Cond: .*(posted_at|sent_at) <=", "%s doesn't start from the cursor:\n%s"
+			% (function.__name__, plan))
+		return plan
+
+	def test_cursor_page_plans(self):
+		for minute in range(25):
+			s.submit_update(1, "day %d at work" % minute)
+		first_page = s.public_updates_page()
+		self.assertCursorPageFromIndex(s.public_updates_page, 0, s.next_cursor(first_page, "posted_at", "update_id"))
+		first_page = s.connection_updates_page(2)
+		self.assertCursorPageFromIndex(s.connection_updates_page, 2, 0, s.next_cursor(first_page, "posted_at", "update_id"))
+		first_page = s.profile_updates_page(1)
+		self.assertCursorPageFromIndex(s.profile_updates_page, 1, 0, s.next_cursor(first_page, "posted_at", "update_id"))
+
+	def test_message_cursor_page_plan(self):
+		for i in range(12):
+			s.submit_message_to_db(1 + i % 2, 2 - i % 2, "message %d" % i)
+		first_page = s.message_history_page(1)
+		plan = self.assertCursorPageFromIndex(s.message_history_page, 1, 0,
+			s.next_cursor(first_page, "sent_at", "msg_id", s.MESSAGE_PAGE_SIZE))
+		#one range for each direction of the conversation
+		self.assertEqual(plan.count("sent_at <="), 2, plan)
+
+	def test_feed_plans(self):
+		self.assertNoSequentialScans(s.show_feed_all, 0)
+		self.assertNoSequentialScans(s.show_feed_connections, 0, 1)
+		self.assertNoSequentialScans(s.all_updates_for_specific_user, 1)
+		self.assertNoSequentialScans(s.profile_updates_page, 1)
+
+	def test_comment_plans(self):
+		self.assertNoSequentialScans(s.display_comments, 2)
+
+	def test_message_plans(self):
+		self.assertNoSequentialScans(s.check_inbox, 1)
+		self.assertNoSequentialScans(s.get_message_history, 1)
+		self.assertNoSequentialScans(s.get_num_messages_between, 1)
+
+	def test_validator_plans(self):
+		self.assertNoSequentialScans(s.public_feed_validators)
+		self.assertNoSequentialScans(s.connection_feed_validator, 1)
+
+	def test_search_plans(self):
+		self.assertNoSequentialScans(s.postgres_search.search_updates, "bottle", 0, 20)
+		self.assertNoSequentialScans(s.postgres_search.search_users, "she", 0, 20)
+
+	def test_connection_plans(self):
+		self.assertNoSequentialScans(s.connections, 1)
+		self.assertNoSequentialScans(s.pair_lookup, 1, 2)
+		self.assertNoSequentialScans(s.get_connection_requests, 2)
+		self.assertNoSequentialScans(s.get_request_id, 2, 4)
+
+	def test_notification_plans(self):
+		self.assertNoSequentialScans(s.find_notifications_not_viewed, 1)
+
+	def tearDown(self):
+		db.session.close()
+		db.drop_all()
+
+
 class RouteTestCasesSession(unittest.TestCase):
 	"""Tests flask route functions in server that use session keys/rely on session keys to know to redirect"""
 
@@ -153,6 +1133,7 @@ class RouteTestCasesSession(unittest.TestCase):
 		connect_to_db(app, "postgresql:///twitterclonetest")
 		db.create_all()
 		fake_test_data()
+		s.reset_caches()
 		self.client = s.app.test_client()
 		s.app.config['TESTING'] = True
 		s.app.config["SECRET_KEY"] = "masseffectrulez"
@@ -203,6 +1184,45 @@ class RouteTestCasesSession(unittest.TestCase):
 		self.assertIn("up for another contest on the citadel later?", result.data)
 		self.assertIn("hell yes", result.data)
 
+	def test_show_message_leaves_conversation_unread(self):
+		self.client.get("/message/1")
+		self.assertFalse(Message.query.get(2).read)
+		result = self.client.post("/mark-conversation-read-json", data={"pair_id": "1"})
+		self.assertIn('"updated": true', result.data)
+		self.assertTrue(Message.query.get(2).read)
+
+	def test_mark_conversation_read_not_in_pair(self):
+		self.assertEqual(self.client.post("/mark-conversation-read-json", data={"pair_id": "4"}).status_code, 403)
+		self.assertEqual(self.client.post("/mark-conversation-read-json", data={"pair_id": "x"}).status_code, 400)
+
+	def test_delete_message_route(self):
+		result = self.client.get("/message/1")
+		self.assertIn('name="msg_id" value="1"', result.data)
+		self.assertNotIn('name="msg_id" value="2"', result.data)
+		result = self.client.post("/delete-message", data={"msg_id": "1", "pair_id": "1"}, follow_redirects=True)
+		self.assertIn("Your message has been deleted.", result.data)
+		self.assertNotIn("up for another contest on the citadel later?", result.data)
+		result = self.client.post("/delete-message", data={"msg_id": "2", "pair_id": "1"}, follow_redirects=True)
+		self.assertIn("You can only delete messages that you have sent.", result.data)
+		self.assertFalse(Message.query.get(2).deleted)
+
+	def test_show_message_more_than_10_messages(self):
+		for i in range(10):
+			s.submit_message_to_db(1, 2, "message " + str(i))
+		result = self.client.get("/message/1")
+		self.assertIn("See More Messages", result.data)
+		self.assertIn("message 9", result.data)
+		self.assertNotIn("message 0", result.data)
+
+	def test_older_messages_json_with_cursor(self):
+		for i in range(10):
+			s.submit_message_to_db(1, 2, "message " + str(i))
+		first_page = s.message_history_page(1)
+		cursor = s.next_cursor(first_page, "sent_at", "msg_id", s.MESSAGE_PAGE_SIZE)
+		result = self.client.get("/older-messages.json", query_string={"cursor": cursor, "other_id": 2})
+		self.assertIn("message 4", result.data)
+		self.assertNotIn("message 5", result.data)
+
 	def test_show_message_logged_in_not_in_pair(self):
 		result = self.client.get("/message/4")
 		self.assertIn("Redirecting..", result.data)
@@ -236,6 +1256,9 @@ class RouteTestCasesSession(unittest.TestCase):
 		result = self.client.get("/profile/2")
 		self.assertIn("You are currently connected with", result.data)
 
+	def test_view_missing_profile(self):
+		self.assertEqual(self.client.get("/profile/99").status_code, 404)
+
 	def test_view_private_profile_not_connected(self):
 		result = self.client.get("/profile/5")
 		self.assertNotIn("You are currently connected with", result.data)
@@ -267,16 +1290,237 @@ class RouteTestCasesSession(unittest.TestCase):
 
 	def test_feed_json_connections(self):
 		result = self.client.get("/feed-connects-json")
-		self.assertEqual('{\n  "results": [\n    [\n      "garrus", \n      "just in the middle of some calibrations", \n      "0:02 UTC on November 11, 2016", \n      2, \n      1\n    ], \n    [\n      "liara", \n      "please stop calling me the shadow broker, I\'m totally not her--I mean, them...", \n      "0:02 UTC on November 11, 2016", \n      4, \n      3\n    ]\n  ]\n}\n', result.data)
+		self.assertEqual('{\n  "next_cursor": null, \n  "results": [\n    [\n      "garrus", \n      "just in the middle of some calibrations", \n      "0:02 UTC on November 11, 2016", \n      2, \n      1\n    ], \n    [\n      "liara", \n      "please stop calling me the shadow broker, I\'m totally not her--I mean, them...", \n      "0:02 UTC on November 11, 2016", \n      4, \n      3\n    ]\n  ]\n}\n', result.data)
 
 	def test_get_notifications_for_ajax_when_exist(self):
 		result = self.client.get("/get-notifications-json")
 		self.assertEqual('{\n  "results": [\n    [\n      1, \n      "msg"\n    ], \n    [\n      2, \n      "req"\n    ]\n  ]\n}\n', result.data)
 
+	def test_get_notifications_for_ajax_from_bus(self):
+		self.client.get("/get-notifications-json")
+		with QueryCounter() as counter:
+			result = self.client.get("/get-notifications-json")
+		self.assertEqual(counter.count, 0)
+		self.assertIn('"req"', result.data)
+
+	def test_stream_notifications(self):
+		result = self.client.get("/notifications/stream")
+		self.assertEqual(result.mimetype, "text/event-stream")
+		chunks = iter(result.response)
+		self.assertEqual(next(chunks), b"retry: 5000\n\n")
+		self.assertEqual(next(chunks), b'id: 1\nevent: notification\ndata: [1, "msg"]\n\n')
+		self.assertEqual(s.notification_bus.subscriber_count(), 1)
+		result.close()
+		self.assertEqual(s.notification_bus.subscriber_count(), 0)
+
+	def test_stream_heartbeat_returns_connection(self):
+		checked_out = [0]
+		pool = db.get_engine(app).pool
+		def checkout(*args):
+			checked_out[0] += 1
+		def checkin(*args):
+			checked_out[0] -= 1
+		subscription = s.notification_bus.subscribe(1)
+		chunks = s.notification_events(subscription, heartbeat=0)
+		self.assertEqual(next(chunks), "retry: 5000\n\n")
+		#as after the request's teardown, with the heartbeat's check reloading from the database
+		db.session.remove()
+		s.notification_bus.clear()
+		event.listen(pool, "checkout", checkout)
+		event.listen(pool, "checkin", checkin)
+		try:
+			chunk = next(chunks)
+			while chunk != ": heartbeat\n\n":
+				chunk = next(chunks)
+		finally:
+			event.remove(pool, "checkout", checkout)
+			event.remove(pool, "checkin", checkin)
+			chunks.close()
+		self.assertEqual(checked_out, [0])
+		self.assertEqual(s.notification_bus.subscriber_count(), 0)
+
+	def test_stream_notifications_when_full(self):
+		s.notification_bus.max_subscriptions = 0
+		try:
+			result = self.client.get("/notifications/stream")
+		finally:
+			s.notification_bus.max_subscriptions = s.NOTIFICATION_STREAMS
+		self.assertEqual(result.status_code, 503)
+
+	def test_profile_updates_json(self):
+		for minute in range(25):
+			s.submit_update(6, "day %d at work" % minute)
+		result = self.client.get("/profile/6")
+		self.assertEqual(result.data.count("at work"), 20)
+		self.assertIn('id="profile-cursor"', result.data)
+		cursor = s.next_cursor(s.profile_updates_page(6), "posted_at", "update_id")
+		page = json.loads(self.client.get("/profile-updates.json?user_id=6&cursor=" + cursor).data)
+		self.assertEqual(len(page["results"]), 6)
+		self.assertIsNone(page["next_cursor"])
+		self.assertEqual(self.client.get("/profile-updates.json?user_id=5").status_code, 403)
+		self.assertEqual(self.client.get("/profile-updates.json?user_id=99").status_code, 404)
+
+	def test_route_statement_budgets(self):
+		for path, budget in sorted(ROUTE_STATEMENT_BUDGETS.items()):
+			self.client.get(path)
+			with s.sql_metrics.budget(budget):
+				self.assertEqual(self.client.get(path).status_code, 200)
+
+	def test_metrics(self):
+		s.sql_metrics.clear()
+		self.client.get("/inbox")
+		self.client.get("/inbox")
+		result = self.client.get("/metrics")
+		self.assertIn('updateme_requests_total{endpoint="show_inbox"} 2', result.data)
+		self.assertIn('updateme_sql_statements_per_request_max{endpoint="show_inbox"}', result.data)
+		self.assertIn('updateme_sql_slowest_statement_seconds{endpoint="show_inbox",rank="1",statement="SELECT',
+			result.data)
+
+	def test_server_timing_header(self):
+		self.assertNotIn("Server-Timing", self.client.get("/inbox").headers)
+		s.app.config["SERVER_TIMING"] = True
+		try:
+			self.assertIn("SQL statements", self.client.get("/inbox").headers["Server-Timing"])
+		finally:
+			s.app.config["SERVER_TIMING"] = False
+
+	def test_feed_all_json_cached(self):
+		s.app.config["RESPONSE_CACHE_ENABLED"] = True
+		try:
+			first = self.client.get("/feed-all-json").data
+			with QueryCounter() as counter:
+				second = self.client.get("/feed-all-json").data
+			#only the lookup of the feed's validators
+			self.assertEqual(counter.count, 1)
+			self.assertEqual(first, second)
+			s.submit_update(2, "private calibrations")
+			self.assertEqual(self.client.get("/feed-all-json").data, first)
+			s.submit_update(1, "public calibrations")
+			self.assertIn("public calibrations", self.client.get("/feed-all-json").data)
+			self.assertEqual(s.response_cache.stats()["hits"], 2)
+		finally:
+			s.app.config["RESPONSE_CACHE_ENABLED"] = False
+
+	def test_feed_all_json_not_modified(self):
+		etag = self.client.get("/feed-all-json").headers["ETag"]
+		with QueryCounter() as counter:
+			result = self.client.get("/feed-all-json", headers={"If-None-Match": etag})
+		self.assertEqual(result.status_code, 304)
+		self.assertEqual(counter.count, 1)
+		s.submit_update(1, "calibrations")
+		result = self.client.get("/feed-all-json", headers={"If-None-Match": etag})
+		self.assertEqual(result.status_code, 200)
+		self.assertNotEqual(result.headers["ETag"], etag)
+
+	def test_feed_all_json_etag_changes_with_same_time_update(self):
+		newest = Update.query.filter(Update.is_public == True).order_by(Update.posted_at.desc()).first()
+		etag = self.client.get("/feed-all-json").headers["ETag"]
+		db.session.add(Update(user_id=1, update_body="at the same moment", posted_at=newest.posted_at, is_public=True))
+		db.session.commit()
+		result = self.client.get("/feed-all-json", headers={"If-None-Match": etag})
+		self.assertEqual(result.status_code, 200)
+
+	def test_feed_all_json_etag_changes_with_visibility(self):
+		etag = self.client.get("/feed-all-json").headers["ETag"]
+		s.set_user_visibility(3, False)
+		result = self.client.get("/feed-all-json", headers={"If-None-Match": etag})
+		self.assertEqual(result.status_code, 200)
+
+	def test_feed_all_json_if_modified_since(self):
+		last_modified = self.client.get("/feed-all-json").headers["Last-Modified"]
+		result = self.client.get("/feed-all-json", headers={"If-Modified-Since": last_modified})
+		self.assertEqual(result.status_code, 304)
+		result = self.client.get("/feed-all-json", headers={"If-Modified-Since": "Thu, 10 Nov 2016 00:00:00 GMT"})
+		self.assertEqual(result.status_code, 200)
+
+	def test_feed_connects_json_not_modified(self):
+		etag = self.client.get("/feed-connects-json").headers["ETag"]
+		self.assertEqual(self.client.get("/feed-connects-json", headers={"If-None-Match": etag}).status_code, 304)
+		s.add_pair_to_db(1, 6)
+		self.assertEqual(self.client.get("/feed-connects-json", headers={"If-None-Match": etag}).status_code, 200)
+
+	def test_get_notifications_not_modified(self):
+		etag = self.client.get("/get-notifications-json").headers["ETag"]
+		with QueryCounter() as counter:
+			result = self.client.get("/get-notifications-json", headers={"If-None-Match": etag})
+		self.assertEqual(result.status_code, 304)
+		self.assertEqual(counter.count, 0)
+		s.mark_notifications_viewed(1, [2])
+		self.assertEqual(self.client.get("/get-notifications-json", headers={"If-None-Match": etag}).status_code, 200)
+
+	def test_cache_stats(self):
+		result = self.client.get("/cache-stats.json")
+		self.assertIn('"response_cache"', result.data)
+
+	def test_pool_stats(self):
+		result = self.client.get("/pool-stats.json")
+		self.assertIn('"pid": %d' % os.getpid(), result.data)
+
+	def test_stats_only_local(self):
+		for path in ["/pool-stats.json", "/cache-stats.json", "/metrics"]:
+			self.assertEqual(self.client.get(path, environ_base={"REMOTE_ADDR": "203.0.113.7"}).status_code, 403)
+			self.assertEqual(self.client.get(path, headers={"X-Forwarded-For": "203.0.113.7"}).status_code, 403)
+
+	def test_stats_with_token(self):
+		s.app.config["STATS_TOKEN"] = "secret"
+		try:
+			remote = {"REMOTE_ADDR": "203.0.113.7"}
+			self.assertEqual(self.client.get("/metrics", environ_base=remote).status_code, 403)
+			self.assertEqual(self.client.get("/metrics", environ_base=remote,
+				headers={"Authorization": "Bearer wrong"}).status_code, 403)
+			self.assertEqual(self.client.get("/metrics", environ_base=remote,
+				headers={"Authorization": "Bearer secret"}).status_code, 200)
+		finally:
+			s.app.config["STATS_TOKEN"] = None
+
+	def test_configure_app_only_once(self):
+		s.app.config["CONFIGURED"] = True
+		try:
+			self.assertRaises(RuntimeError, s.configure_app, {})
+		finally:
+			del s.app.config["CONFIGURED"]
+
+	def test_update_notifications_batch(self):
+		result = self.client.post("/update-notifications-batch-json", data={"notification_ids": ["1", "2", "3"]})
+		self.assertIn('"updated": 2', result.data)
+		self.assertFalse(Notification.query.get(3).viewed)
+
+	def test_update_notifications_batch_bad_id(self):
+		result = self.client.post("/update-notifications-batch-json", data={"notification_ids": ["1", "one"]})
+		self.assertEqual(result.status_code, 400)
+		self.assertFalse(Notification.query.get(1).viewed)
+
+	def test_update_all_notifications(self):
+		result = self.client.post("/update-all-notifications-json")
+		self.assertIn('"updated": 2', result.data)
+		self.assertEqual(s.find_notifications_not_viewed(1), [])
+
 	def test_upload_user_pic_when_valid(self):
-		result = self.client.post("/submit-profile-pic/1", data={"file":"img.png"})
-		file_to_check = "static/images/user" + str(1) + ".png"
-		self.assertTrue(os.path.isfile(file_to_check))
+		result = self.client.post("/submit-profile-pic/1", data={"file": (picture_file(), "img.png")})
+		picture_url = User.query.get(1).picture_url
+		self.assertTrue(picture_url.startswith("/avatars/"))
+		self.assertTrue(os.path.isfile(os.path.join(images.AVATAR_FOLDER, picture_url[len("/avatars/"):])))
+		self.assertIn('src="%s"' % picture_url, self.client.get("/profile/1").data)
+		avatar = self.client.get(picture_url)
+		self.assertEqual(avatar.status_code, 200)
+		self.assertIn("immutable", avatar.headers["Cache-Control"])
+
+	def test_stream_user_pic(self):
+		result = self.client.post("/profile-pic", data=picture_file().getvalue(), content_type="image/png")
+		self.assertEqual(result.status_code, 200)
+		self.assertEqual(json.loads(result.data)["picture_url"], User.query.get(1).picture_url)
+		result = self.client.post("/profile-pic", data=b"MZ not a picture", content_type="image/png")
+		self.assertEqual(result.status_code, 415)
+		result = self.client.post("/profile-pic", data=b"\x89PNG\r\n\x1a\n but cut short", content_type="image/png")
+		self.assertEqual(result.status_code, 415)
+		#the uploads are only spooled to disk while their thumbnails are made
+		self.assertEqual(os.listdir(s.app.config["UPLOAD_FOLDER"]), [])
+
+	def test_upload_user_pic_not_a_picture(self):
+		result = self.client.post("/submit-profile-pic/1", data={"file": (BytesIO(b"GIF89a not really"), "img.png")})
+		self.assertIn("Redirecting..", result.data)
+		self.assertIsNone(User.query.get(1).picture_url)
+		self.assertIn('src="/static/images/default.png"', self.client.get("/profile/1").data)
 
 	def tearDown(self):
 		db.session.close()
@@ -290,6 +1534,7 @@ class RouteTestCasesSessionVersion2(unittest.TestCase):
 		connect_to_db(app, "postgresql:///twitterclonetest")
 		db.create_all()
 		fake_test_data()
+		s.reset_caches()
 		self.client = s.app.test_client()
 		s.app.config['TESTING'] = True
 		s.app.config["SECRET_KEY"] = "masseffectrulez"
@@ -330,10 +1575,15 @@ class RouteTestCasesNoSession(unittest.TestCase):
 		connect_to_db(app, "postgresql:///twitterclonetest")
 		db.create_all()
 		fake_test_data()
+		s.reset_caches()
 		self.client = s.app.test_client()
 		s.app.config['TESTING'] = True
 		s.app.config["SECRET_KEY"] = "masseffectrulez"
 
+	def test_stream_notifications_no_session(self):
+		result = self.client.get("/notifications/stream")
+		self.assertEqual(result.status_code, 401)
+
 	def test_index_route(self):
 		result = self.client.get("/")
 		self.assertIn("<h1>My Feed</h1>", result.data)
@@ -354,6 +1604,13 @@ class RouteTestCasesNoSession(unittest.TestCase):
 		self.assertIsNotNone(User.query.filter(User.username == "aria").first())
 		self.assertTrue((User.query.filter(User.username == "aria").first()).is_public)
 
+	def test_register_success_route_username_taken(self):
+		result = self.client.post("/register-success", data={"username":"garrus", "password":"calibrations", "is_public":"1"},
+			follow_redirects=True)
+		self.assertIn("the username garrus has just been taken", result.data)
+		with self.client.session_transaction() as sess:
+			self.assertNotIn("user_id", sess)
+
 	def test_login_route(self):
 		result = self.client.get("/login")
 		self.assertIn("<h1>Log In</h1>", result.data)
@@ -390,13 +1647,29 @@ class RouteTestCasesNoSession(unittest.TestCase):
 
 	def test_feed_all_json(self):
 		result = self.client.get("/feed-all-json")
-		self.assertEqual('{\n  "results": [\n    [\n      "shepard", \n      "anyone want to open this bottle of serrice ice I got for Chakwas with me?", \n      "0:02 UTC on November 11, 2016", \n      1, \n      2\n    ], \n    [\n      "jenkins", \n      "Yay first day at work I\'m totally not going to die!", \n      "0:02 UTC on November 11, 2016", \n      6, \n      5\n    ]\n  ]\n}\n', result.data)
+		self.assertEqual('{\n  "next_cursor": null, \n  "results": [\n    [\n      "shepard", \n      "anyone want to open this bottle of serrice ice I got for Chakwas with me?", \n      "0:02 UTC on November 11, 2016", \n      1, \n      2\n    ], \n    [\n      "jenkins", \n      "Yay first day at work I\'m totally not going to die!", \n      "0:02 UTC on November 11, 2016", \n      6, \n      5\n    ]\n  ]\n}\n', result.data)
 
 	def test_search_results(self):
 		result = self.client.get("/search-results", query_string={"search":"shepard"})
 		self.assertIn("Users with usernames matching your search:", result.data)
 		self.assertIn("shepard", result.data)
 
+	def test_search_results_pages(self):
+		for i in range(s.SEARCH_PAGE_SIZE + 1):
+			s.submit_update(1, "calibrations number %d" % i)
+		result = self.client.get("/search-results", query_string={"search": "calibrations"})
+		self.assertIn("More results", result.data)
+		self.assertNotIn("Previous results", result.data)
+		result = self.client.get("/search-results", query_string={"search": "calibrations", "page": 1})
+		self.assertIn("Previous results", result.data)
+		self.assertNotIn("More results", result.data)
+
+	def test_stream_user_pic_not_logged_in(self):
+		self.assertEqual(self.client.post("/profile-pic", data=picture_file().getvalue()).status_code, 401)
+
+	def test_profile_updates_json_not_logged_in(self):
+		self.assertEqual(self.client.get("/profile-updates.json?user_id=1").status_code, 401)
+
 	def test_view_profile_not_logged_in(self):
 		result = self.client.get("/profile/1")
 		self.assertIn("Redirecting..", result.data)
@@ -406,6 +1679,26 @@ class RouteTestCasesNoSession(unittest.TestCase):
 		result = self.client.get("/check-username", query_string={"username":"kasumi"})
 		self.assertIn("available", result.data)
 
+	def test_check_username_available_without_query(self):
+		self.client.get("/check-username", query_string={"username": "shepard"})
+		with QueryCounter() as counter:
+			result = self.client.get("/check-username", query_string={"username": "kasumi"})
+		self.assertIn("available", result.data)
+		self.assertEqual(counter.count, 0)
+
+	def test_check_username_taken_any_case(self):
+		self.client.get("/check-username", query_string={"username": "kasumi"})
+		with QueryCounter() as counter:
+			result = self.client.get("/check-username", query_string={"username": "ShePard"})
+		self.assertIn("exists", result.data)
+		self.assertEqual(counter.count, 1)
+
+	def test_check_username_after_registering(self):
+		self.client.get("/check-username", query_string={"username": "kasumi"})
+		s.add_user("Kasumi", "password", 1)
+		result = self.client.get("/check-username", query_string={"username": "kasumi"})
+		self.assertIn("exists", result.data)
+
 	def test_check_if_user_is_available_when_not(self):
 		result = self.client.get("/check-username", query_string={"username":"shepard"})
 		self.assertIn("exists", result.data)
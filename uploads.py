@@ -0,0 +1,78 @@
+"""Receives uploaded files a chunk at a time, straight to disk, so that a worker never holds
+a whole upload in memory however many are coming in at once"""
+
+import os
+
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+#the first bytes of each accepted kind of file, and the extension it is stored with
+MAGIC_NUMBERS = [(b"\xff\xd8\xff", "jpg"), (b"\x89PNG\r\n\x1a\n", "png")]
+HEADER_SIZE = max(len(magic) for magic, extension in MAGIC_NUMBERS)
+
+
+class UploadRejected(ValueError):
+	"""Raised when an upload is turned away, with the HTTP status to answer with"""
+
+	def __init__(self, message, status):
+		ValueError.__init__(self, message)
+		self.status = status
+
+
+def sniff(header):
+	"""Returns the extension for a file starting with header, or None if it isn't a kind
+	of file that is accepted"""
+
+	for magic, extension in MAGIC_NUMBERS:
+		if header.startswith(magic):
+			return extension
+	return None
+
+def read_header(stream):
+	"""Reads the first HEADER_SIZE bytes of a stream (fewer only if it ends first)"""
+
+	header = b""
+	while len(header) < HEADER_SIZE:
+		chunk = stream.read(HEADER_SIZE - len(header))
+		if not chunk:
+			break
+		header += chunk
+	return header
+
+def receive_upload(stream, folder, max_bytes, content_length=None):
+	"""Copies an upload from stream into folder CHUNK_SIZE bytes at a time, and returns the
+	path it is stored at, under a name of its own (so that uploads of the same file at once
+	can't get in each other's way). It is turned away (raising UploadRejected) before any of
+	it is read if content_length is over max_bytes, once its first bytes show it isn't a JPEG
+	or PNG, or as soon as it grows past max_bytes. It is written as a .part file and renamed
+	when complete, so a rejected or broken off upload never leaves a file behind"""
+
+	if content_length is not None and content_length > max_bytes:
+		raise UploadRejected("The file is larger than %d MB" % (max_bytes // (1024 * 1024)), 413)
+	header = read_header(stream)
+	extension = sniff(header)
+	if extension is None:
+		raise UploadRejected("Please upload a .jpg or .png picture", 415)
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+	handle, temporary_path = tempfile.mkstemp(dir=folder, suffix=".part")
+	try:
+		size = len(header)
+		with os.fdopen(handle, "wb") as temporary_file:
+			temporary_file.write(header)
+			while True:
+				chunk = stream.read(CHUNK_SIZE)
+				if not chunk:
+					break
+				size += len(chunk)
+				if size > max_bytes:
+					raise UploadRejected("The file is larger than %d MB" % (max_bytes // (1024 * 1024)), 413)
+				temporary_file.write(chunk)
+		path = temporary_path[:-len(".part")] + "." + extension
+		os.chmod(temporary_path, 0o644)
+		os.rename(temporary_path, path)
+	except BaseException:
+		if os.path.exists(temporary_path):
+			os.remove(temporary_path)
+		raise
+	return path
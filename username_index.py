@@ -0,0 +1,167 @@
+"""In-memory index of the usernames already taken, so that the username check on the
+registration form can answer "available" without asking the database"""
+
+from hashlib import md5
+
+import math
+
+import struct
+
+import threading
+
+import time
+
+
+class BloomFilter(object):
+	"""Set membership in a fixed amount of memory: "not in" answers are always right, and
+	"in" answers are wrong for about error_rate of the strings never added"""
+
+	def __init__(self, capacity, error_rate=0.01):
+		capacity = max(int(capacity), 1)
+		self.capacity = capacity
+		self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+		self.hash_count = max(int(round(self.size * math.log(2) / capacity)), 1)
+		self.bits = bytearray((self.size + 7) // 8)
+		self.count = 0
+
+	def positions(self, value):
+		"""Returns the bit positions for a string (double hashing from one md5 digest)"""
+
+		first, second = struct.unpack("<QQ", md5(value.encode("utf-8")).digest())
+		return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+	def add(self, value):
+		for position in self.positions(value):
+			self.bits[position // 8] |= 1 << (position % 8)
+		self.count += 1
+
+	def __contains__(self, value):
+		for position in self.positions(value):
+			if not self.bits[position // 8] & (1 << (position % 8)):
+				return False
+		return True
+
+
+class UsernameIndex(object):
+	"""Bloom filter of the lowercased usernames in use. loader(after_user_id) returns
+	(user_id, username) for the users with a higher user_id: everyone on first use, and
+	then every refresh seconds the users registered since (through other workers too).
+	user_ids are handed out as rows are inserted but can be committed out of order, so each
+	refresh reads the last overlap user_ids again, and the filter is rebuilt from scratch
+	every full_reload seconds (and at twice the size when it fills up) to pick up any
+	commit that took longer than that"""
+
+	def __init__(self, loader, capacity=100000, error_rate=0.01, refresh=5, overlap=1000, full_reload=300):
+		self.loader = loader
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.refresh = refresh
+		self.overlap = overlap
+		self.full_reload = full_reload
+		self.lookups = 0
+		self.negatives = 0
+		self._filter = None
+		self._last_user_id = 0
+		#the user_ids within overlap of the last one, so that reading them again doesn't count them twice
+		self._recent = set()
+		self._refreshed_at = 0
+		self._built_at = 0
+		self._loading = False
+		#usernames added while a new filter is being built, to be copied into it
+		self._added = []
+		self._lock = threading.Lock()
+
+	def _load(self):
+		"""Adds the users registered since the last load, rebuilding the filter if it is
+		missing, full or due a full reload. The database is read and a new filter filled
+		outside of the lock, so that lookups go on being answered from the current filter
+		meanwhile (and only one thread loads at a time)"""
+
+		now = time.time()
+		with self._lock:
+			due = self._filter is None or (self.refresh is not None and now - self._refreshed_at >= self.refresh)
+			if self._loading or not due:
+				return
+			self._loading = True
+			self._added = []
+			rebuild = self._filter is None or (self.full_reload is not None and now - self._built_at >= self.full_reload)
+			after_user_id = 0 if rebuild else max(self._last_user_id - self.overlap, 0)
+			recent = set() if rebuild else set(self._recent)
+			count, capacity = (0, 0) if rebuild else (self._filter.count, self._filter.capacity)
+		try:
+			rows = [(user_id, username) for user_id, username in self.loader(after_user_id) if user_id not in recent]
+			if not rebuild and count + len(rows) > capacity:
+				#a full reload, into a filter with room to grow
+				self.capacity = max(self.capacity, count + len(rows)) * 2
+				rebuild = True
+				rows = self.loader(0)
+			bloom = None
+			if rebuild:
+				bloom = BloomFilter(max(self.capacity, len(rows) * 2), self.error_rate)
+				for user_id, username in rows:
+					bloom.add(username.lower())
+			with self._lock:
+				if rebuild:
+					for username in self._added:
+						bloom.add(username)
+					self._filter = bloom
+					self._last_user_id = 0
+					self._recent = set()
+					self._built_at = now
+				elif self._filter is not None:
+					for user_id, username in rows:
+						self._filter.add(username.lower())
+				for user_id, username in rows:
+					self._last_user_id = max(self._last_user_id, user_id)
+					self._recent.add(user_id)
+				self._recent = set(user_id for user_id in self._recent if user_id > self._last_user_id - self.overlap)
+				self._refreshed_at = now
+		finally:
+			with self._lock:
+				self._loading = False
+
+	def might_exist(self, username):
+		"""Returns False if no user has this username (in any case), True if one might (which
+		is also the answer while the first load is still running in another thread)"""
+
+		self._load()
+		with self._lock:
+			self.lookups += 1
+			if self._filter is None or username.lower() in self._filter:
+				return True
+			self.negatives += 1
+			return False
+
+	def add(self, username):
+		"""Records a new user straight away (for users registered through this worker)"""
+
+		#the last loaded user_id is left alone, so that users registered meanwhile through
+		#other workers (with lower user_ids) are still picked up by the next refresh
+		with self._lock:
+			if self._loading:
+				self._added.append(username.lower())
+			if self._filter is None:
+				return
+			if self._filter.count >= self._filter.capacity:
+				self._filter = None
+				return
+			self._filter.add(username.lower())
+
+	def clear(self):
+		"""Empties the index, so that it is reloaded on next use"""
+
+		with self._lock:
+			self._filter = None
+			self._last_user_id = 0
+			self._recent = set()
+			self.lookups = 0
+			self.negatives = 0
+
+	def stats(self):
+		"""Returns the number of lookups, how many were answered without the database, and
+		the filter's size"""
+
+		with self._lock:
+			return {"lookups": self.lookups, "negatives": self.negatives,
+				"usernames": self._filter.count if self._filter is not None else 0,
+				"capacity": self._filter.capacity if self._filter is not None else 0}
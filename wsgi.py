@@ -0,0 +1,8 @@
+"""WSGI entry point for multi-worker servers, configured from environment variables
+(see configure_app in server.py)
+
+	gunicorn --worker-class gthread --workers 4 --threads 20 wsgi:application"""
+
+from server import configure_app
+
+application = configure_app()